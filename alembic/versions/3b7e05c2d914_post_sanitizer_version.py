@@ -0,0 +1,26 @@
+"""post sanitizer version
+
+Revision ID: 3b7e05c2d914
+Revises: 9f2c41d7a8e3
+Create Date: 2026-10-19 11:02:17.530914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7e05c2d914'
+down_revision = '9f2c41d7a8e3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing posts get version 0, so the resanitize worker checks them all
+    # against the current allowlist once
+    op.add_column('posts', sa.Column('sanitizer_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('posts', 'sanitizer_version')
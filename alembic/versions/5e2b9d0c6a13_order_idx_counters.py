@@ -0,0 +1,41 @@
+"""order_idx counters
+
+Revision ID: 5e2b9d0c6a13
+Revises: c81e4a7f20b6
+Create Date: 2026-10-19 15:52:40.671203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2b9d0c6a13'
+down_revision = 'c81e4a7f20b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('chapters', sa.Column('next_post_idx', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('stories', sa.Column('next_chapter_idx', sa.Integer(), server_default='0', nullable=False))
+    # start each counter after the last index in use
+    op.execute("""
+        UPDATE chapters SET next_post_idx = m.max_idx + 10
+        FROM (SELECT chapter_id, max(order_idx) AS max_idx
+              FROM posts GROUP BY chapter_id) AS m
+        WHERE chapters.id = m.chapter_id
+    """)
+    op.execute("""
+        UPDATE stories SET next_chapter_idx = m.max_idx + 10
+        FROM (SELECT story_id, max(order_idx) AS max_idx
+              FROM chapters GROUP BY story_id) AS m
+        WHERE stories.id = m.story_id
+    """)
+    op.create_index('post_order_idx', 'posts', ['chapter_id', 'order_idx'], unique=False)
+
+
+def downgrade():
+    op.drop_index('post_order_idx', table_name='posts')
+    op.drop_column('stories', 'next_chapter_idx')
+    op.drop_column('chapters', 'next_post_idx')
@@ -0,0 +1,24 @@
+"""post version
+
+Revision ID: 9f2c41d7a8e3
+Revises: d3930fd73fb2
+Create Date: 2026-10-19 10:12:40.118263
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9f2c41d7a8e3'
+down_revision = 'd3930fd73fb2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('posts', 'version')
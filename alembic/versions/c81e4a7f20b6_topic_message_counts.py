@@ -0,0 +1,36 @@
+"""topic message counts
+
+Revision ID: c81e4a7f20b6
+Revises: 3b7e05c2d914
+Create Date: 2026-10-19 14:37:05.218846
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81e4a7f20b6'
+down_revision = '3b7e05c2d914'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('topics', sa.Column('message_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('topics', sa.Column('last_post_date', sa.DateTime(timezone=True), nullable=True))
+    op.execute("""
+        UPDATE topics SET message_count = m.num_msgs,
+                          last_post_date = m.latest_post
+        FROM (SELECT topic_id, count(id) AS num_msgs,
+                     max(post_date) AS latest_post
+              FROM topic_messages GROUP BY topic_id) AS m
+        WHERE topics.id = m.topic_id
+    """)
+    op.create_index('topic_story_activity_idx', 'topics', ['story_id', 'last_post_date'], unique=False)
+
+
+def downgrade():
+    op.drop_index('topic_story_activity_idx', table_name='topics')
+    op.drop_column('topics', 'last_post_date')
+    op.drop_column('topics', 'message_count')
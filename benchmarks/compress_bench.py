@@ -0,0 +1,83 @@
+#!python3
+
+# Benchmark for response compression: bytes on the wire and CPU time per
+# response, for each encoding and level, on a chapter-page-sized body. By
+# default the body is a synthetic chapter page (posts plus a chat backlog);
+# pass --url to fetch a real page from a running server instead, e.g.
+#
+#     python benchmarks/compress_bench.py --url http://localhost:5000/story/1/1
+#
+# Run it with `just bench-compression`. This doesn't need Postgres or Redis.
+
+from __future__ import annotations
+
+import random, sys, time, urllib.request
+from pathlib import Path
+
+import click
+
+# so this works when run as a script from the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from openakun.compression import (  # noqa: E402
+    available_encodings, compress)
+
+WORDS = ('the quest party ventures forth into darkness while the dragon '
+         'sleeps beneath mountain gold and ancient ruins hold secrets of '
+         'forgotten kings vote for option choose wisely').split()
+
+def synthetic_page(n_posts: int, n_chat: int, rng: random.Random) -> bytes:
+    def para(n: int) -> str:
+        return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+    parts = ['<!DOCTYPE html><html><head><title>Chapter</title></head>'
+             '<body><div id="content-container">']
+    for i in range(n_posts):
+        parts.append(
+            f'<div class="post" id="post-{i}" data-post-id="{i}">'
+            f'<div class="post-date" data-dt="{1700000000000 + i}">'
+            f'2025-01-01 00:00 UTC</div><div class="post-text">' +
+            ''.join(f'<p>{para(rng.randint(40, 120))}</p>'
+                    for _ in range(rng.randint(2, 6))) +
+            '</div></div>')
+    parts.append('<div id="chat-messages">')
+    for i in range(n_chat):
+        parts.append(
+            f'<div class="chat-msg" id="chat-{i}" hx-get="/view_chat/1'
+            f'?thread_id={i}"><span class="username">anon</span> '
+            f'<span class="msg-text">{para(rng.randint(3, 30))}</span>'
+            f'</div>')
+    parts.append('</div></div></body></html>')
+    return ''.join(parts).encode()
+
+@click.command()
+@click.option('--posts', default=40, help="Posts on the synthetic page")
+@click.option('--chat', default=100, help="Chat messages on the page")
+@click.option('--url', default=None, help="Fetch this page to compress")
+@click.option('--rounds', default=50, help="Compressions per setting")
+@click.option('--seed', default=0, help="Random seed")
+def main(posts: int, chat: int, url: str | None, rounds: int,
+         seed: int) -> None:
+    if url is not None:
+        with urllib.request.urlopen(url) as r:
+            body = r.read()
+    else:
+        body = synthetic_page(posts, chat, random.Random(seed))
+
+    print(f"\nbody {len(body)} bytes, {rounds} rounds per setting")
+    print(f"  {'encoding':<10}{'level':>6}{'bytes':>10}{'ratio':>8}"
+          f"{'cpu ms':>10}")
+    levels = { 'gzip': (1, 6, 9), 'br': (1, 4, 6, 11) }
+    for enc in available_encodings():
+        for level in levels[enc]:
+            start = time.process_time()
+            for _ in range(rounds):
+                out = compress(body, enc, level)
+            cpu = (time.process_time() - start) / rounds
+            print(f"  {enc:<10}{level:>6}{len(out):>10}"
+                  f"{len(out) / len(body):>8.3f}{cpu * 1000:>10.3f}")
+    if 'br' not in available_encodings():
+        print("  (brotli isn't installed, so only gzip was measured)")
+
+if __name__ == '__main__':
+    main()
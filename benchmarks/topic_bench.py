@@ -0,0 +1,190 @@
+#!python3
+
+# Benchmark for the story topic list shown on every chapter page: the query
+# it used to run, which loaded every message of every topic, against the
+# current one, which reads the counts kept on the topic rows. This runs
+# against a throwaway Postgres container it starts itself (or an existing
+# database given with --db-url, whose tables get dropped, so be careful), and
+# doesn't need Redis.
+#
+# Run it with `just bench-topics`, or directly:
+#
+#     python benchmarks/topic_bench.py --topics 50 --replies 5000
+
+from __future__ import annotations
+
+import asyncio, random, socket, subprocess, sys, time
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+import click
+from sqlalchemy import select, insert, func
+from sqlalchemy.ext.asyncio import (create_async_engine, AsyncEngine,
+                                    AsyncSession)
+from sqlalchemy.orm import selectinload
+
+# so this works when run as a script from the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from openakun import models, pages  # noqa: E402
+
+from typing import Any, Awaitable, Callable  # noqa: E402
+
+POSTGRES_IMAGE = "postgres:15-alpine"
+DB_PASSWORD = "bench"
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_postgres() -> tuple[str, str]:
+    port = free_port()
+    name = f'openakun-topic-bench-{port}'
+    try:
+        subprocess.run(
+            ['docker', 'run', '--rm', '-d', '--name', name,
+             '-e', f'POSTGRES_PASSWORD={DB_PASSWORD}',
+             '-p', f'{port}:5432', POSTGRES_IMAGE],
+            check=True, stdout=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        raise click.ClickException(
+            "couldn't start a Postgres container; pass --db-url instead")
+    return name, (f'postgresql+asyncpg://postgres:{DB_PASSWORD}'
+                  f'@127.0.0.1:{port}/postgres')
+
+async def wait_ready(engine: AsyncEngine) -> None:
+    for _ in range(60):
+        try:
+            async with engine.connect():
+                return
+        except Exception:
+            await asyncio.sleep(0.5)
+    raise click.ClickException("Postgres didn't come up")
+
+async def seed(engine: AsyncEngine, n_topics: int, n_replies: int,
+               rng: random.Random) -> int:
+    """Creates one story with n_topics topics and n_replies messages spread
+    over them, and returns the story ID."""
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.drop_all)
+        await conn.run_sync(models.Base.metadata.create_all)
+
+    now = datetime.now(tz=timezone.utc)
+    async with AsyncSession(engine) as s:
+        user = models.User(name='bench', password_hash='x', joined_date=now)
+        story = models.Story(title='bench', description='bench',
+                             author=user, channel=models.Channel())
+        topics = [models.Topic(title=f'topic {i}', poster=user,
+                               post_date=now, story=story)
+                  for i in range(n_topics)]
+        s.add_all([user, story, *topics])
+        await s.commit()
+        story_id, user_id = story.id, user.id
+        topic_ids = [t.id for t in topics]
+
+        rows = []
+        counts = { t: (0, None) for t in topic_ids }
+        for i in range(n_replies):
+            tid = rng.choice(topic_ids)
+            date = now + timedelta(seconds=i)
+            rows.append({ 'topic_id': tid, 'poster_id': user_id,
+                          'post_date': date,
+                          'text': f'<p>reply {i} ' + 'text ' * 50 + '</p>' })
+            counts[tid] = (counts[tid][0] + 1, date)
+        for i in range(0, len(rows), 1000):
+            await s.execute(insert(models.TopicMessage), rows[i:i + 1000])
+        # what new_topic_post keeps up to date as messages come in
+        for tid, (n, last) in counts.items():
+            t = await s.get(models.Topic, tid)
+            assert t is not None
+            t.message_count, t.last_post_date = n, last
+        await s.commit()
+    return story_id
+
+async def old_get_topics(s: AsyncSession,
+                         story_id: int) -> list[models.Topic]:
+    # the topic list query as it was before the counts were denormalised
+    msgs = select(
+        models.TopicMessage.topic_id,
+        func.count(models.TopicMessage.id).label('num_msgs'),
+        func.max(models.TopicMessage.post_date).label('latest_post')
+    ).group_by(models.TopicMessage.topic_id).subquery()
+    return list((await s.scalars(
+        select(models.Topic).
+        options(
+            selectinload(models.Topic.poster),
+            selectinload(models.Topic.messages)).
+        outerjoin(msgs, models.Topic.id == msgs.c.topic_id).
+        filter(models.Topic.story_id == story_id).
+        order_by(msgs.c.latest_post.desc(),
+                 models.Topic.post_date.desc()))).all())
+
+async def time_query(
+        engine: AsyncEngine, rounds: int,
+        fn: Callable[[AsyncSession], Awaitable[list[models.Topic]]]
+) -> tuple[list[float], int]:
+    times = []
+    n_objs = 0
+    for _ in range(rounds):
+        # a fresh session each time, as each request would have
+        async with AsyncSession(engine) as s:
+            start = time.perf_counter()
+            await fn(s)
+            times.append(time.perf_counter() - start)
+            n_objs = len(s.identity_map)
+    return times, n_objs
+
+def summarise(times: list[float], n_objs: int) -> dict[str, Any]:
+    st = sorted(times)
+    return {
+        'p50_ms': st[len(st) // 2] * 1000,
+        'p95_ms': st[min(int(len(st) * 0.95), len(st) - 1)] * 1000,
+        'max_ms': st[-1] * 1000,
+        'objects_loaded': n_objs,
+    }
+
+@click.command()
+@click.option('--topics', default=50, help="Topics in the story")
+@click.option('--replies', default=5000, help="Messages across all topics")
+@click.option('--rounds', default=30, help="Times to run each query")
+@click.option('--seed', 'rng_seed', default=0, help="Random seed")
+@click.option('--db-url', default=None,
+              help="Use this database instead of starting one (its tables "
+              "get dropped)")
+def main(topics: int, replies: int, rounds: int, rng_seed: int,
+         db_url: str | None) -> None:
+    container = None
+    if db_url is None:
+        container, db_url = start_postgres()
+
+    async def run() -> dict[str, dict[str, Any]]:
+        engine = create_async_engine(db_url)
+        try:
+            await wait_ready(engine)
+            story_id = await seed(engine, topics, replies,
+                                  random.Random(rng_seed))
+            old = await time_query(
+                engine, rounds, lambda s: old_get_topics(s, story_id))
+            new = await time_query(
+                engine, rounds, lambda s: pages.get_topics(story_id, s))
+            return { 'old': summarise(*old), 'new': summarise(*new) }
+        finally:
+            await engine.dispose()
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        if container is not None:
+            subprocess.run(['docker', 'stop', container],
+                           stdout=subprocess.DEVNULL)
+
+    print(f"\n{topics} topics, {replies} replies, {rounds} rounds")
+    print(f"  {'query':<8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"
+          f"{'objects':>10}")
+    for name, r in results.items():
+        print(f"  {name:<8}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}"
+              f"{r['max_ms']:>10.3f}{r['objects_loaded']:>10}")
+
+if __name__ == '__main__':
+    main()
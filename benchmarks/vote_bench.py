@@ -0,0 +1,276 @@
+#!python3
+
+# Benchmark for the vote hot paths: the Lua vote functions, and the Python
+# code that reads vote state back out of Redis to render it. This runs against
+# a throwaway redis-server it starts itself (or an existing one given with
+# --redis-url, which gets FLUSHALLed, so be careful), and doesn't need
+# Postgres.
+#
+# Run it with `just bench-votes`, or directly:
+#
+#     python benchmarks/vote_bench.py --voters 200 --options 20
+#
+# Passing --max-p99-ms makes it exit non-zero if any operation's p99 latency
+# goes over the limit, for use in CI.
+
+from __future__ import annotations
+
+import asyncio, json, random, shutil, socket, subprocess, sys, time
+import importlib.resources
+from pathlib import Path
+
+import click
+import redis.asyncio as redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from attrs import define, field
+
+# so this works when run as a script from the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from openakun import realtime  # noqa: E402
+from openakun.general import db  # noqa: E402
+from openakun.data import VoteSkeleton  # noqa: E402
+
+from typing import Any, Awaitable, Callable, Iterator  # noqa: E402
+
+CHANNEL_ID = 1
+
+@define
+class OpStats:
+    times: list[float] = field(factory=list)
+    request_bytes: int = 0
+
+    def percentile(self, p: float) -> float:
+        s = sorted(self.times)
+        return s[min(int(len(s) * p / 100), len(s) - 1)]
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'count': len(self.times),
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': max(self.times) * 1000,
+            'avg_request_bytes': self.request_bytes / len(self.times),
+        }
+
+class Recorder:
+    def __init__(self) -> None:
+        self.ops: dict[str, OpStats] = {}
+
+    async def time(self, name: str, aw: Awaitable[Any],
+                   request_bytes: int = 0) -> Any:
+        start = time.perf_counter()
+        rv = await aw
+        st = self.ops.setdefault(name, OpStats())
+        st.times.append(time.perf_counter() - start)
+        st.request_bytes += request_bytes
+        return rv
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_redis() -> tuple[subprocess.Popen, str]:
+    exe = shutil.which('redis-server')
+    if exe is None:
+        raise click.ClickException(
+            "redis-server not found; install it or pass --redis-url")
+    port = free_port()
+    proc = subprocess.Popen(
+        [exe, '--port', str(port), '--save', '', '--appendonly', 'no'],
+        stdout=subprocess.DEVNULL)
+    return proc, f'redis://127.0.0.1:{port}/0'
+
+async def wait_ready(conn: redis.Redis) -> None:
+    for _ in range(50):
+        try:
+            await conn.ping()
+            return
+        except RedisConnectionError:
+            await asyncio.sleep(0.1)
+    raise click.ClickException("redis-server didn't come up")
+
+async def redis_cpu(conn: redis.Redis) -> float:
+    info = await conn.info('cpu')
+    return float(info['used_cpu_sys']) + float(info['used_cpu_user'])
+
+def option_ids(vote_id: int, n_opts: int) -> Iterator[int]:
+    return iter(range(vote_id * 10000, vote_id * 10000 + n_opts))
+
+async def seed_vote(conn: redis.Redis, vote_id: int, n_opts: int,
+                    multivote: bool) -> VoteSkeleton:
+    rd = {
+        'multivote': multivote,
+        'writein_allowed': True,
+        'votes_hidden': False,
+        'close_time': False,
+        'channel_id': CHANNEL_ID,
+        'votes': { str(o): { 'killed': False, 'killed_text': None,
+                             'users_voted_for': [] }
+                   for o in option_ids(vote_id, n_opts) },
+    }
+    async with conn.pipeline(transaction=True) as pipe:
+        pipe.hset('vote_info', str(vote_id), json.dumps(rd))
+        pipe.delete(realtime.user_index_key(vote_id))
+        pipe.sadd(f'channel_votes:{CHANNEL_ID}', str(vote_id))
+        await pipe.execute()
+    return VoteSkeleton(
+        db_id=vote_id, question=f'vote {vote_id}', author_id=1,
+        entries=tuple((o, f'option {o}')
+                      for o in option_ids(vote_id, n_opts)))
+
+async def fcall(rec: Recorder, conn: redis.Redis, name: str,
+                *args: Any) -> Any:
+    keys = (f'channel_votes:{CHANNEL_ID}', 'vote_info')
+    size = sum(len(str(a)) for a in keys + args)
+    return await rec.time(name, conn.fcall(name, 2, *keys, *args), size)
+
+async def voter(rec: Recorder, conn: redis.Redis, vote_id: int, n: int,
+                n_opts: int, rounds: int, rng: random.Random,
+                next_option: Callable[[], int]) -> None:
+    uid = f'anon:voter{n}'
+    opts = list(option_ids(vote_id, n_opts))
+    for _ in range(rounds):
+        r = rng.random()
+        if r < 0.6:
+            await fcall(rec, conn, 'add_vote', vote_id, rng.choice(opts), uid)
+        elif r < 0.9:
+            await fcall(rec, conn, 'remove_vote', vote_id,
+                        rng.choice(opts), uid)
+        elif r < 0.97:
+            await rec.time(
+                'py.get_user_votes', realtime.get_user_votes(vote_id, uid))
+        else:
+            oid = next_option()
+            await fcall(rec, conn, 'new_vote_entry', vote_id, oid, uid)
+            opts.append(oid)
+
+async def author(rec: Recorder, conn: redis.Redis, vote_id: int,
+                 skeleton: VoteSkeleton, multivote: bool,
+                 rounds: int, stop: asyncio.Event) -> None:
+    # the author fiddles with the config while the vote is going, and
+    # re-renders happen the way the coalescer would do them
+    for i in range(rounds):
+        if stop.is_set():
+            return
+        conf = json.dumps({ 'multivote': multivote,
+                            'writein_allowed': True,
+                            'votes_hidden': bool(i % 2) })
+        await fcall(rec, conn, 'set_vote_config', vote_id, conf)
+        rds = await rec.time('hget_vote_info',
+                             conn.hget('vote_info', str(vote_id)))
+        start = time.perf_counter()
+        skeleton.to_vote(json.loads(rds))
+        st = rec.ops.setdefault('py.to_vote', OpStats())
+        st.times.append(time.perf_counter() - start)
+        await asyncio.sleep(0.005)
+
+async def run_scenario(conn: redis.Redis, voters: int, options: int,
+                       rounds: int, multivote: bool,
+                       seed: int) -> dict[str, Any]:
+    await conn.flushall()
+    lua = (importlib.resources.files('openakun').
+           joinpath('redisvotes.lua').read_text())
+    await conn.function_load(lua, replace=True)
+
+    vote_id = 1
+    skeleton = await seed_vote(conn, vote_id, options, multivote)
+    rec = Recorder()
+    rng = random.Random(seed)
+    new_ids = iter(range(vote_id * 10000 + options, vote_id * 10000 + 9999))
+
+    cpu_before = await redis_cpu(conn)
+    start = time.perf_counter()
+    stop = asyncio.Event()
+    author_task = asyncio.create_task(
+        author(rec, conn, vote_id, skeleton, multivote, rounds * 10, stop))
+    await asyncio.gather(*(
+        voter(rec, conn, vote_id, n, options, rounds,
+              random.Random(rng.random()), lambda: next(new_ids))
+        for n in range(voters)))
+    stop.set()
+    await author_task
+    wall = time.perf_counter() - start
+    cpu = await redis_cpu(conn) - cpu_before
+
+    vote_bytes = await conn.hstrlen('vote_info', str(vote_id))
+    index_bytes = await conn.memory_usage(realtime.user_index_key(vote_id))
+    return {
+        'multivote': multivote,
+        'voters': voters,
+        'options': options,
+        'wall_s': wall,
+        'redis_cpu_s': cpu,
+        'vote_json_bytes': vote_bytes,
+        'user_index_bytes': index_bytes,
+        'ops': { k: v.to_dict() for k, v in sorted(rec.ops.items()) },
+    }
+
+def print_result(res: dict[str, Any]) -> None:
+    print(f"\nmultivote={res['multivote']}  voters={res['voters']}  "
+          f"options={res['options']}")
+    print(f"  wall {res['wall_s']:.2f}s, redis cpu {res['redis_cpu_s']:.2f}s, "
+          f"vote JSON {res['vote_json_bytes']} bytes, "
+          f"user index {res['user_index_bytes']} bytes")
+    print(f"  {'op':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'max ms':>10}{'req B':>8}")
+    for name, st in res['ops'].items():
+        print(f"  {name:<20}{st['count']:>8}{st['p50_ms']:>10.3f}"
+              f"{st['p95_ms']:>10.3f}{st['p99_ms']:>10.3f}"
+              f"{st['max_ms']:>10.3f}{st['avg_request_bytes']:>8.0f}")
+
+@click.command()
+@click.option('--voters', default=100, help="Concurrent voters")
+@click.option('--options', default=10, help="Options on the vote")
+@click.option('--rounds', default=50, help="Operations per voter")
+@click.option('--seed', default=0, help="Random seed")
+@click.option('--redis-url', default=None,
+              help="Use this Redis instead of starting one (it gets wiped)")
+@click.option('--json-out', type=click.Path(), default=None,
+              help="Also write the results here as JSON")
+@click.option('--max-p99-ms', type=float, default=None,
+              help="Fail if any operation's p99 latency is over this")
+def main(voters: int, options: int, rounds: int, seed: int,
+         redis_url: str | None, json_out: str | None,
+         max_p99_ms: float | None) -> None:
+    proc = None
+    if redis_url is None:
+        proc, redis_url = start_redis()
+
+    async def run() -> list[dict[str, Any]]:
+        conn = redis.Redis.from_url(redis_url, max_connections=voters + 8)
+        db.redis_conn = conn
+        try:
+            await wait_ready(conn)
+            return [await run_scenario(conn, voters, options, rounds, mv,
+                                       seed)
+                    for mv in (True, False)]
+        finally:
+            await conn.aclose()
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    for res in results:
+        print_result(res)
+    if json_out is not None:
+        Path(json_out).write_text(json.dumps(results, indent=2))
+
+    if max_p99_ms is not None:
+        slow = [(res['multivote'], name, st['p99_ms'])
+                for res in results for name, st in res['ops'].items()
+                if st['p99_ms'] > max_p99_ms]
+        for mv, name, p99 in slow:
+            print(f"FAIL: {name} (multivote={mv}) p99 {p99:.3f}ms "
+                  f"> {max_p99_ms}ms")
+        if slow:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
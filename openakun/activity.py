@@ -0,0 +1,105 @@
+#!python3
+
+from __future__ import annotations
+
+from datetime import datetime
+import time
+
+from . import models
+from .general import db
+
+from sqlalchemy import select, func
+from typing import Awaitable, cast
+
+def to_ms(d: datetime) -> int:
+    return int(d.timestamp() * 1000)
+
+class StoryActivity:
+    """An index of stories by when something last happened in them (a post,
+    a new vote or a chat message), kept in a Redis sorted set of channel IDs
+    scored by the time of that activity in milliseconds. The front page is
+    read from this, so it costs the same however many stories there are.
+
+    Channel IDs are used rather than story IDs since that's what the chat
+    and vote code have to hand; every channel belongs to exactly one story.
+
+    """
+    key = 'story_activity'
+
+    async def _range(self, high: int | str, low: int | str,
+                     count: int) -> list[tuple[bytes, float]]:
+        return await cast(Awaitable[list[tuple[bytes, float]]],
+                          db.redis_conn.zrevrangebyscore(
+                              self.key, high, low, start=0, num=count,
+                              withscores=True))
+
+    async def touch(self, channel_id: int,
+                    when: datetime | None = None) -> None:
+        ms = int(time.time() * 1000) if when is None else to_ms(when)
+        # GT, so something reported late doesn't move a story backwards
+        await db.redis_conn.zadd(self.key, { str(channel_id): ms }, gt=True)
+
+    async def page(
+            self, count: int, before: tuple[int, int] | None = None
+    ) -> list[tuple[int, int]]:
+        """Returns up to count (channel ID, activity time) pairs, most recent
+        first. before is the last pair of the previous page, if any; this
+        page carries on from just after it."""
+        if before is None:
+            rows = await self._range('+inf', '-inf', count)
+            return [(int(m), int(sc)) for m, sc in rows]
+
+        # Members with the same score come in reverse lexical order, so the
+        # ones tied with the cursor that were on the previous page are all at
+        # the start of this range; fetch enough extra to skip past them.
+        before_ms, before_cid = before
+        ties = await cast(Awaitable[int], db.redis_conn.zcount(
+            self.key, before_ms, before_ms))
+        rows = await self._range(before_ms, '-inf', count + ties)
+        rv = []
+        for m, sc in rows:
+            if int(sc) == before_ms and m >= str(before_cid).encode():
+                continue
+            rv.append((int(m), int(sc)))
+        return rv[:count]
+
+    async def live(self, window: float, count: int) -> list[tuple[int, int]]:
+        """Stories with activity in the last window seconds, most recent
+        first."""
+        since = int((time.time() - window) * 1000)
+        rows = await self._range('+inf', since, count)
+        return [(int(m), int(sc)) for m, sc in rows]
+
+    async def seed(self) -> None:
+        """Builds the index from Postgres, if it's not in Redis already (on
+        first startup, or after Redis lost its data). This is the only place
+        that has to look at every story's posts and chat."""
+        if await cast(Awaitable[int], db.redis_conn.exists(self.key)):
+            return
+        start = time.perf_counter()
+        async with db.Session() as s:
+            latest = {
+                cid: 0 for cid in (await s.scalars(
+                    select(models.Story.channel_id))).all() }
+            post_times = (await s.execute(
+                select(models.Story.channel_id,
+                       func.max(models.Post.posted_date)).
+                join(models.Post, models.Post.story_id == models.Story.id).
+                group_by(models.Story.channel_id))).all()
+            chat_times = (await s.execute(
+                select(models.ChatMessage.channel_id,
+                       func.max(models.ChatMessage.date)).
+                group_by(models.ChatMessage.channel_id))).all()
+        for cid, d in (*post_times, *chat_times):
+            if cid in latest and d is not None:
+                latest[cid] = max(latest[cid], to_ms(d))
+        items = list(latest.items())
+        for i in range(0, len(items), 1000):
+            await db.redis_conn.zadd(
+                self.key, { str(c): ms for c, ms in items[i:i + 1000] },
+                gt=True)
+        print(f"Seeded activity for {len(items)} stories in "
+              f"{time.perf_counter() - start:.3f}s")
+
+# global
+story_activity = StoryActivity()
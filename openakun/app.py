@@ -1,8 +1,10 @@
 import quart_flask_patch
 
-from . import models, realtime, pages, websocket, worker
+from . import (models, realtime, pages, websocket, worker, cache, data,
+               activity, assets, compression)
 from .general import (make_csrf, get_script_nonce, add_csp, csp_report,
-                      db_setup, db, login_mgr, add_htmx_vary, db_close)
+                      db_setup, db, login_mgr, add_htmx_vary, db_close,
+                      build_version, csrf_token)
 from .config import Config, CSPLevel
 
 import click, signal, traceback, threading, asyncio, uvicorn
@@ -42,6 +44,12 @@ def create_app(config: Config) -> Quart:
 
     websocket.pubsub.set_redis_opts(config.redis_url,
                                     True, True)
+    realtime.vote_updates.init_app(app, config.vote_update_interval)
+    pages.topic_list_updates.init_app(app, config.topic_list_interval)
+    cache.page_cache.ttl = config.page_cache_ttl
+    pages.post_fragments.maxsize = config.post_fragment_cache_size
+    data.sanitizer_pool.threshold = config.sanitize_offload_size
+    data.sanitizer_pool.max_workers = config.sanitize_workers
 
     app.config['csp_report_only'] = config.csp_level == CSPLevel.Report
     # TODO merge this with the default .config attr properly
@@ -53,8 +61,16 @@ def create_app(config: Config) -> Quart:
     app.jinja_env.globals['models'] = models
 
     app.add_template_global(get_script_nonce)
+    app.add_template_global(csrf_token)
 
     app.before_request(make_csrf)
+    # after_request functions run last-registered first, so this runs after
+    # the others have finished with the response
+    rc = compression.response_compressor
+    rc.min_size = config.compress_min_size
+    rc.gzip_level = config.gzip_level
+    rc.brotli_level = config.brotli_level
+    app.after_request(compression.response_compressor)
     app.after_request(add_csp)
     app.after_request(add_htmx_vary)
     app.after_request(db_close)
@@ -66,6 +82,10 @@ def create_app(config: Config) -> Quart:
     app.teardown_appcontext(close_db_session)
 
     pages.htmx.init_app(app)
+    if config.fingerprint_assets:
+        assets.asset_manifest.init_app(app)
+    # hashed now rather than on the first request
+    print(f"Build version {build_version()}")
 
     return app
 
@@ -113,7 +133,12 @@ def do_run(host: str, port: int, debug: bool, devel: bool) -> None:
         # signal.signal(signal.SIGTERM, sigterm)
         # signal.signal(signal.SIGINT, sigterm)
         # signal.signal(signal.SIGUSR1, start_debug)
-        await realtime.repopulate_from_db()
+        if config.redis_snapshot_restart:
+            await realtime.restore_vote_state()
+        else:
+            await realtime.repopulate_from_db()
+        await realtime.seed_anon_voters()
+        await activity.story_activity.seed()
         if not devel:
             ucfg = uvicorn.Config(app)
         tasks = []
@@ -126,16 +151,27 @@ def do_run(host: str, port: int, debug: bool, devel: bool) -> None:
                 tasks.append(
                     asyncio.create_task(worker.chat_save_worker()))
                 tasks.append(
-                    asyncio.create_task(worker.vote_close_worker()))
+                    asyncio.create_task(worker.vote_closer.run()))
+                tasks.append(
+                    asyncio.create_task(worker.vote_checkpointer.run(
+                        config.vote_checkpoint_interval)))
+                tasks.append(
+                    asyncio.create_task(worker.resanitize_worker()))
                 # TODO figure out the reloader logic in this context
                 tasks.append(
                     asyncio.create_task(
                         app.run_task(host=host, port=port, debug=debug)))
                 await asyncio.gather(*tasks) 
         finally:
-            print("Closing out Redis data...")
-            await realtime.close_to_db()
+            if config.redis_snapshot_restart:
+                print("Saving Redis data...")
+                await realtime.save_vote_state()
+            else:
+                print("Closing out Redis data...")
+                await realtime.close_to_db()
             print("done")
+            data.sanitizer_pool.shutdown()
+            print("Vote updates:", realtime.vote_updates.stats())
     _reload = False
     try:
         loop = asyncio.new_event_loop()
@@ -0,0 +1,130 @@
+#!python3
+
+from __future__ import annotations
+
+import hashlib, mimetypes, re, time
+from pathlib import Path
+
+from quart import Quart, Response, request
+from quart.helpers import send_from_directory
+
+from .metrics import metrics
+from .compression import available_encodings, choose_encoding, compress
+
+from typing import Any
+
+# Served under their own names: TinyMCE loads its plugins, skins and
+# language files by paths relative to itself, so they can't be renamed, and
+# the Tailwind input is only used to build tailwind.css.
+EXCLUDED = ('vendor/tinymce/', 'tailwind-inp.css')
+
+COMPRESSIBLE = ('.css', '.js', '.map', '.svg', '.json', '.txt', '.html')
+
+# don't bother compressing anything smaller than this
+MIN_COMPRESS_SIZE = 512
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# a hashed name: the file's name with the digest before the extension
+HASHED_NAME = re.compile(r'^(.*)\.[0-9a-f]{12}(\.[^./]*)?$')
+
+class Asset:
+    def __init__(self, path: str, content: bytes) -> None:
+        self.path = path
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        stem, dot, ext = path.rpartition('.')
+        self.hashed_path = (f'{stem}.{digest}.{ext}' if dot
+                            else f'{path}.{digest}')
+        self.mimetype = (mimetypes.guess_type(path)[0] or
+                         'application/octet-stream')
+        self.variants: dict[str, bytes] = { 'identity': content }
+        if path.endswith(COMPRESSIBLE) and len(content) >= MIN_COMPRESS_SIZE:
+            for enc in available_encodings():
+                data = compress(content, enc, 11 if enc == 'br' else 9)
+                # only kept if it actually saves something
+                if len(data) < len(content):
+                    self.variants[enc] = data
+
+class AssetManifest:
+    """Content-hashed names for the files in the static folder, so they can be
+    served with a far-future immutable Cache-Control: a changed file gets a
+    new name, so browsers never need to check back for the old one.
+
+    On startup every file is read, hashed and compressed at the highest
+    levels (gzip, and brotli if it's installed), all in memory;
+    url_for('static', filename=...) then produces the hashed names, and
+    requests for them get the best encoding the client accepts. Files added
+    or changed after startup, and excluded ones, are served under their
+    plain names as before. Hashed names from earlier builds get the current
+    file, without the immutable Cache-Control.
+
+    """
+    def __init__(self) -> None:
+        self.assets: dict[str, Asset] = {}
+        self.by_hashed: dict[str, Asset] = {}
+
+    def build(self, static_dir: Path) -> None:
+        start = time.perf_counter()
+        assets = {}
+        for f in sorted(static_dir.rglob('*')):
+            if not f.is_file():
+                continue
+            path = f.relative_to(static_dir).as_posix()
+            if path.startswith(EXCLUDED):
+                continue
+            assets[path] = Asset(path, f.read_bytes())
+        self.assets = assets
+        self.by_hashed = { a.hashed_path: a for a in assets.values() }
+        total = sum(len(a.variants['identity']) for a in assets.values())
+        print(f"Fingerprinted {len(assets)} static files ({total} bytes) in "
+              f"{time.perf_counter() - start:.3f}s")
+
+    def init_app(self, app: Quart) -> None:
+        assert app.static_folder is not None
+        self.static_dir = Path(app.static_folder)
+        self.build(self.static_dir)
+        app.url_defaults(self.hashed_url)
+        app.view_functions['static'] = self.serve
+
+    def hashed_url(self, endpoint: str, values: dict[str, Any]) -> None:
+        if endpoint != 'static':
+            return
+        asset = self.assets.get(values.get('filename', ''))
+        if asset is not None:
+            values['filename'] = asset.hashed_path
+
+    def stale_asset(self, filename: str) -> Asset | None:
+        """Finds the current version of a file asked for by a hashed name from
+        an earlier build, as pages from before a deploy (open, or cached) still
+        will."""
+        m = HASHED_NAME.match(filename)
+        if m is None:
+            return None
+        return self.assets.get(m.group(1) + (m.group(2) or ''))
+
+    async def serve(self, filename: str) -> Response:
+        asset = self.by_hashed.get(filename)
+        immutable = asset is not None
+        if asset is None:
+            asset = self.stale_asset(filename)
+            if asset is not None:
+                metrics.incr('assets.stale')
+        if asset is None:
+            metrics.incr('assets.plain')
+            return await send_from_directory(self.static_dir, filename)
+
+        encoding = choose_encoding(
+            request.accept_encodings,
+            tuple(e for e in available_encodings() if e in asset.variants))
+        metrics.incr(f'assets.{encoding}')
+        resp = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        if encoding != 'identity':
+            resp.headers['Content-Encoding'] = encoding
+        resp.vary.add('Accept-Encoding')
+        # the contents under an old name aren't what that name was for, so
+        # they mustn't be kept as if they were
+        resp.headers['Cache-Control'] = IMMUTABLE if immutable else 'no-cache'
+        return resp
+
+# global
+asset_manifest = AssetManifest()
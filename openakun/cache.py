@@ -0,0 +1,134 @@
+#!python3
+
+from __future__ import annotations
+
+from collections import OrderedDict
+
+from .metrics import metrics
+from .general import db
+
+from typing import Generic, TypeVar, Hashable, Any, Awaitable, cast
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+class LRUCache(Generic[K, V]):
+    """A bounded in-process cache with least-recently-used eviction.
+
+    Hits, misses and evictions are counted in the metrics registry under the
+    cache's name. This is per-node; anything that has to be invalidated across
+    nodes must either be validated on read or keyed by something that changes
+    when the underlying data does.
+
+    """
+    def __init__(self, name: str, maxsize: int) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.data: OrderedDict[K, V] = OrderedDict()
+
+    def get(self, key: K) -> V | None:
+        try:
+            val = self.data[key]
+        except KeyError:
+            metrics.incr(f'{self.name}.misses')
+            return None
+        self.data.move_to_end(key)
+        metrics.incr(f'{self.name}.hits')
+        return val
+
+    def set(self, key: K, val: V) -> None:
+        if self.maxsize <= 0:
+            return
+        self.data[key] = val
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            metrics.incr(f'{self.name}.evictions')
+
+    def pop(self, key: K) -> None:
+        self.data.pop(key, None)
+
+    def clear(self) -> None:
+        self.data.clear()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def hit_ratio(self) -> float | None:
+        return metrics.ratio(f'{self.name}.hits', f'{self.name}.misses')
+
+class ContentVersions:
+    """Version counters for the things a rendered page is made of, kept in a
+    Redis hash so every node sees the same values. Anything that changes
+    content bumps the matching counter; caches put the counters they depend
+    on into their keys, so a bump makes old entries unreachable and no
+    explicit invalidation is needed.
+
+    The fields used are "posts:{channel_id}" (posts and chapters of a story),
+    "votes:{channel_id}", "topics:{channel_id}" and "chat:{channel_id}".
+    Chat changes too often for caching pages under its version to be worth
+    it, so the page cache leaves it out and relies on a short TTL instead;
+    the ETags in pages.py do use it, since checking one costs next to nothing.
+
+    """
+    key = 'content_versions'
+
+    async def bump(self, *fields: str) -> None:
+        async with db.redis_conn.pipeline(transaction=False) as pipe:
+            for f in fields:
+                pipe.hincrby(self.key, f, 1)
+            await pipe.execute()
+
+    async def get(self, *fields: str) -> list[int]:
+        vals = await cast(Awaitable[list[Any]],
+                          db.redis_conn.hmget(self.key, list(fields)))
+        return [int(v) if v is not None else 0 for v in vals]
+
+# global
+content_versions = ContentVersions()
+
+class PageCache:
+    """Caches whole rendered pages in Redis, shared by all nodes, for
+    anonymous readers; see pages.view_chapter for when it's used.
+
+    The only per-request parts of a page an anonymous reader gets are the CSP
+    nonce and the CSRF token. Both are random strings, so they're swapped out
+    for markers before storing the page and the current request's values are
+    put back in when serving it.
+
+    """
+    NONCE_MARKER = '__openakun_script_nonce__'
+    CSRF_MARKER = '__openakun_csrf_token__'
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.ttl = 0.0
+
+    def _key(self, key: str) -> str:
+        return f'{self.name}:{key}'
+
+    async def get(self, key: str, nonce: str, csrf: str) -> str | None:
+        if self.ttl <= 0:
+            return None
+        val = await cast(Awaitable[bytes | None],
+                         db.redis_conn.get(self._key(key)))
+        if val is None:
+            metrics.incr(f'{self.name}.misses')
+            return None
+        metrics.incr(f'{self.name}.hits')
+        return (val.decode().replace(self.NONCE_MARKER, nonce).
+                replace(self.CSRF_MARKER, csrf))
+
+    async def set(self, key: str, html: str, nonce: str, csrf: str) -> None:
+        if self.ttl <= 0:
+            return
+        val = html.replace(nonce, self.NONCE_MARKER).replace(
+            csrf, self.CSRF_MARKER)
+        await db.redis_conn.set(self._key(key), val,
+                                px=int(self.ttl * 1000))
+
+    def hit_ratio(self) -> float | None:
+        return metrics.ratio(f'{self.name}.hits', f'{self.name}.misses')
+
+# global
+page_cache = PageCache('page_cache')
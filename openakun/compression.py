@@ -0,0 +1,98 @@
+#!python3
+
+from __future__ import annotations
+
+import gzip, time
+
+from attrs import define
+from quart import Response, request
+from quart.wrappers.response import DataBody
+from werkzeug.datastructures import Accept
+
+from .metrics import metrics
+
+try:
+    import brotli  # type: ignore[import-not-found]
+except ImportError:
+    # optional; without it only gzip is used
+    brotli = None
+
+# what's worth compressing; images, fonts and the like are already compressed
+TEXT_TYPES = ('text/', 'application/json', 'application/javascript',
+              'image/svg+xml')
+
+def available_encodings() -> tuple[str, ...]:
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def choose_encoding(accepted: Accept, available: tuple[str, ...]) -> str:
+    """Picks the first of available (in order of preference) that the client
+    accepts, or 'identity'."""
+    for enc in available:
+        if accepted[enc] > 0:
+            return enc
+    return 'identity'
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    if encoding == 'br':
+        assert brotli is not None
+        return brotli.compress(data, quality=level)
+    elif encoding == 'gzip':
+        return gzip.compress(data, level, mtime=0)
+    raise ValueError(f"unknown encoding {encoding}")
+
+@define
+class ResponseCompressor:
+    """Compresses text responses (rendered pages and HTMX fragments) on the
+    way out. Responses smaller than min_size aren't worth it; streamed and
+    file responses, and anything that already has a Content-Encoding, are
+    left alone. A level of 0 turns that encoding off.
+
+    The defaults are lower than the maximum, since this runs for every
+    response; static files are compressed at the maximum ahead of time
+    instead (see assets.py).
+
+    """
+    min_size: int = 1024
+    gzip_level: int = 6
+    brotli_level: int = 4
+
+    def encodings(self) -> tuple[str, ...]:
+        return tuple(
+            e for e in available_encodings()
+            if (self.brotli_level if e == 'br' else self.gzip_level) > 0)
+
+    async def __call__(self, resp: Response) -> Response:
+        if (resp.status_code < 200 or resp.status_code in (204, 304) or
+            'Content-Encoding' in resp.headers or
+            not isinstance(resp.response, DataBody) or
+            not (resp.mimetype or '').startswith(TEXT_TYPES)):
+            return resp
+        # the response differs by encoding even when it's not compressed, so
+        # caches have to know that whether or not this one is
+        resp.vary.add('Accept-Encoding')
+        data = await resp.get_data()
+        if isinstance(data, str):
+            data = data.encode()
+        if len(data) < self.min_size:
+            return resp
+        encoding = choose_encoding(request.accept_encodings,
+                                   self.encodings())
+        if encoding == 'identity':
+            return resp
+        level = self.brotli_level if encoding == 'br' else self.gzip_level
+        start = time.perf_counter()
+        out = compress(data, encoding, level)
+        metrics.observe('compression.time', time.perf_counter() - start)
+        metrics.incr(f'compression.{encoding}')
+        metrics.incr('compression.bytes_in', len(data))
+        metrics.incr('compression.bytes_out', len(out))
+        resp.set_data(out)
+        resp.headers['Content-Encoding'] = encoding
+        # a strong validator is for exact bytes, which these aren't any more
+        etag, weak = resp.get_etag()
+        if etag is not None and not weak:
+            resp.set_etag(etag, weak=True)
+        return resp
+
+# global
+response_compressor = ResponseCompressor()
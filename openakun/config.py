@@ -26,6 +26,23 @@ class Config:
     proxy_fix: bool
     main_origin: str
     merge_dict: dict[str, Any]
+    vote_update_interval: float = 0.25
+    topic_list_interval: float = 2.0
+    vote_checkpoint_interval: float = 5.0
+    redis_snapshot_restart: bool = False
+    page_cache_ttl: float = 10.0
+    stats_enabled: bool = False
+    post_fragment_cache_size: int = 10000
+    sanitize_offload_size: int = 32768
+    sanitize_workers: int = 2
+    live_window: float = 900.0
+    fingerprint_assets: bool = True
+    compress_min_size: int = 1024
+    gzip_level: int = 6
+    brotli_level: int = 4
+    chapter_window: int = 300
+    stream_min_posts: int = 200
+    stream_batch_size: int = 50
 
     @classmethod
     def get_config(cls, fn: Path | None = None) -> Config:
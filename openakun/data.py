@@ -2,15 +2,18 @@
 
 from __future__ import annotations
 
-import secrets, bleach, json
+import asyncio, hashlib, secrets, bleach, json
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
 from attrs import define, field, asdict
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import inspect
+from sqlalchemy import inspect, select
 
 from . import models
+from .cache import LRUCache
+from .metrics import metrics
 
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Iterable, Self
 
 @define
 class ChatMessage:
@@ -244,13 +247,60 @@ class Vote:
             db_id=m.id)
 
     @classmethod
-    async def from_model_dbload(
-            cls, s: AsyncSession, vm: models.VoteInfo, uid: str | None = None
-    ) -> Vote:
-        await s.refresh(vm, ["votes"])
-        for ve in vm.votes:
-            await s.refresh(ve, ["votes"])
-        return cls.from_model(vm, uid)
+    async def load_many(
+            cls, s: AsyncSession, vote_ids: Iterable[int],
+            uid: str | None = None
+    ) -> Dict[int, Vote]:
+        """Loads the given votes from Postgres, as stored there (i.e. this
+        doesn't look at Redis state for active votes). Returns a dict keyed by
+        vote ID; IDs that don't exist are left out.
+
+        This always costs three queries (vote rows, entry rows, user vote
+        rows), however many votes and options there are. The rows are read as
+        plain tuples and never go through the ORM identity map.
+
+        """
+        ids = { int(i) for i in vote_ids }
+        if not ids:
+            return {}
+
+        vi, ve, uv = (models.VoteInfo, models.VoteEntry, models.UserVote)
+        vote_rows = (await s.execute(
+            select(vi.id, vi.vote_question, vi.multivote, vi.writein_allowed,
+                   vi.votes_hidden, vi.time_closed).
+            where(vi.id.in_(ids)))).all()
+        entry_rows = (await s.execute(
+            select(ve.id, ve.vote_id, ve.vote_text, ve.killed,
+                   ve.killed_text).
+            where(ve.vote_id.in_(ids)).
+            order_by(ve.id))).all()
+        user_rows = (await s.execute(
+            select(uv.entry_id, uv.user_id, uv.anon_id).
+            join(ve, uv.entry_id == ve.id).
+            where(ve.vote_id.in_(ids)))).all()
+
+        voters: Dict[int, list[str]] = {}
+        for entry_id, user_id, anon_id in user_rows:
+            voters.setdefault(entry_id, []).append(
+                f'user:{user_id}' if user_id else f'anon:{anon_id}')
+
+        rv = {
+            vid: cls(question=q, multivote=mv, writein_allowed=wa,
+                     votes_hidden=vh, close_time=tc, votes=[], db_id=vid)
+            for vid, q, mv, wa, vh, tc in vote_rows }
+        for eid, vid, text, killed, killed_text in entry_rows:
+            uvl = voters.get(eid, [])
+            rv[vid].votes.append(VoteEntry(
+                text=text, killed=killed, killed_text=killed_text, db_id=eid,
+                users_voted_for=uvl, vote_count=len(uvl),
+                user_voted=(uid in uvl) if uid is not None else None))
+        return rv
+
+    @classmethod
+    async def load(
+            cls, s: AsyncSession, vote_id: int, uid: str | None = None
+    ) -> Vote | None:
+        return (await cls.load_many(s, [vote_id], uid)).get(int(vote_id))
 
     def to_dict(self) -> Dict[str, Any]:
         return asdict(self)
@@ -277,12 +327,11 @@ class Vote:
         self.votes_hidden = d.get('votes_hidden', False)
         self.close_time = (datetime.fromisoformat(d['close_time'])
                            if d.get('close_time') else None)
+        entries = { i.db_id: i for i in self.votes }
         for vk, o in d['votes'].items():
-            di = int(vk)
-            for i in self.votes:
-                if i.db_id == di:
-                    i.update_redis_dict(o)
-                    break
+            e = entries.get(int(vk))
+            if e is not None:
+                e.update_redis_dict(o)
 
     def create_model(self) -> models.VoteInfo:
         """This method creates model class objects representing the vote. It
@@ -300,6 +349,42 @@ class Vote:
             vo.vote_info = rv
         return rv
 
+@define(frozen=True)
+class VoteSkeleton:
+    """The parts of a vote that don't change while it's active: the question,
+    the option texts and the story author. Everything else (config, killed
+    flags and who voted for what) lives in Redis, and is merged in by
+    to_vote().
+
+    Write-ins add options, so a skeleton may be missing some options present
+    in the Redis state; users must check covers() before trusting it.
+
+    """
+    db_id: int
+    question: str
+    author_id: int
+    entries: tuple[tuple[int, str], ...]
+
+    def covers(self, option_ids: Any) -> bool:
+        """option_ids is an iterable of option IDs as found in the Redis dict,
+        i.e. strings.
+
+        """
+        have = { str(i) for i, _ in self.entries }
+        return all(i in have for i in option_ids)
+
+    def to_vote(self, redis_dict: Dict[str, Any]) -> Vote:
+        rv = Vote(
+            question=self.question,
+            multivote=False,
+            writein_allowed=False,
+            votes_hidden=False,
+            votes=[VoteEntry(text=t, db_id=i) for i, t in self.entries],
+            db_id=self.db_id,
+            active=True)
+        rv.update_redis_dict(redis_dict)
+        return rv
+
 class BadHTMLError(ValueError):
     def __init__(
             self, *args: Any, good_html: str, bad_html: str, **kwargs: Any
@@ -312,26 +397,138 @@ class BadHTMLError(ValueError):
         return (f"BadHTMLError(good_html={repr(self.good_html)}, "
                 f"bad_html={repr(self.bad_html)})")
 
+class SanitizerPool:
+    """Cleans large HTML inputs in worker processes, so that someone pasting
+    a huge update doesn't stall every other connection on the node while
+    bleach parses it. Inputs smaller than threshold characters are cleaned
+    inline, since sending them to another process costs more than it saves.
+    The processes are only started the first time they're needed.
+
+    """
+    def __init__(self, threshold: int = 32768, max_workers: int = 2) -> None:
+        self.threshold = threshold
+        self.max_workers = max_workers
+        self.executor: ProcessPoolExecutor | None = None
+
+    async def clean(self, cls: type[HTMLText], html_data: str) -> str:
+        if self.max_workers <= 0 or len(html_data) < self.threshold:
+            return cls._clean(html_data)
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.max_workers)
+        metrics.incr('sanitizer.offloaded')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, cls._clean,
+                                          html_data)
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+sanitizer_pool = SanitizerPool()
+
+# Cleaned output keyed by (class name, hash of the input), so that the same
+# text coming through more than once (a resubmitted form, the same content
+# checked and then stored) is only parsed once. Clearing this isn't needed
+# when an allowlist changes, since that only happens with a restart. Only
+# inputs small enough to be cleaned inline are kept, so the entries can't
+# add up to more than a few MB.
+sanitized_html: LRUCache[tuple[str, str], str] = \
+    LRUCache('sanitized_html', 256)
+
+def memoizable(html_data: str) -> bool:
+    return len(html_data) < sanitizer_pool.threshold
+
 class HTMLText(object):
     allowed_tags: list[str] | None
 
+    dirty_html: str
+    _clean_html: str | None = None
+
     def __init__(self, html_data: str, allow_mismatch: bool = False) -> None:
-        self.dirty_html = html_data
-        assert self.allowed_tags is not None
-        self.clean_html = bleach.clean(html_data,
-                                       tags=self.allowed_tags,
-                                       attributes=self.allowed_attributes)
+        key = self._memo_key(html_data) if memoizable(html_data) else None
+        clean = sanitized_html.get(key) if key is not None else None
+        if clean is None:
+            clean = self._clean(html_data)
+            if key is not None:
+                sanitized_html.set(key, clean)
+        self._set_html(html_data, clean, allow_mismatch)
+
+    @classmethod
+    async def clean_async(cls, html_data: str,
+                          allow_mismatch: bool = False) -> Self:
+        """Same as the constructor, including raising BadHTMLError, but
+        large inputs are cleaned in sanitizer_pool rather than blocking the
+        event loop. Use this anywhere user input is handled in a request."""
+        key = cls._memo_key(html_data) if memoizable(html_data) else None
+        clean = sanitized_html.get(key) if key is not None else None
+        if clean is None:
+            clean = await sanitizer_pool.clean(cls, html_data)
+            if key is not None:
+                sanitized_html.set(key, clean)
+        rv = cls.__new__(cls)
+        rv._set_html(html_data, clean, allow_mismatch)
+        return rv
+
+    @property
+    def clean_html(self) -> str:
+        if self._clean_html is None:
+            # unverified() text, cleaned the first time it's used
+            self._clean_html = type(self)(
+                self.dirty_html, allow_mismatch=True).clean_html
+        return self._clean_html
+
+    @clean_html.setter
+    def clean_html(self, value: str) -> None:
+        self._clean_html = value
+
+    def _set_html(self, dirty: str, clean: str, allow_mismatch: bool) -> None:
+        self.dirty_html = dirty
+        self.clean_html = clean
         if self.clean_html != self.dirty_html and not allow_mismatch:
             raise BadHTMLError(bad_html=self.dirty_html,
                                good_html=self.clean_html)
 
+    @classmethod
+    def _memo_key(cls, html_data: str) -> tuple[str, str]:
+        return (cls.__name__,
+                hashlib.sha256(html_data.encode('utf-8')).hexdigest())
+
+    @classmethod
+    def _clean(cls, html_data: str) -> str:
+        # this runs in the worker processes too, so it (and
+        # allowed_attributes) can only depend on things that pickle by name
+        assert cls.allowed_tags is not None
+        return bleach.clean(html_data, tags=cls.allowed_tags,
+                            attributes=cls.allowed_attributes)
+
+    @classmethod
+    def trusted(cls, html_data: str) -> Self:
+        """Wraps HTML that's known to be clean already (i.e. it was cleaned
+        with the current allowlist before being stored) without parsing it
+        again."""
+        rv = cls.__new__(cls)
+        rv.dirty_html = rv.clean_html = html_data
+        return rv
+
+    @classmethod
+    def unverified(cls, html_data: str) -> Self:
+        """Wraps stored HTML that may have been cleaned with an older
+        allowlist. It's cleaned (stripping anything disallowed, rather than
+        raising) when clean_html is first used, unless it's found to be
+        current first."""
+        rv = cls.__new__(cls)
+        rv.dirty_html = html_data
+        return rv
+
     @classmethod
     def from_user_input(cls, html_data: str):
         """for any special processing necessary for the from-user-input HTML;
         in this class, equivalent to just calling init"""
         return cls(html_data)
 
-    def allowed_attributes(self, tag: str, name: str, value: str) -> bool:
+    @staticmethod
+    def allowed_attributes(tag: str, name: str, value: str) -> bool:
         raise NotImplementedError()
 
     def output_html(self) -> str:
@@ -348,8 +545,23 @@ class HTMLText(object):
 class PostHTMLText(HTMLText):
     allowed_tags = ['a', 'b', 'br', 'em', 'i', 'li', 'ol', 'p', 's', 'strong',
                     'strike', 'ul', 'u']
+    # Posts are stored with the version of the allowlist they were cleaned
+    # with, and only cleaned again on load if that's out of date. This must
+    # be bumped whenever allowed_tags or allowed_attributes changes; the
+    # resanitize worker then brings the stored posts up to date.
+    sanitizer_version = 1
 
-    def allowed_attributes(self, tag: str, name: str, value: str) -> bool:
+    @classmethod
+    def from_stored(cls, html_data: str,
+                    sanitizer_version: int | None) -> PostHTMLText:
+        if sanitizer_version == cls.sanitizer_version:
+            return cls.trusted(html_data)
+        # stored content that doesn't pass the current allowlist gets the
+        # disallowed parts stripped rather than raising
+        return cls(html_data, allow_mismatch=True)
+
+    @staticmethod
+    def allowed_attributes(tag: str, name: str, value: str) -> bool:
         if tag == 'a':
             if name == 'data-achieve': return True
             if name == 'class' and value == 'achieve-link': return True
@@ -361,10 +573,13 @@ def clean_html(html_in: str) -> str:
         raise BadHTMLError(good_html=html.clean_html, bad_html=html.dirty_html)
     return html.clean_html
 
+async def clean_html_async(html_in: str) -> str:
+    return (await PostHTMLText.clean_async(html_in)).clean_html
+
 @define
 class Post:
     text: PostHTMLText | None = field(
-        converter=lambda x: (x if isinstance(x, PostHTMLText)
+        converter=lambda x: (x if x is None or isinstance(x, PostHTMLText)
                              else PostHTMLText(x)))
     post_type: models.PostType
     posted_date: datetime = field(
@@ -1,12 +1,13 @@
 from . import models
 
-import secrets, re, sqlalchemy, importlib.resources, hashlib
+import secrets, re, sqlalchemy, importlib.resources, hashlib, functools
+from pathlib import Path
 import redis.asyncio as redis
 import redis.asyncio.client as asyncio_client
 from quart import session, request, abort, g, current_app, url_for
 from quart import websocket as ws
 from functools import wraps
-from base64 import b64encode
+from base64 import b64encode, urlsafe_b64encode, urlsafe_b64decode
 from werkzeug import Response
 from sentry_sdk import push_scope, capture_message
 from .login import LoginManager
@@ -85,6 +86,28 @@ async def db_close(r: Response) -> Response:
 def make_csrf(force: bool = False) -> None:
     if force or '_csrf_token' not in session:
         session['_csrf_token'] = secrets.token_urlsafe()
+        g.pop('csrf_token', None)
+
+def csrf_token() -> str:
+    """The CSRF token to put in this response's forms: the session's token
+    XORed with a random pad, followed by the pad. It's different in every
+    response, so that compressed pages which also carry attacker-controlled
+    text (chat messages, posts) can't be used to recover it a byte at a time
+    (BREACH). csrf_check() takes it off again."""
+    if not hasattr(g, 'csrf_token'):
+        tok = session['_csrf_token'].encode()
+        pad = secrets.token_bytes(len(tok))
+        g.csrf_token = urlsafe_b64encode(
+            bytes(a ^ b for a, b in zip(tok, pad)) + pad).decode()
+    return g.csrf_token
+
+def unmask_csrf_token(masked: str) -> bytes:
+    try:
+        raw = urlsafe_b64decode(masked.encode())
+    except ValueError:
+        return b''
+    n = len(raw) // 2
+    return bytes(a ^ b for a, b in zip(raw[:n], raw[n:]))
 
 def csrf_check(view: Callable) -> Callable:
     @wraps(view)
@@ -94,12 +117,30 @@ def csrf_check(view: Callable) -> Callable:
             tok = (data.get('_csrf_token', '') if data else
                    (await request.form).get('_csrf_token', ''))
             # constant-time compare operation
-            if not secrets.compare_digest(tok,
-                                          session['_csrf_token']):
+            if not secrets.compare_digest(
+                    unmask_csrf_token(tok), session['_csrf_token'].encode()):
                 abort(400)
         return await view(*args, **kwargs)
     return csrf_wrapper
 
+# what a deploy changes that affects what's rendered
+BUILD_SUFFIXES = ('.py', '.html', '.js', '.css', '.lua')
+
+@functools.cache
+def build_version() -> str:
+    """A hash of the package's code, templates and static files. It changes
+    with any deploy that changes those, and is the same on every node
+    running the same code; ETags include it, so that responses browsers
+    kept from before a deploy aren't revalidated as current after it."""
+    root = Path(__file__).parent
+    h = hashlib.blake2b(digest_size=8)
+    for f in sorted(root.rglob('*')):
+        if (f.suffix in BUILD_SUFFIXES and f.is_file() and
+            '__pycache__' not in f.parts):
+            h.update(f.relative_to(root).as_posix().encode())
+            h.update(f.read_bytes())
+    return h.hexdigest()
+
 def get_script_nonce() -> str:
     if not hasattr(g, 'script_nonce'):
         # this has to be real base64, per the spec, not urlencoded; thus
@@ -108,6 +149,10 @@ def get_script_nonce() -> str:
     return g.script_nonce
 
 def add_csp(resp: Response) -> Response:
+    # A 304's headers replace the ones the browser stored with the page, so
+    # this has to leave the CSP out, or its nonce won't match the page's.
+    if resp.status_code == 304:
+        return resp
     nv = get_script_nonce()
     report_only = current_app.config['csp_report_only']
     header_name = ('Content-Security-Policy-Report-Only' if report_only else
@@ -120,7 +165,9 @@ def add_csp(resp: Response) -> Response:
     return resp
 
 def add_htmx_vary(resp: Response) -> Response:
-    resp.headers['Vary'] = 'HX-Request, HX-History-Restore-Request'
+    # added to rather than replaced, since some responses (static files) vary
+    # on other things too
+    resp.vary.update(['HX-Request', 'HX-History-Restore-Request'])
     return resp
 
 def csp_report() -> str:
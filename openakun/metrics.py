@@ -0,0 +1,62 @@
+#!python3
+
+from __future__ import annotations
+
+from attrs import define
+
+from typing import Any
+
+# Process-local counters and timings. These are used to report on the
+# behavior of the caches and update schedulers; they're per-node, and nothing
+# here is shared through Redis.
+
+@define
+class Timing:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def observe(self, secs: float) -> None:
+        self.count += 1
+        self.total += secs
+        self.max = max(self.max, secs)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'count': self.count,
+            'mean': (self.total / self.count) if self.count else None,
+            'max': self.max,
+        }
+
+class Metrics:
+    def __init__(self) -> None:
+        self.counters: dict[str, int] = {}
+        self.timings: dict[str, Timing] = {}
+
+    def incr(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def get(self, name: str) -> int:
+        return self.counters.get(name, 0)
+
+    def observe(self, name: str, secs: float) -> None:
+        self.timings.setdefault(name, Timing()).observe(secs)
+
+    def ratio(self, hits: str, misses: str) -> float | None:
+        """Returns hits / (hits + misses) for the two named counters, or None
+        if neither has been counted yet.
+
+        """
+        h, m = self.get(hits), self.get(misses)
+        if h + m == 0:
+            return None
+        return h / (h + m)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            'counters': dict(self.counters),
+            'timings': { k: v.to_dict() for k, v in self.timings.items() },
+        }
+
+# global
+metrics = Metrics()
@@ -5,10 +5,11 @@ from __future__ import annotations
 
 from sqlalchemy import (Column, Integer, ForeignKey, DateTime, MetaData,
                         CheckConstraint, UniqueConstraint, Index, Table)
-from sqlalchemy import func, text
+from sqlalchemy import text, event, inspect, update, Update, FetchedValue
 from sqlalchemy.orm import (relationship, DeclarativeBase, Mapped,
-                            mapped_column)
-from sqlalchemy.sql import select
+                            mapped_column, InstrumentedAttribute,
+                            object_session)
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.asyncio import \
     (AsyncAttrs, async_sessionmaker, AsyncSession, create_async_engine,
      AsyncEngine)
@@ -19,7 +20,10 @@ from . import data
 
 import os, enum
 
-from typing import Any
+from typing import Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from markupsafe import Markup
 
 # for Alembic
 naming = {
@@ -97,6 +101,9 @@ class Story(Base):
     description: Mapped[str]
     author_id: Mapped[int] = mapped_column(ForeignKey('users.id'))
     channel_id: Mapped[int] = mapped_column(ForeignKey('channels.id'))
+    # the order_idx the next chapter gets; see allocate_idx()
+    next_chapter_idx: Mapped[int] = mapped_column(default=0,
+                                                  server_default='0')
 
     author: Mapped[User] = relationship(back_populates="stories")
     channel: Mapped[Channel] = relationship(uselist=False)
@@ -116,6 +123,30 @@ class Story(Base):
         return "<Story '{}' (id {}) by {}>".format(self.title, self.id,
                                                    self.author.name)
 
+# Chapters in a story, and posts in a chapter, are ordered by order_idx. New
+# ones that aren't given an index are numbered from a counter on the parent
+# row, bumped with UPDATE ... RETURNING: the row lock means concurrent inserts
+# get different indices, and the existing rows never need to be looked at.
+# Indices are ORDER_IDX_GAP apart, to leave room for putting things between
+# them later (see pages.post_idx_after).
+ORDER_IDX_GAP = 10
+
+def allocate_idx(counter: InstrumentedAttribute[int],
+                 parent_id: int) -> Update:
+    """Returns the statement that takes the next index from counter (a column
+    of the parent model) on the row with ID parent_id."""
+    parent = counter.class_
+    return (update(parent).
+            where(parent.id == parent_id).
+            values({ counter: counter + ORDER_IDX_GAP }).
+            returning(counter))
+
+def chapter_idx_default(context: Any) -> int:
+    sid = context.get_current_parameters()['story_id']
+    return context.connection.execute(
+        allocate_idx(Story.next_chapter_idx, sid)
+    ).scalar_one() - ORDER_IDX_GAP
+
 class Chapter(Base):
     __tablename__ = 'chapters'
 
@@ -123,7 +154,9 @@ class Chapter(Base):
     title: Mapped[str]
     story_id: Mapped[int] = mapped_column(ForeignKey('stories.id'))
     is_appendix: Mapped[bool] = mapped_column(default=False)
-    order_idx: Mapped[int]
+    order_idx: Mapped[int] = mapped_column(default=chapter_idx_default)
+    # the order_idx the next post gets
+    next_post_idx: Mapped[int] = mapped_column(default=0, server_default='0')
 
     story: Mapped[Story] = relationship(back_populates='chapters')
     posts: Mapped[list[Post]] = relationship(back_populates='chapter')
@@ -140,12 +173,9 @@ class PostType(enum.Enum):
 
 def order_idx_default(context: Any) -> int:
     cid = context.get_current_parameters()['chapter_id']
-    rv = context.connection.execute(select(
-        func.coalesce(
-            func.max(Post.order_idx) + 10,
-            0)).where(Post.chapter_id == cid))
-    rows = rv.fetchall()
-    return rows[0][0]
+    return context.connection.execute(
+        allocate_idx(Chapter.next_post_idx, cid)
+    ).scalar_one() - ORDER_IDX_GAP
 
 class HTMLPostString(types.TypeDecorator):
     impl = types.String
@@ -160,11 +190,22 @@ class HTMLPostString(types.TypeDecorator):
     def process_result_value(
             self, value: str | None, dialect
     ) -> data.PostHTMLText | None:
+        # the text was cleaned before it was stored, but maybe with an older
+        # allowlist, which the column alone doesn't say; the Post load events
+        # below trust it if the row's sanitizer_version is current, and
+        # otherwise (including for column selects, which only get the
+        # sanitizer_version if they ask for it) it's cleaned again when used
         if value is None: return None
-        return data.PostHTMLText(value)
+        return data.PostHTMLText.unverified(value)
+
+def current_sanitizer_version() -> int:
+    return data.PostHTMLText.sanitizer_version
 
 class Post(Base):
     __tablename__ = 'posts'
+    __table_args__ = (
+        Index('post_order_idx', 'chapter_id', 'order_idx'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     text: Mapped[data.PostHTMLText | None] = mapped_column(HTMLPostString)
@@ -173,6 +214,13 @@ class Post(Base):
     chapter_id: Mapped[int] = mapped_column(ForeignKey('chapters.id'))
     order_idx: Mapped[int] = mapped_column(default=order_idx_default)
     post_type: Mapped[PostType] = mapped_column(default=PostType.Text)
+    # bumped by every ORM UPDATE of the row (see bump_post_version), so
+    # anything rendered from a post can be cached under (id, version)
+    version: Mapped[int] = mapped_column(server_default='1',
+                                         server_onupdate=FetchedValue())
+    # the PostHTMLText.sanitizer_version the text was cleaned with
+    sanitizer_version: Mapped[int] = mapped_column(
+        default=current_sanitizer_version, server_default='0')
     # null unless type is Vote
     # vote_id = Column(Integer, ForeignKey('vote_info.id'))
 
@@ -181,6 +229,47 @@ class Post(Base):
     vote_info: Mapped[VoteInfo] = relationship(uselist=False,
                                                back_populates="post")
 
+    # so the bumped version comes back with RETURNING, rather than being
+    # expired (and lazy loaded, which can't be done under asyncio)
+    __mapper_args__ = {'eager_defaults': True}
+
+    if TYPE_CHECKING:
+        # not a column: the rendered post body, set on posts about to be
+        # rendered by pages.render_post_fragments()
+        fragment: Markup
+
+@event.listens_for(Post, 'load')
+def clean_outdated_post(target: Post, context: Any) -> None:
+    unloaded = inspect(target).unloaded
+    if ('text' not in unloaded and 'sanitizer_version' not in unloaded and
+        target.text is not None):
+        set_committed_value(target, 'text', data.PostHTMLText.from_stored(
+            target.text.dirty_html, target.sanitizer_version))
+
+@event.listens_for(Post, 'refresh')
+def clean_refreshed_post(target: Post, context: Any,
+                         attrs: Any) -> None:
+    # deferred and expired attributes loaded later
+    if attrs is None or 'text' in attrs:
+        clean_outdated_post(target, context)
+
+@event.listens_for(Post, 'before_update')
+def bump_post_version(mapper: Any, connection: Any, target: Post) -> None:
+    # done in the UPDATE itself, so concurrent updates each get their own
+    # version; this isn't optimistic locking (version_id_col), which would
+    # make whichever one came second raise StaleDataError
+    session = object_session(target)
+    if session is None or session.is_modified(target,
+                                              include_collections=False):
+        # a SQL expression, rendered into the UPDATE
+        target.version = Post.version + 1  # type: ignore[assignment]
+
+@event.listens_for(Post.text, 'set')
+def mark_post_sanitized(target: Post, value: Any, oldvalue: Any,
+                        initiator: Any) -> None:
+    # new text is always cleaned by the current allowlist on its way in
+    target.sanitizer_version = data.PostHTMLText.sanitizer_version
+
 class VoteInfo(Base):
     __tablename__ = 'vote_info'
 
@@ -308,6 +397,9 @@ class AddressIdentifier(Base):
 
 class Topic(Base):
     __tablename__ = 'topics'
+    __table_args__ = (
+        Index('topic_story_activity_idx', 'story_id', 'last_post_date'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     title: Mapped[str]
@@ -317,6 +409,12 @@ class Topic(Base):
     # if null, it's a "front page" topic accessible from the homepage
     story_id: Mapped[int | None] = mapped_column(ForeignKey('stories.id'))
 
+    # Kept up to date when messages are added (see pages.new_topic_post), so
+    # the topic list doesn't have to look at the messages at all.
+    message_count: Mapped[int] = mapped_column(default=0, server_default='0')
+    last_post_date: Mapped[datetime | None] = mapped_column(
+        DateTime(timezone=True))
+
     story: Mapped[Story | None] = relationship(back_populates="topics")
     poster: Mapped[User] = relationship()
 
@@ -1,11 +1,16 @@
 #!python
 
 from . import models, realtime, websocket
-from .data import Vote, clean_html, BadHTMLError, PostHTMLText, Post
-from .general import csrf_check, make_csrf, login_mgr, db_connect
+from .data import Vote, clean_html_async, BadHTMLError, PostHTMLText, Post
+from .general import (csrf_check, make_csrf, login_mgr, db_connect, db,
+                      get_script_nonce, build_version, csrf_token)
+from .cache import LRUCache, content_versions, page_cache
+from .activity import story_activity
+from .metrics import metrics
 
 from quart import (render_template, request, redirect, url_for, flash, abort,
-                   jsonify, session, current_app, Blueprint, make_response, g)
+                   jsonify, session, current_app, Blueprint, make_response, g,
+                   stream_with_context)
 from .login import login_user, logout_user, login_required
 from flask_htmx import HTMX
 from quart import Response as QuartResponse
@@ -13,14 +18,20 @@ from werkzeug import Response as WerkzeugResponse
 from sentry_sdk import push_scope, capture_message, capture_exception
 from jinja2_fragments.quart import render_block
 from sqlalchemy.sql.expression import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy import inspect, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload, joinedload, defer
+from sqlalchemy.orm.attributes import set_committed_value
+from markupsafe import Markup
 
-import itsdangerous, json, asyncio
+import itsdangerous, json, asyncio, hashlib, time
+from urllib.parse import urlsplit
 from passlib.context import CryptContext
 
 from datetime import datetime, timezone
 
-from typing import Optional
+from typing import (Optional, Sequence, Awaitable, Callable, Any, cast,
+                    AsyncIterator)
 
 ResponseType = str | QuartResponse | WerkzeugResponse
 
@@ -45,14 +56,48 @@ async def load_user(user_id: int | str) -> models.User | None:
 def get_signer() -> itsdangerous.TimestampSigner:
     return itsdangerous.TimestampSigner(current_app.config['SECRET_KEY'])
 
+STORIES_PER_PAGE = 10
+LIVE_STORIES = 5
+
 @questing.route('/')
 async def main() -> ResponseType:
-    s = db_connect()
-    stories = (await s.scalars(
-        select(models.Story).
-        options(selectinload(models.Story.author)).
-        limit(10))).all()
-    return await render_template("main.html", stories=stories)
+    # stories are listed by latest activity, with the position in the
+    # activity index of the last story on the previous page as the cursor
+    before = None
+    if 'before' in request.args:
+        try:
+            ms, cid = request.args['before'].split('-')
+            before = (int(ms), int(cid))
+        except ValueError:
+            abort(400)
+    live = []
+    if before is None:
+        live = await story_activity.live(
+            current_app.config['data_obj'].live_window, LIVE_STORIES)
+        # the live stories are the most recently active ones, so the first
+        # page carries on from after them rather than listing them again
+        if live:
+            last_cid, last_ms = live[-1]
+            before = (last_ms, last_cid)
+    page = await story_activity.page(STORIES_PER_PAGE, before)
+
+    by_channel: dict[int, models.Story] = {}
+    wanted = { cid for cid, _ in page + live }
+    if wanted:
+        s = db_connect()
+        by_channel = { st.channel_id: st for st in (await s.scalars(
+            select(models.Story).
+            options(selectinload(models.Story.author)).
+            filter(models.Story.channel_id.in_(wanted)))).all() }
+    stories = [by_channel[cid] for cid, _ in page if cid in by_channel]
+    live_stories = [by_channel[cid] for cid, _ in live if cid in by_channel]
+    next_page = None
+    if len(page) == STORIES_PER_PAGE:
+        last_cid, last_ms = page[-1]
+        next_page = url_for('questing.main', before=f'{last_ms}-{last_cid}')
+    return await render_template("main.html", stories=stories,
+                                 live_stories=live_stories,
+                                 next_page=next_page)
 
 @questing.route('/login', methods=['GET', 'POST'])
 @csrf_check
@@ -128,9 +173,9 @@ async def register() -> ResponseType:
         return await render_template("signup.html")
 
 async def add_story(title: str, desc: str, author: models.User) -> models.Story:
-    desc_clean = clean_html(desc)
+    desc_clean = await clean_html_async(desc)
     ns = models.Story(title=title, description=desc_clean, author=author)
-    nc = models.Chapter(order_idx=0, story=ns, title='Chapter 1')
+    nc = models.Chapter(story=ns, title='Chapter 1')
     chan = models.Channel()
     ns.channel = chan
     s = db_connect()
@@ -138,6 +183,7 @@ async def add_story(title: str, desc: str, author: models.User) -> models.Story:
     s.add(nc)
     s.add(chan)
     await s.commit()
+    await story_activity.touch(ns.channel_id)
     return ns
 
 @questing.route('/new_story', methods=['GET', 'POST'])
@@ -173,42 +219,87 @@ async def view_story(story_id: int) -> ResponseType:
 async def prepare_post(p: models.Post, user_votes: bool = False) -> None:
     if getattr(p, 'prepared', False):
         return
-    p.prepared = True
-    p.rendered_date = (p.posted_date.astimezone(timezone.utc).
-                       strftime("%b %d, %Y %I:%M %p UTC"))
-    p.date_millis = (p.posted_date.timestamp() * 1000)
+    prepare_post_dates(p)
     if p.post_type == models.PostType.Vote:
         channel_id = p.story.channel_id
         p.vote = await full_vote_info(
             channel_id, await p.awaitable_attrs.vote_info, user_votes)
 
+def prepare_post_dates(p: models.Post) -> None:
+    p.prepared = True
+    p.rendered_date = (p.posted_date.astimezone(timezone.utc).
+                       strftime("%b %d, %Y %I:%M %p UTC"))
+    p.date_millis = (p.posted_date.timestamp() * 1000)
+
+async def prepare_posts(posts: Sequence[models.Post], channel_id: int,
+                        user_votes: bool = False, uid: str | None = None,
+                        s: AsyncSession | None = None) -> None:
+    """Does prepare_post() for a whole chapter's worth of posts at once. The
+    posts must have vote_info already loaded (e.g. with selectinload). Active
+    votes come from one Redis pipeline plus the skeleton cache, and closed
+    ones from Vote.load_many(), so this takes a fixed number of queries
+    however many vote posts there are.
+
+    With user_votes, the votes of the user with identifier uid (by default
+    the current one) are marked. s is the session to use instead of the
+    request's.
+
+    """
+    vote_posts = []
+    for p in posts:
+        if getattr(p, 'prepared', False):
+            continue
+        prepare_post_dates(p)
+        if p.post_type == models.PostType.Vote and p.vote_info is not None:
+            vote_posts.append(p)
+    if not vote_posts:
+        return
+
+    if not user_votes:
+        uid = None
+    elif uid is None:
+        uid = await realtime.get_user_identifier()
+    vids = [p.vote_info.id for p in vote_posts]
+    if s is None:
+        s = db_connect()
+    votes = await realtime.load_active_votes(channel_id, vids, uid, s)
+    closed = await Vote.load_many(s, [i for i in vids if i not in votes], uid)
+    for v in closed.values():
+        v.active = False
+    votes.update(closed)
+    for p in vote_posts:
+        p.vote = votes[p.vote_info.id]
+
 async def full_vote_info(channel_id: int, vm: models.VoteInfo,
                          user_votes: bool = False) -> Vote:
+    # active votes are built from the cached skeleton plus Redis, without
+    # touching Postgres
+    av = await realtime.load_active_vote(channel_id, vm.id)
+    if av is not None:
+        v = av[0]
+        if user_votes:
+            uv = await realtime.get_user_votes(vm.id)
+            for o in v.votes:
+                o.user_voted = o.db_id in uv
+        return v
     uid = (await realtime.get_user_identifier()) if user_votes else None
     s = db_connect()
-    v = await Vote.from_model_dbload(s, vm, uid)
-    await realtime.populate_vote(channel_id, v)
-    if user_votes and v.active:
-        uv = await realtime.get_user_votes(vm.id)
-        for o in v.votes:
-            o.user_voted = o.db_id in uv
-    return v
-
-async def get_topics(story_id: int) -> list[models.Topic]:
-    msgs = select(
-        models.TopicMessage.topic_id,
-        models.func.count(models.TopicMessage.id).label('num_msgs'),
-        models.func.max(models.TopicMessage.post_date).label('latest_post')
-    ).group_by(models.TopicMessage.topic_id).subquery()
-    s = db_connect()
+    closed = await Vote.load(s, vm.id, uid)
+    assert closed is not None
+    closed.active = False
+    return closed
+
+async def get_topics(story_id: int,
+                     s: AsyncSession | None = None) -> list[models.Topic]:
+    # this only needs the topics themselves; the counts and dates shown are
+    # kept on the topic rows
+    if s is None:
+        s = db_connect()
     topics = (await s.scalars(
         select(models.Topic).
-        options(
-            selectinload(models.Topic.poster),
-            selectinload(models.Topic.messages)).
-        outerjoin(msgs, models.Topic.id == msgs.c.topic_id).
+        options(selectinload(models.Topic.poster)).
         filter(models.Topic.story_id == story_id).
-        order_by(msgs.c.latest_post.desc(),
+        order_by(models.Topic.last_post_date.desc(),
                  models.Topic.post_date.desc()))).all()
     return list(topics)
 
@@ -222,35 +313,432 @@ def make_page_list_data(page_list: list[tuple[int, int, datetime]], current_page
          for (n, i, d) in page_list]
     return {"pages": d, "current_page": current_page}
 
+# Rendered post_body.html for text posts, keyed by (post ID, post version,
+# variant). Vote posts change with the vote state and aren't cached here.
+post_fragments: LRUCache[tuple[int, int, str], Markup] = LRUCache(
+    'post_fragments', 10000)
+
+async def render_post_fragments(posts: Sequence[models.Post], variant: str,
+                                s: AsyncSession | None = None) -> None:
+    """Sets p.fragment on the text posts among posts, which render_post.html
+    uses in place of rendering the post body itself. variant is 'author' or
+    'reader'. The posts must already be prepared.
+
+    Posts can be loaded with their text deferred, in which case it's only
+    loaded (in one query, with s or the request's session) for the posts
+    that aren't cached.
+
+    """
+    misses = []
+    for p in posts:
+        if p.post_type != models.PostType.Text:
+            continue
+        frag = post_fragments.get((p.id, p.version, variant))
+        if frag is None:
+            misses.append(p)
+        else:
+            p.fragment = frag
+    if not misses:
+        return
+
+    unloaded = [p for p in misses if 'text' in inspect(p).unloaded]
+    if unloaded:
+        if s is None:
+            s = db_connect()
+        rows = (await s.execute(
+            select(models.Post.id, models.Post.text,
+                   models.Post.sanitizer_version).
+            filter(models.Post.id.in_([p.id for p in unloaded])))).all()
+        texts = { pid: (PostHTMLText.from_stored(t.dirty_html, sv)
+                        if t is not None else None)
+                  for pid, t, sv in rows }
+        for p in unloaded:
+            set_committed_value(p, 'text', texts.get(p.id))
+    for p in misses:
+        frag = Markup(await render_template('post_body.html', p=p))
+        post_fragments.set((p.id, p.version, variant), frag)
+        p.fragment = frag
+
+# a story's channel never changes, so this needs no invalidation
+story_channels: LRUCache[int, int] = LRUCache('story_channels', 4096)
+
+async def get_story_channel(story_id: int) -> int | None:
+    cid = story_channels.get(story_id)
+    if cid is None:
+        s = db_connect()
+        cid = (await s.scalars(
+            select(models.Story.channel_id).
+            filter(models.Story.id == story_id))).one_or_none()
+        if cid is not None:
+            story_channels.set(story_id, cid)
+    return cid
+
+async def chapter_cache_key(story_id: int, chapter_id: int,
+                            partial: bool = False) -> str | None:
+    """Returns the page cache key for the current request's view of a chapter,
+    or None if it can't be served from the cache. Only anonymous readers who
+    haven't voted see a page that's the same for everyone (with the same
+    theme); the key includes the theme and the content versions of
+    everything on the page, except chat, which is left to the cache TTL.
+
+    """
+    if (page_cache.ttl <= 0 or g.current_user is not None or request.args
+        or session.get('_flashes')):
+        return None
+    channel_id = await get_story_channel(story_id)
+    if channel_id is None:
+        return None
+    # anonymous readers who've voted see their own votes marked
+    uid = await realtime.get_user_identifier()
+    if await cast(Awaitable[int],
+                  db.redis_conn.sismember('anon_voters', uid)):
+        return None
+    versions = await content_versions.get(
+        f'posts:{channel_id}', f'votes:{channel_id}',
+        f'topics:{channel_id}')
+    variant = 'partial' if partial else 'htmx' if htmx else 'full'
+    # anonymous readers can still pick a theme, which the page is rendered in
+    theme = 'dark' if get_dark_mode() else 'light'
+    return (f"chapter:{story_id}:{chapter_id}:{variant}:{theme}:" +
+            '.'.join(str(v) for v in versions))
+
+async def page_etag(*parts: Any) -> str:
+    """Makes an ETag for a response built from parts, which should be the
+    content versions (read before rendering) of everything in it. It also
+    covers what every page varies on: the code and templates it was rendered
+    by, the user, their theme and CSRF token, and whether it's an HTMX
+    request."""
+    base = (build_version(), await realtime.get_user_identifier(),
+            get_dark_mode(), session.get('_csrf_token', ''),
+            request.headers.get('HX-Request', ''),
+            request.headers.get('HX-History-Restore-Request', ''))
+    return hashlib.blake2b(repr((base, parts)).encode(),
+                           digest_size=16).hexdigest()
+
+async def conditional_response(
+        etag: str | None, render: Callable[[], Awaitable[ResponseType]]
+) -> ResponseType:
+    """Returns a 304 without calling render if the client already has the
+    version of the response with this ETag, and otherwise renders it and
+    tags it. The ETags are weak, since the CSP nonce in the body changes on
+    every response. Pass None as the ETag to always render.
+
+    """
+    # flashed messages are shown once, so must always be rendered
+    if etag is None or session.get('_flashes'):
+        return await render()
+    resp: QuartResponse | WerkzeugResponse
+    if request.if_none_match.contains_weak(etag):
+        metrics.incr('etag.not_modified')
+        resp = QuartResponse('', status=304)
+    else:
+        metrics.incr('etag.rendered')
+        resp = await make_response(await render())
+    resp.set_etag(etag, weak=True)
+    # these are personal, so only the browser can keep them, and it has to
+    # check back each time
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+def chapter_nav_partial(story_id: int) -> bool:
+    """Whether this request is HTMX navigation from another chapter of the
+    same story (the chapter menu and next chapter links), which only swaps
+    in #content-container. The chat, topic list and websocket around it
+    stay as they are, so they needn't be rendered.
+
+    """
+    if (not htmx or htmx.history_restore_request or
+        htmx.target != 'content-container'):
+        return False
+    parts = urlsplit(htmx.current_url or '').path.split('/')
+    # /story/<story_id>/<chapter_id>, and anything else under the story
+    return (len(parts) > 3 and parts[1] == 'story' and
+            parts[2].isdigit() and int(parts[2]) == story_id)
+
 @questing.route('/story/<int:story_id>/<int:chapter_id>')
-async def view_chapter(story_id: int, chapter_id: int) -> str:
+async def view_chapter(story_id: int, chapter_id: int) -> ResponseType:
+    partial = chapter_nav_partial(story_id)
+    etag = None
+    channel_id = await get_story_channel(story_id)
+    if channel_id is not None:
+        fields = [f'posts:{channel_id}', f'votes:{channel_id}']
+        if not partial:
+            fields += [f'topics:{channel_id}', f'chat:{channel_id}']
+        etag = await page_etag(
+            'chapter', story_id, chapter_id, partial,
+            sorted(request.args.items()),
+            *await content_versions.get(*fields))
+    return await conditional_response(
+        etag, lambda: cached_chapter(story_id, chapter_id, partial))
+
+async def cached_chapter(story_id: int, chapter_id: int,
+                         partial: bool = False) -> ResponseType:
+    cache_key = await chapter_cache_key(story_id, chapter_id, partial)
+    if cache_key is None:
+        return await render_chapter(story_id, chapter_id, partial,
+                                    allow_stream=True)
+    nonce = get_script_nonce()
+    csrf = csrf_token()
+    html = await page_cache.get(cache_key, nonce, csrf)
+    if html is None:
+        # the cache needs the whole page as a string, so this is never
+        # streamed
+        html = cast(str, await render_chapter(story_id, chapter_id, partial))
+        await page_cache.set(cache_key, html, nonce, csrf)
+    return html
+
+async def prepared_batches(
+        posts: Sequence[models.Post], channel_id: int, variant: str,
+        batch_size: int, uid: str, s: AsyncSession
+) -> AsyncIterator[models.Post]:
+    """Yields posts, doing prepare_posts() and render_post_fragments() on
+    them batch_size at a time, just before the first of each batch is needed.
+    Used as the posts of a streamed chapter page, so that the earlier posts
+    are sent while the later ones (and their votes) are still to be
+    prepared. This runs after the view has returned, so the user identifier
+    uid and session s are passed in rather than taken from the request.
+
+    """
+    for i in range(0, len(posts), batch_size):
+        batch = posts[i:i + batch_size]
+        await prepare_posts(batch, channel_id, user_votes=True, uid=uid, s=s)
+        await render_post_fragments(batch, variant, s)
+        for p in batch:
+            yield p
+
+# Jinja yields a streamed template's output in many small pieces; they're
+# collected into pieces of at least this size before being sent.
+STREAM_CHUNK_SIZE = 4096
+
+async def timed_stream(chunks: AsyncIterator[str],
+                       start: float) -> AsyncIterator[bytes]:
+    """Sends on a streamed chapter page in pieces of STREAM_CHUNK_SIZE,
+    recording the time from start to the first piece (time to first byte)
+    and to the end."""
+    buf: list[str] = []
+    size = 0
+    sent = False
+    async for c in chunks:
+        buf.append(c)
+        size += len(c)
+        if size >= STREAM_CHUNK_SIZE:
+            if not sent:
+                metrics.observe('chapter.stream.ttfb',
+                                time.perf_counter() - start)
+                sent = True
+            yield ''.join(buf).encode()
+            buf, size = [], 0
+    if not sent:
+        metrics.observe('chapter.stream.ttfb', time.perf_counter() - start)
+    yield ''.join(buf).encode()
+    metrics.observe('chapter.stream.total', time.perf_counter() - start)
+
+async def stream_chapter_template(
+        context: dict[str, Any], s: AsyncSession) -> AsyncIterator[str]:
+    """Renders view_chapter.html as a stream, after the view has returned.
+
+    The stream runs in a request context of its own, pushed by
+    stream_with_context(), whose g starts out empty; it gets the request's
+    g state (the user, the CSP nonce the headers went out with) and the
+    session s, which the caller has to have taken off the request's g, so
+    that the request's teardown doesn't close it. The stream's teardown
+    closes it once the page has been sent.
+
+    """
+    await current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template("view_chapter.html")
+    g_state = dict(vars(g._get_current_object()))
+
+    @stream_with_context
+    async def generate() -> AsyncIterator[str]:
+        vars(g._get_current_object()).update(g_state, db_session=s)
+        async for chunk in template.generate_async(context):
+            yield chunk
+
+    return generate()
+
+async def get_chapter(story_id: int, chapter_id: int) -> models.Chapter:
     s = db_connect()
+    # one query for the chapter, its story and author and the story's
+    # chapter list (which the page header needs)
     chapter = (await s.scalars(
         select(models.Chapter).
         options(
-            selectinload(models.Chapter.story).
-            selectinload(models.Story.author)).
+            joinedload(models.Chapter.story).options(
+                joinedload(models.Story.author),
+                joinedload(models.Story.chapters))).
         filter(models.Chapter.id == chapter_id,
                models.Chapter.story_id == story_id)
-    )).one_or_none()
+    )).unique().one_or_none()
     if chapter is None:
         abort(404)
-    chat_backlog = [i.to_browser_message() for i in
-                    await realtime.get_recent_backlog(chapter.story.channel_id)]
-    page_list = await realtime.get_page_list(chapter.story.channel_id)
+    return chapter
+
+async def load_post_window(
+        chapter_id: int, size: int, before: int | None = None,
+        after: int | None = None
+) -> tuple[list[models.Post], int | None, int | None]:
+    """Loads up to size of a chapter's posts, in order: the latest ones, or
+    the ones just before the post with ID before, or just after the one with
+    ID after. A size of 0 loads them all. Also returns the IDs to load more
+    from, if there are more in the direction loaded: the first post loaded,
+    if there are earlier posts, or the last one, if there are later posts.
+
+    These are keyset queries on (chapter_id, order_idx), which
+    post_order_idx covers, so a window costs the same however long the
+    chapter is.
+
+    """
+    s = db_connect()
+    q = (select(models.Post).
+         options(joinedload(models.Post.vote_info),
+                 defer(models.Post.text)).
+         filter(models.Post.chapter_id == chapter_id))
+    anchor = before if before is not None else after
+    if anchor is not None:
+        anchor_idx = (await s.scalars(
+            select(models.Post.order_idx).
+            filter(models.Post.id == anchor,
+                   models.Post.chapter_id == chapter_id))).one_or_none()
+        if anchor_idx is None:
+            abort(404)
+    if after is not None:
+        q = (q.filter(models.Post.order_idx > anchor_idx).
+             order_by(models.Post.order_idx))
+    else:
+        if before is not None:
+            q = q.filter(models.Post.order_idx < anchor_idx)
+        q = q.order_by(models.Post.order_idx.desc())
+    if size > 0:
+        # one extra to tell whether there are more
+        q = q.limit(size + 1)
+    posts = list((await s.scalars(q)).all())
+    more = size > 0 and len(posts) > size
+    if more:
+        del posts[size:]
+    if after is not None:
+        return posts, None, (posts[-1].id if more else None)
+    posts.reverse()
+    return posts, (posts[0].id if more else None), None
+
+async def render_chapter(story_id: int, chapter_id: int,
+                         partial: bool = False,
+                         allow_stream: bool = False) -> ResponseType:
+    """Renders a chapter page, with the latest chapter_window posts; earlier
+    ones are loaded by view_posts(). If allow_stream is set and there are at
+    least stream_min_posts posts to show, the page is streamed: the head and
+    the first batch of posts are sent while the rest are still being
+    prepared. If partial is set, only the title and #content-container are
+    rendered (see chapter_nav_partial()), without the chat backlog, chat
+    page list or topics.
+
+    """
+    start = time.perf_counter()
+    config = current_app.config['data_obj']
+    s = db_connect()
+    chapter = await get_chapter(story_id, chapter_id)
     is_author = chapter.story.author == g.current_user
-    topics = await get_topics(story_id)
-    # Default to showing last page (most recent)
-    current_page = len(page_list) - 1 if page_list else -1
-    return await render_template("view_chapter.html", chapter=chapter,
-                                 msgs=chat_backlog, is_author=is_author,
-                                 topics=topics, story=chapter.story,
-                                 page_list=make_page_list_data(page_list, current_page))
+    variant = 'author' if is_author else 'reader'
+    posts, earlier, _ = await load_post_window(chapter_id,
+                                               config.chapter_window)
+    stream = (allow_stream and config.stream_min_posts > 0 and
+              len(posts) >= config.stream_min_posts)
+    if not stream:
+        await prepare_posts(posts, chapter.story.channel_id, user_votes=True)
+        await render_post_fragments(posts, variant)
+    context = dict(chapter=chapter, is_author=is_author, story=chapter.story,
+                   earlier=earlier, later=None, partial=partial,
+                   max_posts=config.chapter_window * 2)
+    if not partial:
+        chat_backlog = [
+            i.to_browser_message() for i in
+            await realtime.get_recent_backlog(chapter.story.channel_id)]
+        page_list = await realtime.get_page_list(chapter.story.channel_id)
+        topics = await get_topics(story_id)
+        # Default to showing last page (most recent)
+        current_page = len(page_list) - 1 if page_list else -1
+        context.update(
+            msgs=chat_backlog, topics=topics,
+            page_list=make_page_list_data(page_list, current_page))
+    if not stream:
+        html = await render_template("view_chapter.html", posts=posts,
+                                     **context)
+        metrics.observe('chapter.render', time.perf_counter() - start)
+        return html
+
+    metrics.incr('chapter.streamed')
+    # The session now belongs to the stream. Committing ends its read
+    # transaction, so it doesn't hold a connection until the stream starts,
+    # and (with expire_on_commit off) keeps what's loaded.
+    del g.db_session
+    await s.commit()
+    context['posts'] = prepared_batches(
+        posts, chapter.story.channel_id, variant, config.stream_batch_size,
+        await realtime.get_user_identifier(), s)
+    chunks = await stream_chapter_template(context, s)
+    return QuartResponse(timed_stream(chunks, start), mimetype='text/html')
+
+# loaded by the buttons at either end of a chapter's window of posts
+@questing.route('/story/<int:story_id>/<int:chapter_id>/posts')
+async def view_posts(story_id: int, chapter_id: int) -> ResponseType:
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    if (before is None) == (after is None):
+        abort(400)
+    etag = None
+    channel_id = await get_story_channel(story_id)
+    if channel_id is not None:
+        etag = await page_etag(
+            'posts', story_id, chapter_id, before, after,
+            *await content_versions.get(f'posts:{channel_id}',
+                                        f'votes:{channel_id}'))
+    return await conditional_response(
+        etag, lambda: render_post_window(story_id, chapter_id, before, after))
+
+async def render_post_window(story_id: int, chapter_id: int,
+                             before: int | None, after: int | None) -> str:
+    chapter = await get_chapter(story_id, chapter_id)
+    is_author = chapter.story.author == g.current_user
+    posts, earlier, later = await load_post_window(
+        chapter_id, current_app.config['data_obj'].chapter_window,
+        before, after)
+    await prepare_posts(posts, chapter.story.channel_id, user_votes=True)
+    await render_post_fragments(posts, 'author' if is_author else 'reader')
+    return await render_template("post_window.html", chapter=chapter,
+                                 story=chapter.story, posts=posts,
+                                 is_author=is_author, earlier=earlier,
+                                 later=later)
 
 # this endpoint is used only when reopening a closed vote; it gets sent via the
 # standard HTMX path (hx-get on the voteblock element in render_vote.html)
 @questing.route('/vote/<int:vote_id>')
-async def view_vote(vote_id: int) -> str:
+async def view_vote(vote_id: int) -> ResponseType:
+    etag = None
+    channel_id = await get_vote_channel(vote_id)
+    if channel_id is not None:
+        etag = await page_etag(
+            'vote', vote_id,
+            *await content_versions.get(f'posts:{channel_id}',
+                                        f'votes:{channel_id}'))
+    return await conditional_response(etag, lambda: render_vote(vote_id))
+
+# a vote never moves to another story, so this never needs invalidating
+vote_channels: LRUCache[int, int] = LRUCache('vote_channels', 4096)
+
+async def get_vote_channel(vote_id: int) -> int | None:
+    cid = vote_channels.get(vote_id)
+    if cid is None:
+        s = db_connect()
+        cid = (await s.scalars(
+            select(models.Story.channel_id).
+            join(models.Post, models.Post.story_id == models.Story.id).
+            join(models.VoteInfo, models.VoteInfo.post_id == models.Post.id).
+            filter(models.VoteInfo.id == vote_id))).one_or_none()
+        if cid is not None:
+            vote_channels.set(vote_id, cid)
+    return cid
+
+async def render_vote(vote_id: int) -> str:
     s = db_connect()
     ve = (await s.scalars(
         select(models.VoteInfo).
@@ -272,7 +760,17 @@ async def view_vote(vote_id: int) -> str:
 
 # used for updating the topic list over HTMX
 @questing.route("/story/<int:story_id>/topics")
-async def view_topic_list(story_id: int) -> str:
+async def view_topic_list(story_id: int) -> ResponseType:
+    etag = None
+    channel_id = await get_story_channel(story_id)
+    if channel_id is not None:
+        etag = await page_etag(
+            'topics', story_id,
+            *await content_versions.get(f'topics:{channel_id}'))
+    return await conditional_response(
+        etag, lambda: render_topic_list(story_id))
+
+async def render_topic_list(story_id: int) -> str:
     s = db_connect()
     story = (await s.scalars(
         select(models.Story).filter(models.Story.id == story_id)
@@ -283,11 +781,32 @@ async def view_topic_list(story_id: int) -> str:
     return await render_template("topic_list.html", story=story, topics=topics,
                                  htmx=True)
 
+# Changes to a topic send just that topic's row straight away; the whole list
+# (to get the order right) is sent at most once per interval per story.
+topic_list_updates = realtime.CoalescedUpdates('topic_list', 2.0)
+
+async def send_topic_row(t: models.Topic, channel_id: int,
+                         new: bool = False) -> None:
+    """Sends a topic's row in the topic list to everyone viewing the story;
+    new ones are added at the top, where topics without replies go."""
+    text = await render_template("topic_row.html", t=t, htmx=True, new=new)
+    await websocket.pubsub.publish(f'chan:{channel_id}', text)
+    # the flush runs later in a context of its own, so it mustn't touch t,
+    # which belongs to this request's session
+    story_id = t.story_id
+    assert story_id is not None
+    await topic_list_updates.mark(
+        str(channel_id), lambda: send_topic_list(story_id, channel_id))
+
+async def send_topic_list(story_id: int, channel_id: int) -> None:
+    text = await render_topic_list(story_id)
+    await websocket.pubsub.publish(f'chan:{channel_id}', text)
+
 async def create_post(c: models.Chapter, ptype: models.PostType, text: Optional[str],
                       order_idx: Optional[int] = None) -> models.Post:
     if ptype == models.PostType.Text:
         assert text is not None
-        text_clean = PostHTMLText(text)
+        text_clean = await PostHTMLText.clean_async(text)
         if text_clean.clean_html != text_clean.dirty_html and \
            current_app.config['using_sentry']:
             with push_scope() as scope:
@@ -299,47 +818,94 @@ async def create_post(c: models.Chapter, ptype: models.PostType, text: Optional[
         post_text = None
     else:
         raise ValueError("can't pass text unless ptype is Text")
-    # if no explicit order given, it's the last in the current
-    # chapter, plus 10
-    if order_idx is None:
-        s = db_connect()
-        order_idx = (await s.scalars(
-            select(models.func.max(models.Post.order_idx).
-                   label('max')).
-            filter(models.Post.chapter == c))).one()
-        if order_idx is None:
-            order_idx = 0
-        else:
-            order_idx += 10
     np = models.Post(
         text=post_text,
         posted_date=datetime.now(tz=timezone.utc),
         post_type=ptype,
-        chapter=c, story=c.story, order_idx=order_idx)
+        chapter=c, story=c.story)
+    # if no explicit order given, the model default puts it last in the
+    # chapter
+    if order_idx is not None:
+        np.order_idx = order_idx
     s = db_connect()
-    async with s.begin():
-        s.add(np)
+    s.add(np)
+    await s.commit()
     return np
 
+async def post_idx_after(chapter_id: int, after_post_id: int | None) -> int:
+    """Returns an order_idx that puts a new post in the chapter straight after
+    the given post, or before all of them if after_post_id is None. If
+    there's no gap left there, the chapter's posts are renumbered first
+    (without changing their order). Aborts with a 404 if after_post_id isn't
+    a post in the chapter.
+
+    This locks the chapter row until the session commits, so call it just
+    before adding the post.
+
+    """
+    P = models.Post
+    gap = models.ORDER_IDX_GAP
+    s = db_connect()
+    await s.execute(
+        select(models.Chapter.id).
+        filter(models.Chapter.id == chapter_id).
+        with_for_update())
+    if after_post_id is None:
+        first = (await s.scalars(
+            select(func.min(P.order_idx)).
+            filter(P.chapter_id == chapter_id))).one()
+        if first is not None:
+            return first - gap
+    for _ in range(2):
+        hi = None
+        if after_post_id is not None:
+            lo = (await s.scalars(
+                select(P.order_idx).
+                filter(P.id == after_post_id,
+                       P.chapter_id == chapter_id))).one_or_none()
+            if lo is None:
+                abort(404)
+            hi = (await s.scalars(
+                select(func.min(P.order_idx)).
+                filter(P.chapter_id == chapter_id, P.order_idx > lo))).one()
+        if hi is None:
+            # going at the end; the counter is always past the last post
+            return (await s.execute(models.allocate_idx(
+                models.Chapter.next_post_idx, chapter_id))).scalar_one() - gap
+        if hi - lo >= 2:
+            return (lo + hi) // 2
+
+        # No room, so space the chapter's posts out again. The posts stay in
+        # the same order, so nothing rendered from them changes.
+        numbered = select(
+            P.id,
+            ((func.row_number().over(order_by=(P.order_idx, P.id))
+              - 1) * gap).label('new_idx')
+        ).filter(P.chapter_id == chapter_id).subquery()
+        await s.execute(
+            update(P).
+            where(P.id == numbered.c.id).
+            values(order_idx=numbered.c.new_idx).
+            execution_options(synchronize_session=False))
+        n = (await s.scalars(
+            select(func.count(P.id)).
+            filter(P.chapter_id == chapter_id))).one()
+        await s.execute(
+            update(models.Chapter).
+            where(models.Chapter.id == chapter_id).
+            values(next_post_idx=n * gap).
+            execution_options(synchronize_session=False))
+    raise RuntimeError(f"couldn't make room in chapter {chapter_id}")
+
 async def create_chapter(story: models.Story, title: str,
                          order_idx: Optional[int] = None) -> models.Chapter:
-    if order_idx is None:
-        s = db_connect()
-        order_idx = (await s.scalars(
-            select(models.func.max(models.Chapter.order_idx).
-                   label('max')).
-            filter(models.Chapter.story == story)
-        )).one()
-        if order_idx is None:
-            order_idx = 0
-        else:
-            order_idx += 10
-    nc = models.Chapter(
-        title=title, story=story, order_idx=order_idx,
-        is_appendix=False)
+    nc = models.Chapter(title=title, story=story, is_appendix=False)
+    # as with posts, the model default puts it last if no order is given
+    if order_idx is not None:
+        nc.order_idx = order_idx
     s = db_connect()
-    async with s.begin():
-        s.add(nc)
+    s.add(nc)
+    await s.commit()
     return nc
 
 @questing.route('/new_post', methods=['POST'])
@@ -372,13 +938,13 @@ async def new_post() -> ResponseType:
         ptype = models.PostType[data['post_type']]
     except KeyError:
         abort(400)
-    if ptype == models.PostType.Text:
-        pt = data['post_text']
-    else:
-        pt = None
     # p = create_post(nc, ptype, pt)
     # this will throw BadHTMLError if HTML is bad
     try:
+        if ptype == models.PostType.Text:
+            pt = await PostHTMLText.clean_async(data['post_text'])
+        else:
+            pt = None
         post_info = Post(text=pt, post_type=ptype)
     except BadHTMLError as e:
         if current_app.config['using_sentry']:
@@ -405,12 +971,15 @@ async def new_post() -> ResponseType:
         s.add(vote_model)
     channel_id = c.story.channel_id
     await s.commit()
+    await content_versions.bump(f'posts:{channel_id}')
+    await story_activity.touch(channel_id, p.posted_date)
     # emit the post after committing the session, so that clients don't see a
     # chapter that failed DB write
     if p.post_type == models.PostType.Vote:
         # vote_info = Vote.from_model(vote_model)
         await realtime.add_active_vote(vote_model, c.story.channel_id)
     await prepare_post(p, user_votes=False)
+    await render_post_fragments([p], 'reader')
     text = await render_template('render_post.html', p=p, htmx=True,
                                  chapter=p.chapter)
     await websocket.pubsub.publish(f'chan:{channel_id}', text)
@@ -506,8 +1075,8 @@ async def new_topic() -> ResponseType:
 
     if story is not None:
         assert story_id is not None
-        text = await view_topic_list(story_id)
-        await websocket.pubsub.publish(f'chan:{story.channel_id}', text)
+        await content_versions.bump(f'topics:{story.channel_id}')
+        await send_topic_row(t, story.channel_id, new=True)
 
     # since this is going straight to HTMX, we just return the text that
     # view_topic would along with the appropriate URL header
@@ -526,13 +1095,16 @@ async def new_topic_post() -> ResponseType:
     topic_id = data['topic_id']
     s = db_connect()
     topic = (await s.scalars(
-        select(models.Topic).filter(models.Topic.id == topic_id)
+        select(models.Topic).
+        options(selectinload(models.Topic.story),
+                selectinload(models.Topic.poster)).
+        filter(models.Topic.id == topic_id)
     )).one_or_none()
     if topic is None:
         abort(400)
 
     try:
-        text = clean_html(data['text'])
+        text = await clean_html_async(data['text'])
     except Exception:
         abort(400)
 
@@ -543,13 +1115,23 @@ async def new_topic_post() -> ResponseType:
     message.poster = g.current_user
 
     s = db_connect()
-    async with s.begin():
-        s.add(message)
+    s.add(message)
+    # in the same transaction, so the count can't drift from the messages
+    count, last_date = (await s.execute(
+        update(models.Topic).
+        where(models.Topic.id == topic_id).
+        values(message_count=models.Topic.message_count + 1,
+               last_post_date=func.greatest(
+                   models.Topic.last_post_date, message.post_date)).
+        returning(models.Topic.message_count, models.Topic.last_post_date).
+        execution_options(synchronize_session=False))).one()
+    await s.commit()
+    set_committed_value(topic, 'message_count', count)
+    set_committed_value(topic, 'last_post_date', last_date)
 
     if topic.story is not None:
-        story_id = topic.story_id
-        text = await view_topic_list(story_id)
-        await websocket.pubsub.publish(f'chan:{topic.story.channel_id}', text)
+        await content_versions.bump(f'topics:{topic.story.channel_id}')
+        await send_topic_row(topic, topic.story.channel_id)
 
     return redirect(url_for('questing.view_topic', topic_id=topic_id))
 
@@ -566,12 +1148,29 @@ def find_page_for_message(page_list: list[tuple[int, int, datetime]], return_id:
                 return page_num
     return 0  # Default to first page if not found
 
+@questing.route('/stats')
+async def stats() -> ResponseType:
+    if not current_app.config['data_obj'].stats_enabled:
+        abort(404)
+    rv = metrics.snapshot()
+    rv['hit_ratios'] = { c.name: c.hit_ratio() for c in
+                         (page_cache, realtime.vote_skeletons,
+                          story_channels, post_fragments) }
+    rv['vote_updates'] = realtime.vote_updates.stats()
+    rv['topic_list_updates'] = topic_list_updates.stats()
+    return jsonify(rv)
+
 @questing.route('/view_chat/<int:channel_id>')
 async def view_chat(channel_id: int) -> ResponseType:
     uid = 'anon' if g.current_user is None else g.current_user.id
     if not await realtime.check_channel_auth(channel_id, uid):
         abort(403)
+    etag = await page_etag(
+        'chat', channel_id, sorted(request.args.items()),
+        *await content_versions.get(f'chat:{channel_id}'))
+    return await conditional_response(etag, lambda: render_chat(channel_id))
 
+async def render_chat(channel_id: int) -> str:
     tis = request.args.get('thread_id', "")
     return_id = request.args.get('return_id', '')
     after_date_str = request.args.get('after_date', '')
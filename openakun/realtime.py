@@ -5,20 +5,24 @@ from __future__ import annotations
 from . import models, websocket
 from .general import (db, db_connect, decode_redis_dict, register_ip,
                       get_user_identifier)
-from .data import ChatMessage, Vote, VoteEntry, Message
-from quart import render_template, g
+from .data import ChatMessage, Vote, VoteEntry, VoteSkeleton, Message
+from .metrics import metrics
+from .cache import LRUCache, content_versions
+from .activity import story_activity
+from quart import render_template, g, Quart
 from quart import websocket as ws
 from functools import wraps
 from datetime import datetime, timezone, timedelta
-from sqlalchemy import sql, or_, func
+from sqlalchemy import sql, or_, func, update, delete, insert
 from sqlalchemy.sql.expression import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import cast, Awaitable, Any
 from sqlalchemy.orm import selectinload
-import json
+import json, asyncio, time, traceback, hashlib, importlib.resources
+import contextvars, secrets
 from .websocket import handle_message
 
-from typing import List, Optional, Any, Union, cast, Callable
+from typing import List, Optional, Any, Union, cast, Callable, Collection
 
 async def get_channel(channel_id: int) -> models.Channel:
     s = db_connect()
@@ -172,9 +176,63 @@ async def handle_chat(data: dict[str, Any]) -> None:
     if mo['is_anon']:
         # TODO eventually set this to the story-configured anon username
         mo['username'] = 'anon'
+    await story_activity.touch(channel_id, c_ts)
+    await content_versions.bump(f'chat:{channel_id}')
     html = await render_template('render_chatmsg.html', c=mo, htmx=True)
     await websocket.pubsub.publish(f'chan:{channel_id}', html)
 
+def user_index_key(vote_id: int | str) -> str:
+    return f"vote_user_options:{vote_id}"
+
+def user_index_mapping(vote: Vote) -> dict[str, str]:
+    """Builds the contents of a vote's user -> options reverse index (see
+    redisvotes.lua) from its users_voted_for lists.
+
+    """
+    opts: dict[str, list[str]] = {}
+    for e in vote.votes:
+        for u in set(e.users_voted_for or []):
+            opts.setdefault(u, []).append(str(e.db_id))
+    return { u: ','.join(ol) for u, ol in opts.items() }
+
+def parse_user_index(val: bytes | str | None) -> set[int]:
+    if not val:
+        return set()
+    if isinstance(val, bytes):
+        val = val.decode()
+    return { int(i) for i in val.split(',') }
+
+# Published whenever a vote close time is set, so the node running the vote
+# close scheduler (worker.VoteCloseScheduler) can wake up early if the new
+# deadline comes before the one it's sleeping until. The value is the close
+# time in milliseconds since the epoch, same as the vote_close_times score.
+vote_close_wake_key = 'vote_close_wake'
+
+async def notify_vote_close_time(close_ms: int) -> None:
+    await websocket.pubsub.publish(vote_close_wake_key, str(close_ms))
+
+def queue_active_vote(pipe: Any, vote: Vote, channel_id: int) -> None:
+    """Queues up the Redis commands to make a vote active on a pipeline. The
+    vote info, its user index and the channel membership should go in
+    together, in a MULTI, so the Lua functions never see a partially set-up
+    vote.
+
+    """
+    assert vote.db_id is not None
+    rd = vote.to_redis_dict()
+    rd['channel_id'] = channel_id
+    uidx = user_index_mapping(vote)
+
+    pipe.hset('vote_info', str(vote.db_id), json.dumps(rd))
+    pipe.delete(user_index_key(vote.db_id))
+    if uidx:
+        pipe.hset(user_index_key(vote.db_id), mapping=uidx)
+    if vote.close_time is not None:
+        pipe.zadd('vote_close_times',
+                  { f"{channel_id}:{vote.db_id}":
+                    int(vote.close_time.timestamp() * 1000) })
+    pipe.sadd(f"channel_votes:{channel_id}", str(vote.db_id))
+
 async def add_active_vote(vm: models.VoteInfo, channel_id: int,
                           s: AsyncSession | None = None) -> None:
     """This function takes trusted input: it gets called when a new vote is
@@ -184,37 +242,77 @@ async def add_active_vote(vm: models.VoteInfo, channel_id: int,
     """
     if s is None:
         s = db_connect()
-    vote = await Vote.from_model_dbload(s, vm)
-    assert vote.db_id is not None
+    vote = await Vote.load(s, vm.id)
+    assert vote is not None and vote.db_id is not None
     assert db.redis_conn is not None
 
-    rd = vote.to_redis_dict()
-    rd['channel_id'] = channel_id
-    rds = json.dumps(rd)
-    await cast(Awaitable[int], db.redis_conn.hset('vote_info', str(vote.db_id), rds))
-
+    async with db.redis_conn.pipeline(transaction=True) as pipe:
+        queue_active_vote(pipe, vote, channel_id)
+        await pipe.execute()
     if vote.close_time is not None:
-        await db.redis_conn.zadd('vote_close_times',
-                                 { f"{channel_id}:{vote.db_id}":
-                                   int(vote.close_time.timestamp() * 1000) })
-
-    channel_key = f"channel_votes:{channel_id}"
-    await cast(Awaitable[int], db.redis_conn.sadd(channel_key, str(vote.db_id)))
+        await notify_vote_close_time(
+            int(vote.close_time.timestamp() * 1000))
 
 async def repopulate_from_db() -> None:
+    """Makes every open vote in the DB active in Redis. Votes that are already
+    there are left alone, since their Redis state is newer than what's in the
+    DB; this makes restarting a node (or several) cheap. Everything else is
+    loaded with a fixed number of queries and written in one MULTI.
+
+    """
+    start = time.perf_counter()
     async with db.Session() as s:
-        votes = (await s.scalars(
-            select(models.VoteInfo).
-            options(selectinload(models.VoteInfo.votes).
-                    selectinload(models.VoteEntry.votes),
-                    selectinload(models.VoteInfo.post).
-                    selectinload(models.Post.story)).
+        active = (await s.execute(
+            select(models.VoteInfo.id, models.Story.channel_id).
+            join(models.Post, models.VoteInfo.post_id == models.Post.id).
+            join(models.Story, models.Post.story_id == models.Story.id).
             where((models.VoteInfo.time_closed > sql.functions.now()) |
                   (models.VoteInfo.time_closed == None)))).all()
-        for vm in votes:
-            print(vm)
-            channel_id = vm.post.story.channel_id
-            await add_active_vote(vm, channel_id, s)
+        if len(active) == 0:
+            return
+
+        # a vote counts as present only if it's both in vote_info and in its
+        # channel set; add_active_vote and close_votes keep those in step
+        async with db.redis_conn.pipeline(transaction=False) as pipe:
+            for vote_id, channel_id in active:
+                pipe.hexists('vote_info', str(vote_id))
+                pipe.sismember(f"channel_votes:{channel_id}", str(vote_id))
+            res = await pipe.execute()
+        missing = { vote_id: channel_id
+                    for (vote_id, channel_id), has_info, is_member
+                    in zip(active, res[::2], res[1::2])
+                    if not (has_info and is_member) }
+
+        votes = await Vote.load_many(s, missing.keys())
+
+    if votes:
+        async with db.redis_conn.pipeline(transaction=True) as pipe:
+            for vote_id, vote in votes.items():
+                queue_active_vote(pipe, vote, missing[vote_id])
+            await pipe.execute()
+        close_times = [v.close_time for v in votes.values()
+                       if v.close_time is not None]
+        if close_times:
+            await notify_vote_close_time(
+                int(min(close_times).timestamp() * 1000))
+
+    print(f"Repopulated {len(votes)} votes ({len(active) - len(missing)} "
+          f"already active) in {time.perf_counter() - start:.3f}s")
+
+async def seed_anon_voters() -> None:
+    """The Lua vote functions add anonymous voters to the anon_voters set as
+    they vote, for the page cache to check; this adds the ones whose votes
+    are only in Postgres.
+
+    """
+    async with db.Session() as s:
+        anon_ids = (await s.scalars(
+            select(models.UserVote.anon_id).
+            where(models.UserVote.anon_id != None).
+            distinct())).all()
+    for i in range(0, len(anon_ids), 1000):
+        await cast(Awaitable[int], db.redis_conn.sadd(
+            'anon_voters', *(f'anon:{a}' for a in anon_ids[i:i + 1000])))
 
 async def vote_is_active(channel_id: int, vote_id: int) -> bool:
     assert db.redis_conn is not None
@@ -244,14 +342,140 @@ async def populate_vote(channel_id: int, vote: Vote) -> Vote:
 
     return vote
 
+# Skeletons of active votes, keyed by vote ID. Entries are dropped locally
+# whenever this node changes a vote's options or config; other nodes' copies
+# are caught by the covers() check in get_vote_skeleton(), since the only
+# skeleton change that matters to them (a new write-in) shows up as an option
+# missing from the skeleton.
+vote_skeletons: LRUCache[int, VoteSkeleton] = LRUCache('vote_skeletons', 4096)
+
+async def get_vote_skeleton(
+        vote_id: int, option_ids: Any = (), s: AsyncSession | None = None
+) -> VoteSkeleton | None:
+    """Returns the skeleton for the given vote, from the cache if the cached
+    copy covers all of option_ids, or else loaded fresh from Postgres in one
+    query.
+
+    """
+    return (await get_vote_skeletons({ int(vote_id): option_ids }, s)).get(
+        int(vote_id))
+
+async def get_vote_skeletons(
+        wanted: dict[int, Any], s: AsyncSession | None = None
+) -> dict[int, VoteSkeleton]:
+    """Like get_vote_skeleton(), for any number of votes. wanted maps vote ID
+    to the option IDs the skeleton has to cover. Whatever isn't in the cache
+    is loaded in one query. Votes that don't exist are left out.
+
+    """
+    rv: dict[int, VoteSkeleton] = {}
+    missing = []
+    for vote_id, option_ids in wanted.items():
+        sk = vote_skeletons.get(vote_id)
+        if sk is not None and sk.covers(option_ids):
+            rv[vote_id] = sk
+        else:
+            missing.append(vote_id)
+    if not missing:
+        return rv
+
+    if s is None:
+        s = db_connect()
+    rows = (await s.execute(
+        select(models.VoteInfo.id, models.VoteInfo.vote_question,
+               models.Story.author_id,
+               models.VoteEntry.id, models.VoteEntry.vote_text).
+        join(models.Post, models.VoteInfo.post_id == models.Post.id).
+        join(models.Story, models.Post.story_id == models.Story.id).
+        outerjoin(models.VoteEntry,
+                  models.VoteEntry.vote_id == models.VoteInfo.id).
+        where(models.VoteInfo.id.in_(missing)).
+        order_by(models.VoteInfo.id, models.VoteEntry.id))).all()
+    by_vote: dict[int, list[Any]] = {}
+    for row in rows:
+        by_vote.setdefault(row[0], []).append(row)
+    for vote_id, vrows in by_vote.items():
+        sk = VoteSkeleton(
+            db_id=vote_id, question=vrows[0][1], author_id=vrows[0][2],
+            entries=tuple((eid, text) for _, _, _, eid, text in vrows
+                          if eid is not None))
+        vote_skeletons.set(vote_id, sk)
+        rv[vote_id] = sk
+    return rv
+
+async def load_active_vote(
+        channel_id: int, vote_id: int, s: AsyncSession | None = None
+) -> tuple[Vote, VoteSkeleton] | None:
+    """If the vote is active, build it from its cached skeleton and the live
+    Redis state; this normally needs no Postgres queries. Returns None if the
+    vote isn't active on the given channel.
+
+    """
+    assert db.redis_conn is not None
+    async with db.redis_conn.pipeline(transaction=False) as pipe:
+        pipe.sismember(f"channel_votes:{channel_id}", str(vote_id))
+        pipe.hget('vote_info', str(vote_id))
+        is_active, rds = await pipe.execute()
+    if not is_active or rds is None:
+        return None
+    rd = json.loads(rds)
+    sk = await get_vote_skeleton(vote_id, rd['votes'].keys(), s)
+    if sk is None:
+        return None
+    return sk.to_vote(rd), sk
+
+async def load_active_votes(
+        channel_id: int, vote_ids: Collection[int],
+        user_id: str | None = None, s: AsyncSession | None = None
+) -> dict[int, Vote]:
+    """Batch version of load_active_vote(), for rendering a whole chapter: one
+    Redis round trip and at most one query for uncached skeletons, however
+    many votes there are. If user_id is given, user_voted is filled in on the
+    options for that user. Votes that aren't active are left out.
+
+    """
+    assert db.redis_conn is not None
+    vids = [int(i) for i in vote_ids]
+    if not vids:
+        return {}
+    async with db.redis_conn.pipeline(transaction=False) as pipe:
+        for vid in vids:
+            pipe.sismember(f"channel_votes:{channel_id}", str(vid))
+            pipe.hget('vote_info', str(vid))
+            if user_id is not None:
+                pipe.hget(user_index_key(vid), user_id)
+        res = await pipe.execute()
+    step = 3 if user_id is not None else 2
+    states: dict[int, tuple[dict[str, Any], set[int] | None]] = {}
+    for n, vid in enumerate(vids):
+        is_active, rds = res[n * step], res[n * step + 1]
+        if not is_active or rds is None:
+            continue
+        uv = (parse_user_index(res[n * step + 2]) if user_id is not None
+              else None)
+        states[vid] = (json.loads(rds), uv)
+
+    sks = await get_vote_skeletons(
+        { vid: rd['votes'].keys() for vid, (rd, _) in states.items() }, s)
+    rv = {}
+    for vid, (rd, uv) in states.items():
+        sk = sks.get(vid)
+        if sk is None:
+            continue
+        v = sk.to_vote(rd)
+        if uv is not None:
+            for o in v.votes:
+                o.user_voted = o.db_id in uv
+        rv[vid] = v
+    return rv
+
 async def get_vote_object(channel_id: int, vote_id: int) -> Optional[Vote]:
-    s = db_connect()
-    vm = (await s.scalars(
-        select(models.VoteInfo).filter(models.VoteInfo.id == vote_id)
-    )).one_or_none()
-    if vm is None:
+    av = await load_active_vote(channel_id, vote_id)
+    if av is not None:
+        return av[0]
+    v = await Vote.load(db_connect(), vote_id)
+    if v is None:
         return None
-    v = await Vote.from_model_dbload(s, vm)
     await populate_vote(channel_id, v)
     return v
 
@@ -264,30 +488,145 @@ async def send_vote_html(
     order to update clients' views.
 
     """
-    s = db_connect()
-    m = (await s.scalars(
-        select(models.VoteInfo).
-        options(selectinload(models.VoteInfo.post).
-                selectinload(models.Post.story).
-                selectinload(models.Story.author)).
-        filter(models.VoteInfo.id == vote_id)
-    )).one()
-    v = await Vote.from_model_dbload(s, m)
-    await populate_vote(channel_id, v)
+    await content_versions.bump(f'votes:{channel_id}')
+    av = await load_active_vote(channel_id, vote_id)
+    if av is not None:
+        v, sk = av
+        author_id = sk.author_id
+    else:
+        s = db_connect()
+        author_id = (await s.scalars(
+            select(models.Story.author_id).
+            where(models.Story.channel_id == channel_id))).one()
+        lv = await Vote.load(s, vote_id)
+        assert lv is not None
+        v = await populate_vote(channel_id, lv)
     # this is a dummy chapter object used only to get the channel ID
     dummy_chapter = { 'story': { 'channel_id': channel_id }}
     # in this case the public update will have vote totals hidden; we draw a
     # special update with totals shown, and send it only to the story author
     if v.votes_hidden and v.active:
-        author_id = f"user:{m.post.story.author_id}"
         html = await render_template('render_vote.html', vote=v,
                                      morph_swap=True, is_author=True,
                                      chapter=dummy_chapter)
-        await websocket.pubsub.publish(author_id, html)
+        await websocket.pubsub.publish(f"user:{author_id}", html)
     html = await render_template('render_vote.html', vote=v, morph_swap=True,
                                  chapter=dummy_chapter)
     await websocket.pubsub.publish(f'chan:{channel_id}', html)
 
+class CoalescedUpdates:
+    """Rate-limits an expensive broadcast, so that a burst of changes to the
+    same object produces one update rather than one per change.
+
+    Callers mark an object (identified by a string key) as dirty. The first
+    mark takes a short-lived Redis lease on the key; the node holding the lease
+    waits out the interval, releases the lease and then runs the flush, which
+    must read the latest state itself. Marks made while the lease is held, on
+    this node or any other, are absorbed by the pending flush. Since every
+    writer changes the state before marking, and the lease is released before
+    the flush reads it, no change can be missed: a mark that fails to take the
+    lease happened before the release, and so before the read.
+
+    The flush runs in a fresh request context rather than that of whichever
+    handler marked the object, since that handler's context (and database
+    session) may be gone or in use by the time the interval elapses. Its task
+    is started with an empty contextvars.Context, since it would otherwise
+    inherit the marking handler's app context, and with it that handler's g
+    and session; the new context's session is closed by the app teardown when
+    the flush is done. It has no current user, so it must render
+    user-agnostic content only.
+
+    """
+    def __init__(self, name: str, interval: float = 0.25) -> None:
+        self.name = name
+        self.interval = interval
+        self.app: Quart | None = None
+        # unique across nodes, so that a node only ever releases its own
+        # lease (PIDs aren't unique in containers)
+        self.node_id = secrets.token_hex(8)
+        self.pending: dict[str, asyncio.Task] = {}
+
+    def init_app(self, app: Quart, interval: float | None = None) -> None:
+        self.app = app
+        if interval is not None:
+            self.interval = interval
+
+    def _lease_key(self, key: str) -> str:
+        return f"update_lease:{self.name}:{key}"
+
+    async def mark(self, key: str,
+                   flush: Callable[[], Awaitable[None]]) -> None:
+        metrics.incr(f'{self.name}.marked')
+        # with no interval (or outside a running app), just send immediately
+        # in the caller's context
+        if self.interval <= 0 or self.app is None:
+            await flush()
+            metrics.incr(f'{self.name}.emitted')
+            return
+
+        if key in self.pending:
+            metrics.incr(f'{self.name}.coalesced')
+            return
+        # the lease TTL is only a backstop in case this node dies during the
+        # interval; normally the lease is released explicitly by _run()
+        lease_ms = max(int(self.interval * 4000), 1000)
+        acquired = await db.redis_conn.set(self._lease_key(key), self.node_id,
+                                           nx=True, px=lease_ms)
+        if not acquired:
+            metrics.incr(f'{self.name}.coalesced')
+            return
+        self.pending[key] = asyncio.create_task(
+            self._run(key, flush), context=contextvars.Context())
+
+    async def _release(self, key: str) -> None:
+        # only if it's still ours: if this ran past the lease TTL another
+        # node may hold it by now
+        await cast(Awaitable[Any], db.redis_conn.fcall(
+            'release_lease', 1, self._lease_key(key), self.node_id))
+
+    async def _run(self, key: str,
+                   flush: Callable[[], Awaitable[None]]) -> None:
+        released = False
+        try:
+            await asyncio.sleep(self.interval)
+            # order matters here: drop the local pending entry and the lease
+            # before reading any state, so later marks start a new interval
+            del self.pending[key]
+            await self._release(key)
+            released = True
+            assert self.app is not None
+            async with self.app.test_request_context('/'):
+                await flush()
+            metrics.incr(f'{self.name}.emitted')
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.pending.pop(key, None)
+            if not released:
+                # cancelled during the interval, or the release failed; try
+                # again rather than leave the key locked until the TTL
+                try:
+                    await self._release(key)
+                except Exception:
+                    traceback.print_exc()
+
+    def stats(self) -> dict[str, int]:
+        return { i: metrics.get(f'{self.name}.{i}')
+                 for i in ('marked', 'emitted', 'coalesced') }
+
+# global
+vote_updates = CoalescedUpdates('vote_updates')
+
+async def schedule_vote_html(channel_id: int, vote_id: int) -> None:
+    """Mark a vote as changed. At most one send_vote_html() per vote is done
+    per interval, across all nodes, using whatever the vote state is in Redis
+    by then.
+
+    """
+    channel_id, vote_id = int(channel_id), int(vote_id)
+    await vote_updates.mark(
+        str(vote_id), lambda: send_vote_html(channel_id, vote_id))
+
 @handle_message('add_vote')
 @with_channel_auth()
 async def handle_add_vote(data: dict[str, Any]) -> None:
@@ -319,7 +658,7 @@ async def handle_add_vote(data: dict[str, Any]) -> None:
         pl['clear'] = True
     m = Message(message_type='user-vote', data=pl, dest=uid)
     await m.send()
-    await send_vote_html(int(channel_id), int(vote_id))
+    await schedule_vote_html(channel_id, vote_id)
 
 @handle_message('remove_vote')
 @with_channel_auth()
@@ -346,7 +685,7 @@ async def handle_remove_vote(data: dict[str, Any]) -> None:
                 data={ 'vote': vote_id, 'option': option_id, 'value': False,
                        'clear': False }, dest=uid)
     await m.send()
-    await send_vote_html(int(channel_id), int(vote_id))
+    await schedule_vote_html(channel_id, vote_id)
 
 @handle_message('new_vote_entry')
 @with_channel_auth()
@@ -409,12 +748,13 @@ async def handle_new_vote_entry(data: dict[str, Any]) -> None:
         await s.delete(om)
         await s.commit()
         return
+    vote_skeletons.pop(int(vote_id))
 
     m = Message(message_type='user-vote',
                 data={ 'vote': vote_id, 'option': option.db_id, 'value': True,
                        'clear': False }, dest=uid)
     await m.send()
-    await send_vote_html(int(channel_id), int(vote_id))
+    await schedule_vote_html(channel_id, vote_id)
 
 async def get_user_votes(
         vote_id: Union[int, str], user_id: Optional[str] = None) -> set[int]:
@@ -426,16 +766,32 @@ async def get_user_votes(
         user_id = await get_user_identifier()
     user_id = str(user_id)
 
-    rv: set[int] = set()
-    vis = await cast(Awaitable[str | None], db.redis_conn.hget('vote_info', str(vote_id)))
-    if not vis:
-        return rv
-    vote = json.loads(vis)
-    for oid, opt in vote['votes'].items():
-        if user_id in opt['users_voted_for']:
-            rv.add(int(oid))
+    val = await cast(Awaitable[bytes | None],
+                     db.redis_conn.hget(user_index_key(vote_id), user_id))
+    return parse_user_index(val)
 
-    return rv
+async def get_user_votes_many(
+        vote_ids: Collection[int | str], user_id: Optional[str] = None
+) -> dict[int, set[int]]:
+    """Like get_user_votes(), but for any number of votes (e.g. all the active
+    votes on a chapter) in a single Redis round trip. Returns a dict of vote
+    ID to option ID set; inactive votes map to empty sets.
+
+    """
+    assert db.redis_conn is not None
+
+    if user_id is None:
+        user_id = await get_user_identifier()
+    user_id = str(user_id)
+
+    vids = [int(i) for i in vote_ids]
+    if not vids:
+        return {}
+    async with db.redis_conn.pipeline(transaction=False) as pipe:
+        for vid in vids:
+            pipe.hget(user_index_key(vid), user_id)
+        res = await pipe.execute()
+    return { vid: parse_user_index(val) for vid, val in zip(vids, res) }
 
 # @handle_message('get_my_votes')
 # def request_my_votes(data) -> None:
@@ -477,78 +833,268 @@ async def close_vote(
     true.
 
     """
-    assert db.redis_conn is not None
+    await close_votes([(channel_id, vote_id)], set_close_time,
+                      emit_client_event, s)
 
-    if not await vote_is_active(channel_id, vote_id):
-        return None
+async def write_vote_state(
+        s: AsyncSession, states: dict[int, dict[str, Any]],
+        time_closed: dict[int, datetime | None] | None = None
+) -> None:
+    """Writes the given Redis vote dicts (keyed by vote ID) to the vote_info,
+    vote_entries and user_votes tables, replacing what's there. This is done
+    with set-based statements, so it takes the same number of queries however
+    many votes, options and voters there are. time_closed is only written if
+    it's given. The caller commits.
+
+    """
+    info_rows = []
+    entry_rows = []
+    uv_rows = []
+    for vote_id, rd in states.items():
+        # these parameters don't matter when the vote is closed but they're
+        # preserved for if it opens again
+        row = {
+            'id': vote_id,
+            'multivote': rd.get('multivote', False),
+            'writein_allowed': rd.get('writein_allowed', False),
+            'votes_hidden': rd.get('votes_hidden', False) }
+        if time_closed is not None:
+            row['time_closed'] = time_closed[vote_id]
+        info_rows.append(row)
+        for oid, od in rd['votes'].items():
+            killed = od.get('killed', False)
+            entry_rows.append({
+                'id': int(oid), 'killed': killed,
+                'killed_text': od.get('killed_text') if killed else None })
+            for u in set(od.get('users_voted_for') or []):
+                if u.startswith('user:'):
+                    uv_rows.append({ 'entry_id': int(oid),
+                                     'user_id': int(u[5:]), 'anon_id': None })
+                else:
+                    uv_rows.append({ 'entry_id': int(oid),
+                                     'user_id': None, 'anon_id': u[5:] })
+
+    await s.execute(update(models.VoteInfo), info_rows)
+    if entry_rows:
+        await s.execute(update(models.VoteEntry), entry_rows)
+    await s.execute(
+        delete(models.UserVote).
+        where(models.UserVote.entry_id.in_(
+            select(models.VoteEntry.id).
+            where(models.VoteEntry.vote_id.in_(states.keys())))).
+        execution_options(synchronize_session=False))
+    if uv_rows:
+        await s.execute(insert(models.UserVote), uv_rows)
+
+def expire_vote_objects(s: AsyncSession, vote_ids: Collection[int]) -> None:
+    """The bulk statements in write_vote_state() don't touch objects already
+    loaded in the session, so expire those."""
+    for obj in list(s.identity_map.values()):
+        if ((isinstance(obj, models.VoteInfo) and obj.id in vote_ids) or
+            (isinstance(obj, models.VoteEntry) and obj.vote_id in vote_ids)):
+            s.expire(obj)
+
+async def checkpoint_votes(s: AsyncSession | None = None) -> int:
+    """Copies the state of every vote changed since the last checkpoint from
+    Redis to Postgres, so that losing Redis only loses the changes since then;
+    repopulate_from_db() picks up from whatever was last written. Returns the
+    number of votes written.
 
+    """
+    assert db.redis_conn is not None
     if s is None:
         s = db_connect()
-    vm = (await s.scalars(
-        select(models.VoteInfo).filter(models.VoteInfo.id == vote_id))).one()
-    ve = await Vote.from_model_dbload(s, vm)
-
-    await populate_vote(channel_id, ve)
-
-    channel_key = f"channel_votes:{channel_id}"
-    removed = await cast(Awaitable[int], db.redis_conn.srem(channel_key, str(vote_id)))
-    # srem() returns the number of items removed from the set; in this case
-    # that will be 1 or 0 depending on whether the ID was actually in the set
-
-    # if it's 0, that means we got a race condition where someone else beat us
-    # to removing the item, so just exit
-    if removed < 1:
-        return None
+    res = await cast(Awaitable[list[Any]], db.redis_conn.fcall(
+        'take_dirty_votes', 0))
+    states = { int(res[i]): json.loads(res[i + 1])
+               for i in range(0, len(res), 2) }
+    if len(states) == 0:
+        return 0
+    taken = list(states)
+
+    try:
+        # A close_votes() that overlaps with this must win, since its state
+        # is the newer one. Locking the rows means a close that comes after
+        # this point blocks until we've committed and then overwrites us; a
+        # close that came before has already taken the vote out of its
+        # channel set, so we skip those votes.
+        await s.execute(
+            select(models.VoteInfo.id).
+            where(models.VoteInfo.id.in_(taken)).
+            with_for_update())
+        async with db.redis_conn.pipeline(transaction=False) as pipe:
+            for vote_id, rd in states.items():
+                pipe.sismember(f"channel_votes:{rd['channel_id']}",
+                               str(vote_id))
+            active = await pipe.execute()
+        states = { vote_id: rd for (vote_id, rd), a
+                   in zip(states.items(), active) if a }
+        if states:
+            await write_vote_state(s, states)
+        await s.commit()
+    except Exception:
+        await s.rollback()
+        # mark them dirty again so the next checkpoint picks them up
+        await cast(Awaitable[int], db.redis_conn.sadd(
+            'vote_dirty', *(str(v) for v in taken)))
+        raise
+    expire_vote_objects(s, states.keys())
+    return len(states)
+
+async def close_votes(
+        votes: Collection[tuple[int, int]], set_close_time: bool = True,
+        emit_client_event: bool = True, s: AsyncSession | None = None,
+        due_ms: int | None = None
+) -> list[int]:
+    """Closes a batch of votes, given as (channel ID, vote ID) pairs, with a
+    fixed number of Redis round trips and a single DB transaction however many
+    votes and voters there are. See close_vote() for the parameters. Returns
+    the IDs of the votes that were actually closed; the others weren't active
+    or were closed by someone else first.
+
+    With due_ms, only the votes whose close time (in vote_close_times) is at
+    or before due_ms are closed, checked atomically with taking each one, so a
+    close time pushed back after the caller read the schedule is kept.
 
-    # these parameters don't matter when the vote is closed but they're
-    # preserved for if it opens again
-    vm.multivote = ve.multivote
-    vm.writein_allowed = ve.writein_allowed
-    vm.votes_hidden = ve.votes_hidden
+    """
+    assert db.redis_conn is not None
+    if len(votes) == 0:
+        return []
+    if s is None:
+        s = db_connect()
 
-    # for closed votes, time_closed represents the actual time of closure, so
-    # just set it to the current time
-    if set_close_time:
-        vm.time_closed = datetime.now(tz=timezone.utc)
-    else:
-        vm.time_closed = ve.close_time
-
-    ed = { i.db_id: i for i in ve.votes }
-    for v in vm.votes:
-        v.killed = ed[v.id].killed
-        v.killed_text = ed[v.id].killed_text
-
-        vl = ed[v.id].users_voted_for
-        assert vl is not None
-        v.votes.clear()
-        for u in vl:
-            if u.startswith('user:'):
-                user_id = int(u[5:])
-                um = models.UserVote(user_id=user_id)
+    # taking a vote out of its channel set stops the Lua functions from
+    # touching it, so doing that and reading the vote state in one MULTI gets
+    # us a snapshot that can't change under us. srem() returns 0 if someone
+    # else beat us to removing the vote, in which case we leave it to them.
+    async with db.redis_conn.pipeline(transaction=True) as pipe:
+        for channel_id, vote_id in votes:
+            if due_ms is None:
+                pipe.srem(f"channel_votes:{channel_id}", str(vote_id))
             else:
-                anon_id = u[5:]
-                um = models.UserVote(anon_id=anon_id)
-            v.votes.append(um)
-    await s.commit()
+                pipe.fcall('take_due_vote', 2, 'vote_close_times',
+                           f"channel_votes:{channel_id}",
+                           f"{channel_id}:{vote_id}", vote_id, due_ms)
+            pipe.hget('vote_info', str(vote_id))
+        res = await pipe.execute()
+    snap: dict[int, tuple[int, dict[str, Any]]] = {}
+    for (channel_id, vote_id), removed, rds in zip(votes, res[::2], res[1::2]):
+        if removed < 1 or rds is None:
+            continue
+        snap[vote_id] = (channel_id, json.loads(rds))
+    if len(snap) == 0:
+        return []
+
+    now = datetime.now(tz=timezone.utc)
+    time_closed: dict[int, datetime | None] = {}
+    for vote_id, (_, rd) in snap.items():
+        # for closed votes, time_closed represents the actual time of closure;
+        # votes closed for later repopulation keep their planned close time
+        if set_close_time:
+            time_closed[vote_id] = now
+        else:
+            time_closed[vote_id] = (datetime.fromisoformat(rd['close_time'])
+                                    if rd.get('close_time') else None)
 
-    await cast(Awaitable[int], db.redis_conn.zrem('vote_close_times', f"{channel_id}:{ve.db_id}"))
-    await cast(Awaitable[int], db.redis_conn.hdel('vote_info', str(vote_id)))
+    try:
+        await write_vote_state(
+            s, { v: rd for v, (_, rd) in snap.items() }, time_closed)
+        await s.commit()
+    except Exception:
+        await s.rollback()
+        # put the votes back, so they're still open rather than lost
+        async with db.redis_conn.pipeline(transaction=True) as pipe:
+            for vote_id, (channel_id, _) in snap.items():
+                pipe.sadd(f"channel_votes:{channel_id}", str(vote_id))
+            await pipe.execute()
+        raise
+    expire_vote_objects(s, snap.keys())
+
+    async with db.redis_conn.pipeline(transaction=False) as pipe:
+        pipe.zrem('vote_close_times',
+                  *(f"{c}:{v}" for v, (c, _) in snap.items()))
+        pipe.hdel('vote_info', *(str(v) for v in snap))
+        pipe.delete(*(user_index_key(v) for v in snap))
+        await pipe.execute()
+    for vote_id in snap:
+        vote_skeletons.pop(vote_id)
+    await content_versions.bump(
+        *{ f'votes:{c}' for c, _ in snap.values() })
 
     if emit_client_event:
-        await websocket.pubsub.publish(f'chan:{channel_id}',
-                                       json.dumps({ 'type': 'set-vote-open',
-                                                    'vote_id': vote_id,
-                                                    'open': False }))
+        for vote_id, (channel_id, _) in snap.items():
+            await websocket.pubsub.publish(f'chan:{channel_id}',
+                                           json.dumps({ 'type': 'set-vote-open',
+                                                        'vote_id': vote_id,
+                                                        'open': False }))
+    return list(snap)
 
 async def close_to_db() -> None:
-    s = db.Session()
+    start = time.perf_counter()
     vl = await cast(Awaitable[dict[Any, Any]], db.redis_conn.hgetall('vote_info'))
     vd = decode_redis_dict(vl)
-    for vid, vs in vd.items():
-        vi = json.loads(vs)
-        channel_id = vi['channel_id']
-        await close_vote(channel_id, int(vid), set_close_time=False,
-                         emit_client_event=False, s=s)
+    votes = [(json.loads(vs)['channel_id'], int(vid))
+             for vid, vs in vd.items()]
+    async with db.Session() as s:
+        closed = await close_votes(votes, set_close_time=False,
+                                   emit_client_event=False, s=s)
+    elapsed = time.perf_counter() - start
+    metrics.observe('votes.close_to_db', elapsed)
+    print(f"Closed {len(closed)} votes to the DB in {elapsed:.3f}s")
+
+# With redis_snapshot_restart set, a node shutting down leaves the vote state
+# in Redis rather than closing every vote to the DB, and stamps it so the next
+# startup knows it can use it as it is. The stamp covers the layout version
+# below and the Lua code, since either changing can make the old state
+# unreadable. Bump VOTE_STATE_VERSION whenever the Redis vote keys change
+# shape.
+VOTE_STATE_VERSION = 1
+vote_state_stamp_key = 'vote_state_stamp'
+
+def vote_state_stamp() -> str:
+    lua = (importlib.resources.files('openakun').
+           joinpath('redisvotes.lua').read_bytes())
+    return f"{VOTE_STATE_VERSION}:{hashlib.sha256(lua).hexdigest()}"
+
+async def save_vote_state() -> None:
+    """Called on shutdown in snapshot mode instead of close_to_db()."""
+    start = time.perf_counter()
+    # not needed for the restart itself, but keeps Postgres reasonably
+    # current in case Redis doesn't make it
+    async with db.Session() as s:
+        n = await checkpoint_votes(s)
+    await db.redis_conn.set(vote_state_stamp_key, vote_state_stamp())
+    print(f"Left vote state in Redis ({n} votes checkpointed) in "
+          f"{time.perf_counter() - start:.3f}s")
+
+async def clear_vote_state() -> None:
+    keys: list[Any] = ['vote_info', 'vote_close_times', 'vote_dirty']
+    for pat in ('channel_votes:*', 'vote_user_options:*'):
+        keys.extend([k async for k in db.redis_conn.scan_iter(match=pat)])
+    await db.redis_conn.delete(*keys)
+
+async def restore_vote_state() -> None:
+    """Called on startup in snapshot mode instead of repopulate_from_db(). If
+    the vote state was left by a matching version, it's adopted as is,
+    without going to Postgres at all. Votes whose close time passed in the
+    meantime are closed by the close scheduler once it starts.
+
+    """
+    async with db.redis_conn.pipeline(transaction=True) as pipe:
+        pipe.get(vote_state_stamp_key)
+        pipe.delete(vote_state_stamp_key)
+        stamp, _ = await pipe.execute()
+    if stamp is not None and stamp.decode() == vote_state_stamp():
+        print("Adopted vote state left in Redis")
+        return
+    if stamp is not None:
+        # left by a different version; we can't trust we can read it
+        print("Vote state in Redis is from another version, rebuilding")
+        await clear_vote_state()
+    # with no stamp at all (first start, or the last node didn't shut down
+    # cleanly), whatever's in Redis is still the newest state there is, and
+    # repopulate_from_db() leaves it alone
+    await repopulate_from_db()
 
 # This can just call add_active_vote again, unset time_closed on the vote
 # entry, and emit an event to the frontend
@@ -561,8 +1107,11 @@ async def open_vote(channel_id: int, vote_id: int) -> None:
         where(models.VoteInfo.id == vote_id))).one()
     channel_id = vm.post.story.channel_id
     vm.time_closed = None
+    vote_skeletons.pop(vote_id)
     await add_active_vote(vm, channel_id)
     await s.commit()
+    await content_versions.bump(f'votes:{channel_id}')
+    await story_activity.touch(channel_id)
 
     await websocket.pubsub.publish(
         f'chan:{channel_id}',
@@ -615,8 +1164,9 @@ async def set_option_killed(data: dict[str, Any]) -> None:
         kill_string))
     if not rv:
         return None
+    vote_skeletons.pop(int(vote_id))
 
-    await send_vote_html(int(channel_id), int(vote_id))
+    await schedule_vote_html(channel_id, vote_id)
 
 @handle_message('set_vote_options')
 async def set_vote_options(data: dict[str, Any]) -> None:
@@ -655,8 +1205,9 @@ async def set_vote_options(data: dict[str, Any]) -> None:
         vote_id, json.dumps(vote.to_redis_dict())))
     if not rv:
         return None
+    vote_skeletons.pop(vote_id)
 
-    await send_vote_html(channel_id, vote_id)
+    await schedule_vote_html(channel_id, vote_id)
 
 @handle_message('set_vote_close_time')
 async def set_vote_close_time(data: dict[str, Any]) -> None:
@@ -704,13 +1255,15 @@ async def set_vote_close_time(data: dict[str, Any]) -> None:
         vote_id, json.dumps(rd)))
     if not rv:
         return None
+    vote_skeletons.pop(vote_id)
 
     if vote.close_time is not None:
+        close_ms = int(vote.close_time.timestamp() * 1000)
         await db.redis_conn.zadd('vote_close_times',
-                                 { f"{channel_id}:{vote.db_id}":
-                                   int(vote.close_time.timestamp() * 1000) })
+                                 { f"{channel_id}:{vote.db_id}": close_ms })
+        await notify_vote_close_time(close_ms)
     else:
         await db.redis_conn.zrem('vote_close_times',
                                  f"{channel_id}:{vote.db_id}")
 
-    await send_vote_html(channel_id, vote_id)
+    await schedule_vote_html(channel_id, vote_id)
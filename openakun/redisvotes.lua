@@ -9,6 +9,17 @@
 -- strings, and values are JSON text. This includes vote
 -- configuration, options and votes.
 
+-- Alongside that, each active vote has a reverse index hash
+-- "vote_user_options:{vote_id}", mapping each user identifier to a
+-- comma-separated list of the option IDs that user currently votes
+-- for. This lets the web code answer "what did this user vote for"
+-- without decoding the whole vote. It's kept in step by the functions
+-- here; users with no votes have no entry.
+
+-- Every change to a vote also adds its ID to the "vote_dirty" set,
+-- which the checkpointer drains (take_dirty_votes) to copy just the
+-- changed votes to Postgres.
+
 -- for all these functions, "keys" will always be 1. the appropriate
 -- "channel_votes:{channel_id}" key and 2. "vote_info"
 
@@ -27,10 +38,7 @@ end
 -- call only after validating that the given vote is on the correct
 -- channel
 local function get_vote(id)
-   local d = redis.call('HGET', 'vote_info', id)
-   redis.log(redis.LOG_WARNING, d)
-   local vote = cjson.decode(d)
-   redis.log(redis.LOG_WARNING, cjson.encode(vote))
+   local vote = cjson.decode(redis.call('HGET', 'vote_info', id))
    for _, v in pairs(vote.votes) do
       v.users_voted_for = Set(v.users_voted_for)
    end
@@ -44,11 +52,37 @@ local function set_vote(id, vote)
       v.users_voted_for = to_list(v.users_voted_for)
    end
    redis.call('HSET', 'vote_info', id, cjson.encode(vote))
+   redis.call('SADD', 'vote_dirty', id)
 end
 redis.register_function('set_vote', set_vote)
 
+local function user_index_key(vote_id)
+   return 'vote_user_options:' .. vote_id
+end
+
+-- call after changing any of user_id's votes on the given vote
+local function update_user_index(vote_id, vote, user_id)
+   local opts = {}
+   for oid, v in pairs(vote.votes) do
+      if v.users_voted_for[user_id] then
+         table.insert(opts, oid)
+      end
+   end
+   if #opts == 0 then
+      redis.call('HDEL', user_index_key(vote_id), user_id)
+   else
+      redis.call('HSET', user_index_key(vote_id), user_id,
+                 table.concat(opts, ','))
+      -- anonymous readers who have voted don't get cached pages, since
+      -- their own votes are marked on the page
+      if string.sub(user_id, 1, 5) == 'anon:' then
+         redis.call('SADD', 'anon_voters', user_id)
+      end
+   end
+end
+
 local function add_vote(keys, args)
-   if not redis.call('SISMEMBER', keys[1], args[1]) == 1 then
+   if redis.call('SISMEMBER', keys[1], args[1]) ~= 1 then
       return false
    end
    local vote_id = args[1]
@@ -67,13 +101,14 @@ local function add_vote(keys, args)
       end
    end
    vote.votes[option_id].users_voted_for[user_id] = true
+   update_user_index(vote_id, vote, user_id)
    set_vote(vote_id, vote)
    return true
 end
 redis.register_function('add_vote', add_vote)
 
 local function remove_vote(keys, args)
-   if not redis.call('SISMEMBER', keys[1], args[1]) == 1 then
+   if redis.call('SISMEMBER', keys[1], args[1]) ~= 1 then
       return false
    end
    local vote_id = args[1]
@@ -84,13 +119,14 @@ local function remove_vote(keys, args)
       return false
    end
    vote.votes[option_id].users_voted_for[user_id] = nil
+   update_user_index(vote_id, vote, user_id)
    set_vote(vote_id, vote)
    return true
 end
 redis.register_function('remove_vote', remove_vote)
 
 local function new_vote_entry(keys, args)
-   if not redis.call('SISMEMBER', keys[1], args[1]) == 1 then
+   if redis.call('SISMEMBER', keys[1], args[1]) ~= 1 then
       return false
    end
    local vote_id = args[1]
@@ -108,6 +144,7 @@ local function new_vote_entry(keys, args)
    vote.votes[option_id] = { killed=false, users_voted_for={} }
    if user_id then
       vote.votes[option_id].users_voted_for[user_id] = true
+      update_user_index(vote_id, vote, user_id)
    end
    set_vote(vote_id, vote)
    return true
@@ -115,7 +152,7 @@ end
 redis.register_function('new_vote_entry', new_vote_entry)
 
 local function set_option_killed(keys, args)
-   if not redis.call('SISMEMBER', keys[1], args[1]) == 1 then
+   if redis.call('SISMEMBER', keys[1], args[1]) ~= 1 then
       return false
    end
    local vote_id = args[1]
@@ -142,7 +179,7 @@ end
 redis.register_function('set_option_killed', set_option_killed)
 
 local function set_vote_config(keys, args)
-   if not redis.call('SISMEMBER', keys[1], args[1]) == 1 then
+   if redis.call('SISMEMBER', keys[1], args[1]) ~= 1 then
       return false
    end
    local vote_id = args[1]
@@ -165,3 +202,59 @@ local function set_vote_config(keys, args)
    return true
 end
 redis.register_function('set_vote_config', set_vote_config)
+
+-- Empties the dirty set, and returns a flat list of vote ID, vote
+-- JSON pairs for the votes in it. Votes that have been closed since
+-- they were changed are left out. Doing this atomically means any
+-- change made after the snapshot marks the vote dirty again.
+local function take_dirty_votes(keys, args)
+   local ids = redis.call('SMEMBERS', 'vote_dirty')
+   redis.call('DEL', 'vote_dirty')
+   local rv = {}
+   for _, id in ipairs(ids) do
+      local d = redis.call('HGET', 'vote_info', id)
+      if d then
+         table.insert(rv, id)
+         table.insert(rv, d)
+      end
+   end
+   return rv
+end
+redis.register_function('take_dirty_votes', take_dirty_votes)
+
+-- Takes a vote out of its channel set, as close_votes does, but only
+-- if it's still due to close: keys[1] is "vote_close_times" and
+-- keys[2] the vote's "channel_votes:{channel_id}"; args[1] is the
+-- vote's member in the schedule, args[2] the vote ID and args[3] the
+-- time in milliseconds it has to be due by. A close time that's been
+-- pushed back since the caller read the schedule keeps the vote open.
+local function take_due_vote(keys, args)
+   local score = redis.call('ZSCORE', keys[1], args[1])
+   if not score or tonumber(score) > tonumber(args[3]) then
+      return 0
+   end
+   return redis.call('SREM', keys[2], args[2])
+end
+redis.register_function('take_due_vote', take_due_vote)
+
+-- Lease helpers, used to elect a single node to run a background
+-- job. keys[1] is the lease key; args[1] is the ID of the node that
+-- holds (or thinks it holds) the lease. Taking a free lease is a plain
+-- SET NX PX, which needs no function.
+local function renew_lease(keys, args)
+   if redis.call('GET', keys[1]) ~= args[1] then
+      return false
+   end
+   redis.call('PEXPIRE', keys[1], args[2])
+   return true
+end
+redis.register_function('renew_lease', renew_lease)
+
+local function release_lease(keys, args)
+   if redis.call('GET', keys[1]) ~= args[1] then
+      return false
+   end
+   redis.call('DEL', keys[1])
+   return true
+end
+redis.register_function('release_lease', release_lease)
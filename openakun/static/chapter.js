@@ -119,6 +119,62 @@ $(function () {
     anim_running = false;
   });
 
+  // Long chapters show a window of their posts, with buttons at either
+  // end that load the next window over. Once a load takes the page over
+  // data-max-posts posts, posts are dropped from the other end and a
+  // button to load them again is put in their place, so the page
+  // doesn't grow without bound as the reader goes through the chapter.
+  let trim_from = null;
+  htmx.on('htmx:beforeRequest', (ev) => {
+    let cl = ev.detail.elt.classList;
+    if (cl.contains('earlier-posts')) {
+      trim_from = 'end';
+    } else if (cl.contains('later-posts')) {
+      trim_from = 'start';
+    }
+  });
+  htmx.on('htmx:afterSettle', () => {
+    if (trim_from !== null) {
+      trim_posts(trim_from);
+      trim_from = null;
+    }
+  });
+
+  function trim_posts(from) {
+    let sc = document.querySelector('#story-content');
+    let max_posts = parseInt(sc.dataset.maxPosts);
+    let posts = Array.from(sc.querySelectorAll(':scope > .post'));
+    if (!max_posts || posts.length <= max_posts) {
+      return;
+    }
+    let dropped, anchor, dir;
+    if (from === 'end') {
+      dropped = posts.slice(max_posts);
+      anchor = posts[max_posts - 1];
+      dir = 'after';
+    } else {
+      dropped = posts.slice(0, posts.length - max_posts);
+      anchor = posts[posts.length - max_posts];
+      dir = 'before';
+    }
+    sc.querySelectorAll(dir === 'after' ? '.later-posts' : '.earlier-posts')
+      .forEach((el) => el.remove());
+    dropped.forEach((el) => el.remove());
+
+    let btn = document.createElement('button');
+    btn.className = (`post-loader ${dir === 'after' ? 'later' : 'earlier'}-posts ` +
+                     'btn btn-sm block w-full my-2');
+    btn.setAttribute('hx-get', `${sc.dataset.postsUrl}?${dir}=${anchor.dataset.postId}`);
+    btn.setAttribute('hx-swap', 'outerHTML');
+    btn.textContent = dir === 'after' ? 'Later posts' : 'Earlier posts';
+    if (dir === 'after') {
+      sc.append(btn);
+    } else {
+      sc.prepend(btn);
+    }
+    htmx.process(btn);
+  }
+
   ws_html_func((node, ev) => {
     let is_author = !!document.querySelector('[data-is-author]');
     if (node.getAttribute('data-totals-hidden') == '1' && is_author) {
@@ -133,6 +189,12 @@ $(function () {
       console.log(`ignoring update for chapter ${node.getAttribute('data-chapter-id')} (current chapter is ${chapter_id})`);
       ev.preventDefault();
     }
+    // new posts would go after the later posts that have been dropped;
+    // the reader will get them by loading those
+    if (node.id === 'story-content' && document.querySelector('#story-content .later-posts')) {
+      console.log('ignoring new post while later posts are unloaded');
+      ev.preventDefault();
+    }
 
     let chat_thread_id = document.querySelector('#chat-messages').dataset.threadId;
     let msg_thread_id = node.querySelector('[data-thread-id]')?.getAttribute('data-thread-id');
@@ -1,13 +1,17 @@
 #!python3
 
-import asyncio, json
+import asyncio, json, secrets, time, traceback
 from datetime import datetime, timezone, timedelta
 from .general import db
-from .realtime import close_vote
-from .data import ChatMessage
+from .realtime import close_votes, checkpoint_votes
+from .metrics import metrics
+from .cache import content_versions
+from . import realtime, websocket
+from .data import ChatMessage, PostHTMLText, sanitizer_pool
 from .models import Base, AsyncSession
 from . import models
 
+from sqlalchemy import select, update, bindparam, Table
 from sqlalchemy.dialects import postgresql
 
 from typing import Any, NoReturn, Collection, cast, Awaitable
@@ -125,23 +129,243 @@ async def chat_save_worker() -> NoReturn:
         await asyncio.sleep(60)
         await do_address_save()
 
-async def vote_close_worker() -> NoReturn:
-    while True:
-        await asyncio.sleep(1)
+class RedisLease:
+    """A lease on a Redis key, used to make sure that only one node runs a
+    given background job. Whoever manages to SET the key holds the lease until
+    it expires; the holder has to keep renewing it for as long as it wants to
+    keep the job.
 
-        now = datetime.now(tz=timezone.utc)
-        vals = await db.redis_conn.zrange(
-            'vote_close_times',
-            0, int(now.timestamp() * 1000), withscores=True, byscore=True)
+    """
+    def __init__(self, key: str, ttl: float = 10.0) -> None:
+        self.key = key
+        self.ttl = ttl
+        # this has to be unique across nodes, and PIDs aren't (in containers
+        # everything tends to be PID 1)
+        self.owner = secrets.token_hex(8)
+        self.held = False
+
+    async def acquire(self) -> bool:
+        """Takes the lease if it's free, or renews it if we already hold it.
+        Returns whether we hold the lease afterwards."""
+        ttl_ms = int(self.ttl * 1000)
+        if self.held:
+            self.held = bool(await cast(Awaitable[Any], db.redis_conn.fcall(
+                'renew_lease', 1, self.key, self.owner, ttl_ms)))
+        else:
+            self.held = bool(await db.redis_conn.set(
+                self.key, self.owner, nx=True, px=ttl_ms))
+        return self.held
 
+    async def release(self) -> None:
+        if self.held:
+            self.held = False
+            await cast(Awaitable[Any], db.redis_conn.fcall(
+                'release_lease', 1, self.key, self.owner))
+
+class VoteCloseScheduler:
+    """Closes votes when their close time comes up.
+
+    Only the node holding the vote_close lease does any closing. It sleeps
+    until the earliest deadline in vote_close_times, or until it hears on the
+    pubsub (realtime.vote_close_wake_key) that a sooner deadline has been set.
+    The only regular wakeups are for renewing the lease; the other nodes just
+    try to take the lease every so often in case the leader went away.
+
+    """
+    def __init__(self, lease_ttl: float = 10.0) -> None:
+        self.lease = RedisLease('lease:vote_close', lease_ttl)
+        self.wake = asyncio.Event()
+        self.next_deadline: float | None = None
+
+    async def _listen(self) -> NoReturn:
+        async for _, val in websocket.pubsub.subscribe(
+                realtime.vote_close_wake_key):
+            if not self.lease.held:
+                continue
+            if self.next_deadline is None or float(val) < self.next_deadline:
+                self.wake.set()
+        raise RuntimeError("vote close wake subscription ended")
+
+    async def close_due(self, now_ms: int) -> None:
+        vals = await db.redis_conn.zrange(
+            'vote_close_times', 0, now_ms, byscore=True)
+        if len(vals) == 0:
+            return
+        votes = []
+        for val in vals:
+            channel_id, vote_id = [int(i) for i in val.decode().split(':')]
+            votes.append((channel_id, vote_id))
         async with db.Session() as s:
-            for val, score in vals:
-                close_time = datetime.fromtimestamp(
-                    float(score) / 1000.0, timezone.utc)
-                if close_time > now:
+            try:
+                # the schedule may have changed since it was read; only
+                # the votes that are still due get closed
+                closed = await close_votes(
+                    votes, set_close_time=True, emit_client_event=True, s=s,
+                    due_ms=now_ms)
+            except Exception:
+                # leave the schedule alone so we try again, but not in a
+                # tight loop
+                traceback.print_exc()
+                await asyncio.sleep(1)
+                return
+        if closed:
+            metrics.incr('votes.closed_on_schedule', len(closed))
+        # close_votes takes the votes out of vote_close_times itself, but not
+        # if the vote had already gone inactive; drop those entries here so we
+        # don't keep waking up for them. Doing it by score means a close time
+        # that got pushed back in the meantime survives.
+        await db.redis_conn.zremrangebyscore('vote_close_times', 0, now_ms)
+
+    async def _lead_once(self) -> None:
+        # the event is cleared before reading the schedule, so a notification
+        # that comes in while we're working still wakes the wait below
+        self.wake.clear()
+        now_ms = int(time.time() * 1000)
+        await self.close_due(now_ms)
+
+        nxt = await db.redis_conn.zrange(
+            'vote_close_times', 0, 0, withscores=True)
+        self.next_deadline = float(nxt[0][1]) if nxt else None
+        # wake up in time to renew the lease even if nothing is due
+        timeout = self.lease.ttl / 3
+        if self.next_deadline is not None:
+            due_in = (self.next_deadline - time.time() * 1000) / 1000
+            timeout = max(min(timeout, due_in), 0)
+        try:
+            await asyncio.wait_for(self.wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self) -> NoReturn:
+        listener = asyncio.create_task(self._listen())
+        try:
+            while True:
+                try:
+                    leader = await self.lease.acquire()
+                except Exception:
+                    traceback.print_exc()
+                    leader = False
+                if not leader:
+                    self.next_deadline = None
+                    await asyncio.sleep(self.lease.ttl / 2)
                     continue
-                print(val, close_time)
-                channel_id, vote_id = [int(i) for i in val.decode().split(':')]
-                await close_vote(
-                    channel_id, vote_id, set_close_time=True,
-                    emit_client_event=True, s=s)
+                try:
+                    await self._lead_once()
+                except Exception:
+                    traceback.print_exc()
+                    await asyncio.sleep(1)
+        finally:
+            listener.cancel()
+            await self.lease.release()
+
+vote_closer = VoteCloseScheduler()
+
+class VoteCheckpointer:
+    """Periodically copies changed votes from Redis to Postgres (see
+    realtime.checkpoint_votes). Like the close scheduler, this only runs on
+    the node holding its lease.
+
+    """
+    def __init__(self) -> None:
+        self.lease = RedisLease('lease:vote_checkpoint')
+
+    async def run(self, interval: float) -> None:
+        if interval <= 0:
+            return
+        # the lease has to outlast a sleep between checkpoints
+        self.lease.ttl = max(self.lease.ttl, interval * 3)
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    if not await self.lease.acquire():
+                        continue
+                    start = time.perf_counter()
+                    async with db.Session() as s:
+                        n = await checkpoint_votes(s)
+                    if n:
+                        metrics.incr('votes.checkpointed', n)
+                        metrics.observe('votes.checkpoint',
+                                        time.perf_counter() - start)
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            await self.lease.release()
+
+vote_checkpointer = VoteCheckpointer()
+
+async def resanitize_batch(batch_size: int = 500) -> tuple[int, int]:
+    """Cleans a batch of posts whose text was cleaned with an older version
+    of the post allowlist, writing back the ones whose text changes (which
+    bumps their version, so cached renders are dropped, and their story's
+    posts content version, so cached pages are) and marking the rest as
+    current. Returns (posts checked, posts changed).
+
+    """
+    current = PostHTMLText.sanitizer_version
+    # Core statements on the table for the bulk updates, bumping the version
+    # by hand where the text changes; __table__ is only typed as FromClause
+    posts = cast(Table, models.Post.__table__)
+    stories = cast(Table, models.Story.__table__)
+    async with db.Session() as s:
+        rows = (await s.execute(
+            select(posts.c.id, posts.c.text, stories.c.channel_id).
+            join_from(posts, stories, posts.c.story_id == stories.c.id).
+            where(posts.c.sanitizer_version != current).
+            order_by(posts.c.id).
+            limit(batch_size))).all()
+        changed = []
+        same = []
+        channels = set()
+        for pid, text, channel_id in rows:
+            if text is None:
+                same.append(pid)
+                continue
+            # straight to the pool rather than through clean_async, so old
+            # posts don't push recent input out of the memo
+            clean = await sanitizer_pool.clean(PostHTMLText, text.dirty_html)
+            if clean != text.dirty_html:
+                changed.append({ 'pid': pid, 'new_text': clean })
+                channels.add(channel_id)
+            else:
+                same.append(pid)
+        if changed:
+            await s.execute(
+                update(posts).
+                where(posts.c.id == bindparam('pid')).
+                values(text=bindparam('new_text'), sanitizer_version=current,
+                       version=posts.c.version + 1),
+                changed)
+        if same:
+            await s.execute(
+                update(posts).
+                where(posts.c.id.in_(same)).
+                values(sanitizer_version=current))
+        await s.commit()
+    if channels:
+        await content_versions.bump(*(f'posts:{c}' for c in channels))
+    return len(rows), len(changed)
+
+async def resanitize_worker() -> None:
+    """Runs once at startup; after the allowlist changes, this brings all the
+    stored posts up to date in the background. Until it gets to a post, the
+    post is cleaned again each time it's loaded.
+
+    """
+    lease = RedisLease('lease:resanitize', 60.0)
+    if not await lease.acquire():
+        return
+    checked = changed = 0
+    try:
+        while True:
+            n, c = await resanitize_batch()
+            checked += n
+            changed += c
+            if n == 0 or not await lease.acquire():
+                break
+    except Exception:
+        traceback.print_exc()
+    finally:
+        await lease.release()
+    if checked:
+        print(f"Resanitized posts: {checked} checked, {changed} changed")
@@ -1,11 +1,15 @@
 import pytest
+import re
 import time
 import subprocess
 import psycopg2
 import secrets
 import redis
+from sqlalchemy import event, select
 
-from openakun import app, models, general, config, pages
+from datetime import datetime, timezone
+
+from openakun import app, models, general, config, pages, data
 
 from typing import Generator, AsyncGenerator
 
@@ -20,6 +24,74 @@ REDIS_IMAGE = "redis:alpine"
 REDIS_CONTAINER_NAME = "redis-test"
 REDIS_PORT = 6379
 
+class QueryCounter:
+    """Counts the SQL statements run while it's active."""
+    def __init__(self) -> None:
+        self.count = 0
+
+    def _count(self, *args, **kwargs) -> None:
+        self.count += 1
+
+    def __enter__(self) -> 'QueryCounter':
+        event.listen(general.db.db_engine.sync_engine,
+                     'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *args) -> None:
+        event.remove(general.db.db_engine.sync_engine,
+                     'before_cursor_execute', self._count)
+
+async def get_admin() -> models.User:
+    s = general.db_connect()
+    return (await s.scalars(
+        select(models.User).filter(models.User.name == 'admin'))).one()
+
+async def make_story(title: str,
+                     desc: str = '') -> tuple[models.Story, models.Chapter]:
+    """Creates a story by the admin user, and returns it and its first
+    chapter. Must be called in an app context."""
+    story = await pages.add_story(title, desc or title, await get_admin())
+    return story, (await story.awaitable_attrs.chapters)[0]
+
+async def make_vote_chapter(n_votes: int, n_opts: int):
+    """Creates a story whose first chapter has n_votes vote posts with n_opts
+    options each, and one user vote on every option. Returns (chapter, list of
+    vote IDs)."""
+    s = general.db_connect()
+    story, chapter = await make_story('vote story', 'votes')
+    vote_ids = []
+    for i in range(n_votes):
+        p = models.Post(text=None, post_type=models.PostType.Vote,
+                        posted_date=datetime.now(tz=timezone.utc),
+                        chapter=chapter, story=story)
+        vote = data.Vote.from_dict({
+            'question': f'question {i}', 'multivote': True,
+            'writein_allowed': True, 'votes_hidden': False,
+            'votes': [{ 'text': f'option {j}' } for j in range(n_opts)] })
+        vm = vote.create_model()
+        vm.post = p
+        for e in vm.votes:
+            e.votes.append(models.UserVote(anon_id=f'voter{i}'))
+        s.add(vm)
+        await s.commit()
+        vote_ids.append(vm.id)
+    return chapter, vote_ids
+
+async def get_csrf(response) -> str:
+    csrf_token = re.search(r'"_csrf_token"[^>]+?"([^"]+)"',
+                           await response.get_data(True)).group(1)
+    if csrf_token is not None: return csrf_token
+
+async def do_login(client, user: str, pwd: str):
+    lresp = await client.get('/login')
+    csrf_token = await get_csrf(lresp)
+    data = {
+        'user': user, 'pass': pwd,
+        '_csrf_token': csrf_token
+    }
+    lresp = await client.post('/login', form=data)
+    return lresp
+
 @pytest.fixture(scope="session")
 def redis_container() -> Generator[int, None, None]:
     """Fixture to run a temporary Redis container for testing."""
@@ -1,19 +1,6 @@
 import pytest, re
 
-async def get_csrf(response) -> str:
-    csrf_token = re.search(r'"_csrf_token"[^>]+?"([^"]+)"',
-                           await response.get_data(True)).group(1)
-    if csrf_token is not None: return csrf_token
-
-async def do_login(client, user: str, pwd: str):
-    lresp = await client.get('/login')
-    csrf_token = await get_csrf(lresp)
-    data = {
-        'user': user, 'pass': pwd,
-        '_csrf_token': csrf_token
-    }
-    lresp = await client.post('/login', form=data)
-    return lresp
+from conftest import do_login, get_csrf
 
 async def test_main(openakun_app):
     client = openakun_app.test_client()
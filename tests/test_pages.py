@@ -0,0 +1,574 @@
+import pytest, re, gzip
+from pathlib import Path
+from datetime import datetime, timezone, timedelta
+from sqlalchemy import select, insert
+from sqlalchemy.orm import defer
+from werkzeug.exceptions import NotFound
+
+from openakun import (models, pages, cache, data, worker, activity,
+                      compression)
+from openakun.metrics import metrics
+from openakun.general import db, db_connect
+
+from conftest import (QueryCounter, get_admin, make_story, make_vote_chapter,
+                      do_login, get_csrf)
+
+def get_nonce(resp) -> str:
+    csp = resp.headers['Content-Security-Policy-Report-Only']
+    return re.search(r"'nonce-([^']+)'", csp).group(1)
+
+async def test_anon_chapter_cache(openakun_app):
+    async with openakun_app.app_context():
+        story, chapter = await make_story('cached story', 'cached')
+        url = f'/story/{story.id}/{chapter.id}'
+        channel_id = story.channel_id
+
+    client = openakun_app.test_client()
+    r1 = await client.get(url)
+    assert r1.status_code == 200
+    with QueryCounter() as qc:
+        r2 = await client.get(url)
+    assert r2.status_code == 200
+    assert qc.count == 0
+
+    # the cached page carries this response's nonce, not the first one's
+    body = await r2.get_data(True)
+    assert get_nonce(r1) != get_nonce(r2)
+    assert get_nonce(r2) in body and get_nonce(r1) not in body
+    assert cache.PageCache.NONCE_MARKER not in body
+    assert cache.PageCache.CSRF_MARKER not in body
+
+    # a reader's theme isn't served to the others
+    dark = openakun_app.test_client()
+    await dark.post('/settings', form={ 'dark_mode': '1' })
+    assert 'data-theme="forest"' in await (await dark.get(url)).get_data(True)
+    assert 'data-theme="forest"' not in await r2.get_data(True)
+    r = await openakun_app.test_client().get(url)
+    assert 'data-theme="forest"' not in await r.get_data(True)
+
+    # a new post invalidates it
+    async with openakun_app.app_context():
+        await cache.content_versions.bump(f'posts:{channel_id}')
+    with QueryCounter() as qc:
+        r3 = await client.get(url)
+    assert r3.status_code == 200
+    assert qc.count > 0
+
+async def test_post_fragment_cache(openakun_app):
+    async with openakun_app.test_request_context('/'):
+        s = db_connect()
+        story, chapter = await make_story('fragment story', 'fragments')
+        p = models.Post(text=data.PostHTMLText('<p>first</p>'),
+                        post_type=models.PostType.Text,
+                        posted_date=datetime.now(tz=timezone.utc),
+                        chapter=chapter, story=story)
+        s.add(p)
+        await s.commit()
+
+        async def load_and_render():
+            s.expunge_all()
+            posts = (await s.scalars(
+                select(models.Post).
+                options(defer(models.Post.text)).
+                filter(models.Post.chapter_id == chapter.id))).all()
+            await pages.prepare_posts(posts, story.channel_id)
+            with QueryCounter() as qc:
+                await pages.render_post_fragments(posts, 'reader')
+            post = next(i for i in posts if i.id == p.id)
+            return post, qc.count
+
+        post, count = await load_and_render()
+        assert count == 1 and 'first' in post.fragment
+        post, count = await load_and_render()
+        assert count == 0 and 'first' in post.fragment
+
+        # an edit bumps the version, so the old fragment isn't used
+        post.text = data.PostHTMLText('<p>second</p>')
+        await s.commit()
+        assert post.version == 2
+        post, count = await load_and_render()
+        assert count == 1 and 'second' in post.fragment
+
+async def test_post_version_bump(openakun_app):
+    async with openakun_app.test_request_context('/'):
+        _, chapter = await make_story('version story')
+        pid = (await pages.create_post(chapter, models.PostType.Text,
+                                       '<p>first</p>')).id
+
+    async with db.Session() as s1, db.Session() as s2:
+        p1 = await s1.get(models.Post, pid)
+        p2 = await s2.get(models.Post, pid)
+        p1.text = data.PostHTMLText('<p>one</p>')
+        await s1.commit()
+        assert p1.version == 2
+        # an update made from a copy loaded before that one still goes
+        # through, and still gets a new version
+        p2.text = data.PostHTMLText('<p>two</p>')
+        await s2.commit()
+        assert p2.version == 3
+
+async def test_outdated_posts_resanitized(openakun_app):
+    async with openakun_app.app_context():
+        s = db_connect()
+        story, chapter = await make_story('old story', 'old')
+        # as if stored under an older, laxer allowlist
+        pid = (await s.execute(
+            insert(models.Post.__table__).
+            values(text='<p>ok</p><script>bad()</script>',
+                   posted_date=datetime.now(tz=timezone.utc),
+                   story_id=story.id, chapter_id=chapter.id, order_idx=10,
+                   post_type=models.PostType.Text, sanitizer_version=0).
+            returning(models.Post.__table__.c.id))).scalar_one()
+        await s.commit()
+
+        # loading it cleans it, without writing anything
+        p = await s.get(models.Post, pid)
+        assert '<script>' not in str(p.text)
+        assert p.sanitizer_version == 0
+        # and so does selecting just the column, which doesn't say which
+        # allowlist the text was cleaned with
+        text = (await s.scalars(
+            select(models.Post.text).filter(models.Post.id == pid))).one()
+        assert '<script>' not in str(text)
+
+        posts_key = f'posts:{story.channel_id}'
+        before = (await cache.content_versions.get(posts_key))[0]
+        checked, changed = 0, 0
+        while True:
+            n, c = await worker.resanitize_batch()
+            if n == 0:
+                break
+            checked, changed = checked + n, changed + c
+        assert checked >= 1 and changed >= 1
+        # cached pages with the old text are dropped
+        assert (await cache.content_versions.get(posts_key))[0] > before
+
+        s.expunge_all()
+        p = await s.get(models.Post, pid)
+        assert p.sanitizer_version == data.PostHTMLText.sanitizer_version
+        assert p.version == 2
+        assert '<script>' not in p.text.dirty_html
+
+async def test_clean_async(openakun_app):
+    pool = data.sanitizer_pool
+    old_threshold = pool.threshold
+    pool.threshold = 1000
+    try:
+        good = '<p>' + 'long text ' * 200 + '</p>'
+        bad = good + '<script>bad()</script>'
+        for html in ('<p>short</p>', good):
+            t = await data.PostHTMLText.clean_async(html)
+            assert t.clean_html == t.dirty_html == html
+        assert await data.clean_html_async(good) == good
+        # only the input small enough to clean inline is memoized
+        memo = data.sanitized_html
+        assert memo.get(data.PostHTMLText._memo_key('<p>short</p>'))
+        assert memo.get(data.PostHTMLText._memo_key(good)) is None
+
+        # the same errors as the synchronous versions
+        with pytest.raises(data.BadHTMLError) as e1:
+            await data.PostHTMLText.clean_async(bad)
+        with pytest.raises(data.BadHTMLError) as e2:
+            data.clean_html(bad)
+        assert e1.value.bad_html == e2.value.bad_html == bad
+        assert e1.value.good_html == e2.value.good_html
+        assert '<script>' not in e1.value.good_html
+        t = await data.PostHTMLText.clean_async(bad, allow_mismatch=True)
+        assert t.clean_html == e1.value.good_html
+
+        # the second time around comes from the memo
+        data.sanitized_html.clear()
+        await data.PostHTMLText.clean_async(good)
+        assert len(data.sanitized_html) == 1
+        await data.PostHTMLText.clean_async(good)
+        assert data.PostHTMLText(good).clean_html == good
+        assert len(data.sanitized_html) == 1
+    finally:
+        pool.threshold = old_threshold
+
+async def test_story_activity(openakun_app):
+    idx = activity.story_activity
+    async with openakun_app.app_context():
+        stories = [(await make_story(f'active {i}'))[0] for i in range(4)]
+        # in the future, so they're at the top whatever else is in there
+        when = datetime.now(tz=timezone.utc) + timedelta(days=1)
+        for i, st in enumerate(stories):
+            await idx.touch(st.channel_id, when + timedelta(minutes=i))
+        # tied with the newest, to check the cursor handles ties
+        await idx.touch(stories[0].channel_id,
+                        when + timedelta(minutes=3))
+        # an older time doesn't move a story back
+        await idx.touch(stories[3].channel_id, when)
+
+        seen = []
+        before = None
+        while len(seen) < 4:
+            page = await idx.page(1, before)
+            assert len(page) == 1
+            seen.append(page[0][0])
+            before = page[0]
+        assert sorted(seen[:2]) == sorted(
+            [stories[0].channel_id, stories[3].channel_id])
+        assert seen[2:] == [stories[2].channel_id, stories[1].channel_id]
+
+    client = openakun_app.test_client()
+    r = await client.get('/')
+    assert r.status_code == 200
+    body = await r.get_data(True)
+    assert 'Live now' in body and 'active 3' in body
+    # the live stories aren't listed again under them
+    for st in stories:
+        assert body.count(f'href="/story/{st.id}"') == 1
+
+async def test_topic_counts(openakun_app):
+    async with openakun_app.app_context():
+        s = db_connect()
+        story, _ = await make_story('topic story', 'topics')
+        topic = models.Topic(title='a topic', poster=await get_admin(),
+                             story=story,
+                             post_date=datetime.now(tz=timezone.utc))
+        s.add(topic)
+        await s.commit()
+        story_id, topic_id = story.id, topic.id
+
+    client = openakun_app.test_client()
+    await do_login(client, 'admin', 'password')
+    r = await client.get('/new_story')
+    tok = await get_csrf(r)
+    before = pages.topic_list_updates.stats()
+    for i in range(3):
+        r = await client.post('/new_topic_post', json={
+            'topic_id': topic_id, 'text': f'<p>reply {i}</p>',
+            '_csrf_token': tok })
+        assert r.status_code == 302
+    # one list re-render pending for all three replies
+    after = pages.topic_list_updates.stats()
+    assert after['marked'] - before['marked'] == 3
+    assert after['coalesced'] - before['coalesced'] == 2
+
+    async with openakun_app.app_context():
+        s = db_connect()
+        with QueryCounter() as qc:
+            topics = await pages.get_topics(story_id)
+        # the topics and their posters, and no messages
+        assert qc.count == 2
+        assert not any(isinstance(o, models.TopicMessage)
+                       for o in s.identity_map.values())
+        t = next(t for t in topics if t.id == topic_id)
+        assert t.message_count == 3
+        assert t.last_post_date is not None
+
+async def test_post_order_allocation(openakun_app):
+    async with openakun_app.test_request_context('/'):
+        s = db_connect()
+        story, first = await make_story('ordered story', 'ordered')
+        second = await pages.create_chapter(story, 'Chapter 2')
+        assert (first.order_idx, second.order_idx) == (0, 10)
+
+        # taking an index is one UPDATE, however many posts there are
+        posts = []
+        for i in range(3):
+            with QueryCounter() as qc:
+                posts.append(await pages.create_post(
+                    first, models.PostType.Text, f'<p>post {i}</p>'))
+            # the INSERT and the counter UPDATE
+            assert qc.count <= 2
+        assert [p.order_idx for p in posts] == [0, 10, 20]
+
+        # squeeze posts in after the first until it has to renumber
+        ids = [p.id for p in posts]
+        for i in range(5):
+            idx = await pages.post_idx_after(first.id, posts[0].id)
+            p = await pages.create_post(first, models.PostType.Text,
+                                        f'<p>between {i}</p>', idx)
+            ids.insert(1, p.id)
+        p = await pages.create_post(first, models.PostType.Text,
+                                    '<p>first</p>',
+                                    await pages.post_idx_after(first.id, None))
+        ids.insert(0, p.id)
+        p = await pages.create_post(first, models.PostType.Text,
+                                    '<p>last</p>')
+        ids.append(p.id)
+
+        ordered = (await s.scalars(
+            select(models.Post.id).
+            filter(models.Post.chapter_id == first.id).
+            order_by(models.Post.order_idx))).all()
+        assert list(ordered) == ids
+
+        # a post from another chapter isn't somewhere to put one
+        other = await pages.create_post(second, models.PostType.Text,
+                                        '<p>elsewhere</p>')
+        with pytest.raises(NotFound):
+            await pages.post_idx_after(first.id, other.id)
+
+async def test_conditional_get(openakun_app, monkeypatch):
+    async with openakun_app.app_context():
+        story, chapter = await make_story('etag story', 'etags')
+        channel_id = story.channel_id
+    client = openakun_app.test_client()
+
+    for url, field in ((f'/story/{story.id}/{chapter.id}', 'posts'),
+                       (f'/story/{story.id}/topics', 'topics')):
+        r1 = await client.get(url)
+        assert r1.status_code == 200
+        etag = r1.headers['ETag']
+        with QueryCounter() as qc:
+            r2 = await client.get(url, headers={ 'If-None-Match': etag })
+        assert r2.status_code == 304 and qc.count == 0
+        assert await r2.get_data(True) == ''
+        assert 'Content-Security-Policy-Report-Only' not in r2.headers
+
+        # the HTMX version of the page is a different representation
+        r3 = await client.get(url, headers={ 'If-None-Match': etag,
+                                             'HX-Request': 'true' })
+        assert r3.status_code == 200 and r3.headers['ETag'] != etag
+
+        async with openakun_app.app_context():
+            await cache.content_versions.bump(f'{field}:{channel_id}')
+        r4 = await client.get(url, headers={ 'If-None-Match': etag })
+        assert r4.status_code == 200 and r4.headers['ETag'] != etag
+
+    # nor after changing theme, or after a deploy
+    url = f'/story/{story.id}/{chapter.id}'
+    etag = (await client.get(url)).headers['ETag']
+    monkeypatch.setattr(pages, 'build_version', lambda: 'next deploy')
+    r = await client.get(url, headers={ 'If-None-Match': etag })
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+    await client.post('/settings', form={ 'dark_mode': '1' })
+    r = await client.get(url, headers={ 'If-None-Match': etag })
+    assert r.status_code == 200 and 'data-theme="forest"' in (
+        await r.get_data(True))
+
+async def test_fingerprinted_assets(openakun_app):
+    client = openakun_app.test_client()
+    r = await client.get('/')
+    body = await r.get_data(True)
+    url = re.search(r'src="(/static/main\.[0-9a-f]{12}\.js)"', body).group(1)
+    plain = (Path(openakun_app.static_folder) / 'main.js').read_bytes()
+
+    r = await client.get(url, headers={ 'Accept-Encoding': 'gzip' })
+    assert r.status_code == 200
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in r.headers['Cache-Control']
+    assert 'Accept-Encoding' in r.headers['Vary']
+    assert gzip.decompress(await r.get_data()) == plain
+
+    r = await client.get(url, headers={ 'Accept-Encoding': 'identity' })
+    assert 'Content-Encoding' not in r.headers
+    assert await r.get_data() == plain
+
+    # a page from before a deploy asks for the old name
+    r = await client.get('/static/main.0123456789ab.js')
+    assert r.status_code == 200 and await r.get_data() == plain
+    assert 'immutable' not in r.headers['Cache-Control']
+
+    # excluded files are still there under their own names
+    r = await client.get('/static/vendor/tinymce/tinymce.min.js')
+    assert r.status_code == 200
+
+async def test_response_compression(openakun_app):
+    async with openakun_app.app_context():
+        story, chapter = await make_story('gzip story', 'gzip ' * 500)
+    client = openakun_app.test_client()
+    url = f'/story/{story.id}/{chapter.id}'
+
+    plain = await (await client.get(
+        url, headers={ 'Accept-Encoding': 'identity' })).get_data()
+    r = await client.get(url, headers={ 'Accept-Encoding': 'gzip' })
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert {'Accept-Encoding', 'HX-Request'} <= set(r.vary)
+    assert r.headers['ETag'].startswith('W/')
+    html = gzip.decompress(await r.get_data()).decode()
+    assert 'gzip story' in html
+    assert len(await r.get_data()) < len(plain)
+
+    r = await client.get(url, headers={ 'Accept-Encoding': 'identity' })
+    assert 'Content-Encoding' not in r.headers
+    assert 'Accept-Encoding' in r.vary
+
+    # the CSRF token is masked differently in every response, so it can't be
+    # worked out from the compressed sizes of pages (BREACH), and each one
+    # is still accepted
+    tokens = [await get_csrf(await client.get('/login')) for _ in range(2)]
+    assert tokens[0] != tokens[1]
+    for tok in tokens:
+        r = await client.post('/login', form={
+            '_csrf_token': tok, 'user': 'admin', 'pass': 'wrong' })
+        assert r.status_code != 400
+
+    # too small to be worth compressing
+    rc = compression.response_compressor
+    old_size, rc.min_size = rc.min_size, 10**9
+    try:
+        r = await client.get(url, headers={ 'Accept-Encoding': 'gzip' })
+        assert 'Content-Encoding' not in r.headers
+    finally:
+        rc.min_size = old_size
+
+async def test_streamed_chapter(openakun_app):
+    async with openakun_app.test_request_context('/'):
+        story, chapter = await make_story('long story', 'long')
+        for i in range(7):
+            await pages.create_post(chapter, models.PostType.Text,
+                                    f'<p>streamed post {i}</p>')
+    client = openakun_app.test_client()
+    url = f'/story/{story.id}/{chapter.id}'
+
+    cfg = openakun_app.config['data_obj']
+    old = cfg.stream_min_posts, cfg.stream_batch_size
+    cfg.stream_min_posts, cfg.stream_batch_size = 5, 3
+    streamed = metrics.get('chapter.streamed')
+    try:
+        r = await client.get(url)
+    finally:
+        cfg.stream_min_posts, cfg.stream_batch_size = old
+    assert r.status_code == 200
+    assert metrics.get('chapter.streamed') == streamed + 1
+    html = await r.get_data(True)
+    # the same page as when it's rendered whole
+    assert html.rstrip().endswith('</html>')
+    found = re.findall(r'streamed post (\d)', html)
+    assert found == [str(i) for i in range(7)]
+    assert 'Content-Encoding' not in r.headers
+    assert metrics.timings['chapter.stream.ttfb'].count >= 1
+    assert metrics.timings['chapter.stream.total'].count >= 1
+
+async def test_streamed_chapter_logged_in(openakun_app):
+    # the stream renders after the view has returned, so it mustn't depend on
+    # anything the request's teardown has already cleaned up
+    async with openakun_app.test_request_context('/'):
+        chapter, vote_ids = await make_vote_chapter(1, 2)
+        s = db_connect()
+        vote = await data.Vote.load(s, vote_ids[0])
+        s.add(models.UserVote(entry_id=vote.votes[0].db_id,
+                              user_id=(await get_admin()).id))
+        await s.commit()
+        for i in range(4):
+            await pages.create_post(chapter, models.PostType.Text,
+                                    f'<p>streamed post {i}</p>')
+        url = f'/story/{chapter.story_id}/{chapter.id}'
+    client = openakun_app.test_client()
+    await do_login(client, 'admin', 'password')
+
+    cfg = openakun_app.config['data_obj']
+    old = cfg.stream_min_posts, cfg.stream_batch_size
+    cfg.stream_min_posts, cfg.stream_batch_size = 2, 2
+    streamed = metrics.get('chapter.streamed')
+    try:
+        r = await client.get(url)
+        html = await r.get_data(True)
+    finally:
+        cfg.stream_min_posts, cfg.stream_batch_size = old
+    assert r.status_code == 200
+    assert metrics.get('chapter.streamed') == streamed + 1
+    assert html.rstrip().endswith('</html>')
+    assert 'Welcome, admin' in html
+    assert 'question 0' in html
+    assert re.findall(r'streamed post (\d)', html) == ['0', '1', '2', '3']
+    # the admin's own vote is marked
+    assert 'class="voted-for' in html
+    # one nonce for the whole page, the one the CSP allows
+    assert set(re.findall(r'nonce="([^"]+)"', html)) == {get_nonce(r)}
+
+async def test_post_window(openakun_app):
+    async with openakun_app.test_request_context('/'):
+        story, chapter = await make_story('windowed story', 'windowed')
+        other = await pages.create_chapter(story, 'Chapter 2')
+        for i in range(8):
+            await pages.create_post(chapter, models.PostType.Text,
+                                    f'<p>window post {i}</p>')
+        stray = await pages.create_post(other, models.PostType.Text,
+                                        '<p>elsewhere</p>')
+    client = openakun_app.test_client()
+    url = f'/story/{story.id}/{chapter.id}'
+    loader = re.compile(r'hx-get="[^"]*/posts\?(before|after)=(\d+)"')
+
+    def shown(html):
+        return [int(i) for i in re.findall(r'window post (\d)', html)]
+
+    cfg = openakun_app.config['data_obj']
+    old = cfg.chapter_window
+    cfg.chapter_window = 3
+    try:
+        html = await (await client.get(url)).get_data(True)
+        assert shown(html) == [5, 6, 7]
+        assert 'data-max-posts="6"' in html
+        # each window only has a button for the direction it was loaded in
+        seen = []
+        while (m := loader.search(html)) is not None:
+            assert m.group(1) == 'before'
+            r = await client.get(f'{url}/posts?before={m.group(2)}',
+                                 headers={ 'HX-Request': 'true' })
+            assert r.status_code == 200
+            html = await r.get_data(True)
+            seen = shown(html) + seen
+        assert seen == [0, 1, 2, 3, 4]
+
+        first = re.search(r'data-post-id="(\d+)"', html).group(1)
+        r = await client.get(f'{url}/posts?after={first}')
+        html = await r.get_data(True)
+        assert shown(html) == [1, 2, 3]
+        assert loader.search(html).group(1) == 'after'
+
+        assert (await client.get(f'{url}/posts')).status_code == 400
+        r = await client.get(f'{url}/posts?before={stray.id}')
+        assert r.status_code == 404
+    finally:
+        cfg.chapter_window = old
+
+async def test_chapter_nav_partial(openakun_app):
+    async with openakun_app.test_request_context('/'):
+        story, first = await make_story('nav story', 'nav')
+        second = await pages.create_chapter(story, 'Chapter 2')
+        await pages.create_post(second, models.PostType.Text,
+                                '<p>second chapter</p>')
+        # so the full page has a topic list and chat backlog to load
+        s = db_connect()
+        now = datetime.now(tz=timezone.utc)
+        s.add(models.Topic(title='a topic', poster=await get_admin(),
+                           story=story, post_date=now))
+        s.add(models.ChatMessage(channel_id=story.channel_id,
+                                 anon_id='anon', date=now, text='hello'))
+        await s.commit()
+    client = openakun_app.test_client()
+    url = f'/story/{story.id}/{second.id}'
+    nav = { 'HX-Request': 'true', 'HX-Target': 'content-container',
+            'HX-Current-URL': f'http://localhost/story/{story.id}/{first.id}' }
+
+    with QueryCounter() as full_qc:
+        full = await client.get(url, headers={ **nav, 'HX-Current-URL':
+                                               'http://localhost/' })
+    full_html = await full.get_data(True)
+    assert 'id="chat-messages"' in full_html
+    assert 'id="topic-bar"' in full_html
+
+    with QueryCounter() as qc:
+        r = await client.get(url, headers=nav)
+    html = await r.get_data(True)
+    assert r.status_code == 200
+    # less than half the queries of the whole page
+    assert qc.count * 2 < full_qc.count
+    assert '<title>nav story - openakun</title>' in html
+    assert 'id="content-container"' in html and 'second chapter' in html
+    assert 'id="chat-messages"' not in html
+    assert 'id="topic-bar"' not in html
+    assert 'ws-connect' not in html
+    assert r.headers['ETag'] != full.headers['ETag']
+
+    # a new chat message doesn't change what's sent here
+    async with openakun_app.app_context():
+        await cache.content_versions.bump(f'chat:{story.channel_id}')
+    r2 = await client.get(url, headers={ **nav,
+                                         'If-None-Match': r.headers['ETag'] })
+    assert r2.status_code == 304
+
+    # nor does it apply coming from another story (including one whose ID
+    # starts the same), or on history restores
+    other = f'http://localhost/story/{story.id}0/{first.id}'
+    for headers in ({ **nav, 'HX-Current-URL': 'http://localhost/story/0/1' },
+                    { **nav, 'HX-Current-URL': other },
+                    { **nav, 'HX-History-Restore-Request': 'true' }):
+        html = await (await client.get(url, headers=headers)).get_data(True)
+        assert 'id="chat-messages"' in html
@@ -0,0 +1,404 @@
+import asyncio, json, time
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from openakun import models, pages, data, realtime, websocket, worker
+from openakun.general import db, db_connect
+from quart import g, render_template
+
+from conftest import QueryCounter, make_vote_chapter
+
+async def test_vote_bulk_load_query_count(openakun_app):
+    async with openakun_app.app_context():
+        _, vote_ids = await make_vote_chapter(5, 20)
+        s = db_connect()
+
+        with QueryCounter() as qc:
+            votes = await data.Vote.load_many(s, vote_ids, 'anon:voter0')
+        assert qc.count == 3
+
+        assert set(votes) == set(vote_ids)
+        first = votes[vote_ids[0]]
+        assert len(first.votes) == 20
+        assert all(e.vote_count == 1 for e in first.votes)
+        assert all(e.user_voted for e in first.votes)
+        assert not any(e.user_voted for e in votes[vote_ids[1]].votes)
+
+        with QueryCounter() as qc:
+            one = await data.Vote.load(s, vote_ids[0])
+        assert qc.count == 3
+        assert one is not None and one.question == 'question 0'
+
+async def test_user_vote_index(openakun_app):
+    async with openakun_app.app_context():
+        chapter, vote_ids = await make_vote_chapter(2, 3)
+        s = db_connect()
+        channel_id = chapter.story.channel_id
+        for vid in vote_ids:
+            vm = await s.get(models.VoteInfo, vid)
+            await realtime.add_active_vote(vm, channel_id, s)
+
+        uv = await realtime.get_user_votes_many(vote_ids, 'anon:voter0')
+        assert len(uv[vote_ids[0]]) == 3
+        assert uv[vote_ids[1]] == set()
+
+        # changes made through the Lua functions keep the index in step
+        first, second = vote_ids
+        opt = min(uv[first])
+        await db.redis_conn.fcall(
+            'remove_vote', 2, f'channel_votes:{channel_id}', 'vote_info',
+            first, opt, 'anon:voter0')
+        other = (await data.Vote.load(s, second)).votes[0].db_id
+        await db.redis_conn.fcall(
+            'add_vote', 2, f'channel_votes:{channel_id}', 'vote_info',
+            second, other, 'anon:voter0')
+        uv = await realtime.get_user_votes_many(vote_ids, 'anon:voter0')
+        assert opt not in uv[first] and len(uv[first]) == 2
+        assert uv[second] == { other }
+        assert await realtime.get_user_votes(first, 'anon:voter0') == \
+            uv[first]
+
+async def test_close_votes_bulk(openakun_app):
+    async with openakun_app.app_context():
+        chapter, vote_ids = await make_vote_chapter(3, 4)
+        s = db_connect()
+        channel_id = chapter.story.channel_id
+        for vid in vote_ids:
+            vm = await s.get(models.VoteInfo, vid)
+            await realtime.add_active_vote(vm, channel_id, s)
+
+        # change the Redis state so we can see it make it to the DB
+        first = vote_ids[0]
+        opts = [e.db_id for e in (await data.Vote.load(s, first)).votes]
+        await db.redis_conn.fcall(
+            'remove_vote', 2, f'channel_votes:{channel_id}', 'vote_info',
+            first, opts[0], 'anon:voter0')
+        await db.redis_conn.fcall(
+            'add_vote', 2, f'channel_votes:{channel_id}', 'vote_info',
+            first, opts[1], 'anon:someone')
+
+        closed = await realtime.close_votes(
+            [(channel_id, v) for v in vote_ids], set_close_time=True,
+            emit_client_event=False, s=s)
+        assert sorted(closed) == sorted(vote_ids)
+        # a second close finds nothing to do
+        assert await realtime.close_votes(
+            [(channel_id, first)], emit_client_event=False, s=s) == []
+
+        for vid in vote_ids:
+            assert not await realtime.vote_is_active(channel_id, vid)
+            assert await db.redis_conn.hget('vote_info', str(vid)) is None
+        vote = await data.Vote.load(s, first)
+        counts = { e.db_id: e.vote_count for e in vote.votes }
+        assert counts[opts[0]] == 0
+        assert counts[opts[1]] == 2
+        assert all(counts[o] == 1 for o in opts[2:])
+        vm = await s.get(models.VoteInfo, first)
+        assert vm.time_closed is not None
+
+async def test_repopulate_skips_active(openakun_app):
+    async with openakun_app.app_context():
+        chapter, vote_ids = await make_vote_chapter(2, 2)
+        s = db_connect()
+        channel_id = chapter.story.channel_id
+        await realtime.repopulate_from_db()
+        for vid in vote_ids:
+            assert await realtime.vote_is_active(channel_id, vid)
+        assert len(await realtime.get_user_votes(
+            vote_ids[0], 'anon:voter0')) == 2
+
+        # state that's only in Redis survives a second repopulate
+        opt = (await data.Vote.load(s, vote_ids[1])).votes[0].db_id
+        await db.redis_conn.fcall(
+            'add_vote', 2, f'channel_votes:{channel_id}', 'vote_info',
+            vote_ids[1], opt, 'anon:late')
+        with QueryCounter() as qc:
+            await realtime.repopulate_from_db()
+        assert qc.count == 1
+        assert await realtime.get_user_votes(vote_ids[1], 'anon:late') == \
+            { opt }
+
+async def test_checkpoint_votes(openakun_app):
+    async with openakun_app.app_context():
+        chapter, vote_ids = await make_vote_chapter(2, 2)
+        s = db_connect()
+        channel_id = chapter.story.channel_id
+        for vid in vote_ids:
+            vm = await s.get(models.VoteInfo, vid)
+            await realtime.add_active_vote(vm, channel_id, s)
+        # start from a clean slate, whatever earlier tests left behind
+        await realtime.checkpoint_votes(s)
+
+        first = vote_ids[0]
+        opt = (await data.Vote.load(s, first)).votes[0].db_id
+        await db.redis_conn.fcall(
+            'add_vote', 2, f'channel_votes:{channel_id}', 'vote_info',
+            first, opt, 'anon:checkpointed')
+        assert await realtime.checkpoint_votes(s) == 1
+        assert await realtime.checkpoint_votes(s) == 0
+
+        # the vote is still active, but Postgres has the new ballot
+        assert await realtime.vote_is_active(channel_id, first)
+        vote = await data.Vote.load(s, first, 'anon:checkpointed')
+        entry = next(e for e in vote.votes if e.db_id == opt)
+        assert entry.user_voted and entry.vote_count == 2
+
+async def test_vote_state_snapshot(openakun_app):
+    async with openakun_app.app_context():
+        chapter, vote_ids = await make_vote_chapter(1, 2)
+        s = db_connect()
+        channel_id = chapter.story.channel_id
+        vm = await s.get(models.VoteInfo, vote_ids[0])
+        await realtime.add_active_vote(vm, channel_id, s)
+
+        # a matching stamp means the state is adopted without any queries
+        await realtime.save_vote_state()
+        with QueryCounter() as qc:
+            await realtime.restore_vote_state()
+        assert qc.count == 0
+        assert await realtime.vote_is_active(channel_id, vote_ids[0])
+        assert await db.redis_conn.get(realtime.vote_state_stamp_key) is None
+
+        # a stale one means rebuilding from Postgres
+        await db.redis_conn.set(realtime.vote_state_stamp_key, '0:old')
+        index_key = realtime.user_index_key(vote_ids[0])
+        await db.redis_conn.hset(index_key, 'anon:stale', '1')
+        await realtime.restore_vote_state()
+        assert await realtime.vote_is_active(channel_id, vote_ids[0])
+        assert await db.redis_conn.hget(index_key, 'anon:stale') is None
+
+async def test_prepare_posts_query_count(openakun_app):
+    async with openakun_app.app_context():
+        counts = []
+        for n_votes in (4, 12):
+            chapter, vote_ids = await make_vote_chapter(n_votes, 3)
+            s = db_connect()
+            channel_id = chapter.story.channel_id
+            # half the votes active, half closed
+            for vid in vote_ids[::2]:
+                vm = await s.get(models.VoteInfo, vid)
+                await realtime.add_active_vote(vm, channel_id, s)
+            posts = (await s.scalars(
+                select(models.Post).
+                options(selectinload(models.Post.vote_info)).
+                filter(models.Post.chapter_id == chapter.id))).all()
+            realtime.vote_skeletons.clear()
+
+            with QueryCounter() as qc:
+                await pages.prepare_posts(posts, channel_id)
+            counts.append(qc.count)
+
+            votes = { p.vote.db_id: p.vote for p in posts
+                      if p.post_type == models.PostType.Vote }
+            assert set(votes) == set(vote_ids)
+            assert all(votes[v].active for v in vote_ids[::2])
+            assert not any(votes[v].active for v in vote_ids[1::2])
+            assert all(len(v.votes) == 3 for v in votes.values())
+        # one skeleton query for the active votes, three for the closed ones
+        assert counts == [4, 4]
+
+async def test_active_vote_from_skeleton(openakun_app):
+    async with openakun_app.test_request_context('/'):
+        channel_id, (vote_id,) = await activate_votes(1)
+        realtime.vote_skeletons.clear()
+        with QueryCounter() as qc:
+            v, _ = await realtime.load_active_vote(channel_id, vote_id)
+        # just the skeleton
+        assert qc.count == 1
+
+        # after that, changes to the vote only need Redis
+        opt = v.votes[0].db_id
+        await db.redis_conn.fcall(
+            'add_vote', 2, f'channel_votes:{channel_id}', 'vote_info',
+            vote_id, opt, 'anon:late')
+        with QueryCounter() as qc:
+            v, _ = await realtime.load_active_vote(channel_id, vote_id)
+            html = await render_template(
+                'render_vote.html', vote=v,
+                chapter={ 'story': { 'channel_id': channel_id } })
+        assert qc.count == 0
+        assert 'question 0' in html
+        counts = { e.db_id: e.vote_count for e in v.votes }
+        assert counts[opt] == 2
+
+async def test_coalesced_flush_count(openakun_app, monkeypatch):
+    flushes = 0
+    updates = realtime.CoalescedUpdates('test_count', 0.05)
+    updates.init_app(openakun_app)
+
+    async def flush():
+        nonlocal flushes
+        flushes += 1
+
+    async with openakun_app.test_request_context('/'):
+        for _ in range(10):
+            await updates.mark('k', flush)
+        await updates.pending['k']
+    assert flushes == 1
+    assert updates.stats() == { 'marked': 10, 'emitted': 1, 'coalesced': 9 }
+
+    # and one send_vote_html() per vote for a burst of changes to it
+    sent = []
+    async def send(channel_id, vote_id, reopen=False):
+        sent.append((channel_id, vote_id))
+    monkeypatch.setattr(realtime, 'send_vote_html', send)
+    async with openakun_app.test_request_context('/'):
+        for _ in range(5):
+            await realtime.schedule_vote_html(1, 12345)
+            await realtime.schedule_vote_html(1, 12346)
+        await asyncio.gather(realtime.vote_updates.pending['12345'],
+                             realtime.vote_updates.pending['12346'])
+    assert sorted(sent) == [(1, 12345), (1, 12346)]
+
+async def test_coalesced_lease_release(openakun_app):
+    updates = realtime.CoalescedUpdates('test_release', 0.05)
+    updates.init_app(openakun_app)
+    lease = updates._lease_key('k')
+
+    async def failing():
+        raise RuntimeError("flush failed")
+
+    async with openakun_app.test_request_context('/'):
+        # a failed flush doesn't hold up the next one
+        await updates.mark('k', failing)
+        await updates.pending['k']
+        assert not await db.redis_conn.exists(lease)
+        assert 'k' not in updates.pending
+
+        # nor does one cancelled during the interval
+        updates.interval = 30
+        await updates.mark('k', failing)
+        assert await db.redis_conn.exists(lease)
+        task = updates.pending['k']
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert not await db.redis_conn.exists(lease)
+        assert 'k' not in updates.pending
+
+async def test_coalesced_flush_context(openakun_app):
+    seen = {}
+    done = asyncio.Event()
+    updates = realtime.CoalescedUpdates('test_flush', 0.01)
+    updates.init_app(openakun_app)
+
+    async def flush():
+        seen['marker'] = g.get('marker')
+        seen['session'] = db_connect()
+        done.set()
+
+    async with openakun_app.test_request_context('/'):
+        g.marker = 'caller'
+        caller_session = db_connect()
+        await updates.mark('k', flush)
+        await asyncio.wait_for(done.wait(), 5)
+    # the flush had its own g and session, not the marking request's
+    assert seen['marker'] is None
+    assert seen['session'] is not caller_session
+    assert not await db.redis_conn.exists(updates._lease_key('k'))
+
+    # a lease that's been taken over by another node isn't released
+    await db.redis_conn.set(updates._lease_key('k'), 'other')
+    updates.pending['k'] = asyncio.create_task(updates._run('k', flush))
+    await updates.pending['k']
+    assert await db.redis_conn.get(updates._lease_key('k')) == b'other'
+    await db.redis_conn.delete(updates._lease_key('k'))
+
+async def test_redis_lease(openakun_app):
+    async with openakun_app.app_context():
+        a = worker.RedisLease('lease:test', 5.0)
+        b = worker.RedisLease('lease:test', 5.0)
+        assert await a.acquire()
+        assert not await b.acquire()
+        # renewing keeps it
+        assert await a.acquire()
+        assert await db.redis_conn.pttl('lease:test') > 4000
+        await a.release()
+        assert not a.held
+        assert await b.acquire()
+        # a holder whose lease has lapsed and been taken can't renew it, or
+        # release it from under the new holder
+        a.held = True
+        assert not await a.acquire()
+        a.held = True
+        await a.release()
+        assert await db.redis_conn.get('lease:test') == b.owner.encode()
+        await b.release()
+        assert not await db.redis_conn.exists('lease:test')
+
+async def activate_votes(n_votes: int) -> tuple[int, list[int]]:
+    chapter, vote_ids = await make_vote_chapter(n_votes, 2)
+    s = db_connect()
+    channel_id = chapter.story.channel_id
+    for vid in vote_ids:
+        vm = await s.get(models.VoteInfo, vid)
+        await realtime.add_active_vote(vm, channel_id, s)
+    return channel_id, vote_ids
+
+async def closes_seen(channel_id: int, timeout: float) -> list[int]:
+    """The IDs of the votes that clients are told have closed on a channel,
+    over the next timeout seconds."""
+    closed = []
+    async for _, msg in websocket.pubsub.subscribe(f'chan:{channel_id}',
+                                                   timeout=timeout):
+        d = json.loads(msg)
+        if d.get('type') == 'set-vote-open' and not d['open']:
+            closed.append(d['vote_id'])
+    return closed
+
+async def stop(*tasks: asyncio.Task) -> None:
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def test_vote_close_scheduler(openakun_app):
+    async with openakun_app.app_context():
+        channel_id, (due, later) = await activate_votes(2)
+        now_ms = int(time.time() * 1000)
+        await db.redis_conn.zadd('vote_close_times',
+                                 { f'{channel_id}:{due}': now_ms - 1000,
+                                   f'{channel_id}:{later}': now_ms + 60000 })
+
+        with websocket.pubsub:
+            seen = asyncio.create_task(closes_seen(channel_id, 2))
+            await asyncio.sleep(0)
+            scheds = [worker.VoteCloseScheduler(lease_ttl=0.6)
+                      for _ in range(2)]
+            tasks = [asyncio.create_task(sc.run()) for sc in scheds]
+            closed = await seen
+            leaders = [sc.lease.held for sc in scheds]
+            await stop(*tasks)
+        # one of them led, and the due vote was closed once
+        assert leaders.count(True) == 1
+        assert closed == [due]
+        assert not await realtime.vote_is_active(channel_id, due)
+        assert await realtime.vote_is_active(channel_id, later)
+
+        # a close time pushed back after the schedule was read (here, after
+        # now_ms) keeps the vote open
+        s = db_connect()
+        assert await realtime.close_votes(
+            [(channel_id, later)], emit_client_event=False, s=s,
+            due_ms=now_ms) == []
+        assert await realtime.vote_is_active(channel_id, later)
+        assert await realtime.close_votes(
+            [(channel_id, later)], emit_client_event=False, s=s) == [later]
+
+async def test_vote_close_wake(openakun_app):
+    async with openakun_app.app_context():
+        channel_id, (vote_id,) = await activate_votes(1)
+        with websocket.pubsub:
+            sched = worker.VoteCloseScheduler(lease_ttl=30.0)
+            task = asyncio.create_task(sched.run())
+            while not sched.lease.held:
+                await asyncio.sleep(0.05)
+            # it's now asleep for up to ttl / 3, ten seconds
+            await asyncio.sleep(0.2)
+            seen = asyncio.create_task(closes_seen(channel_id, 3))
+            await asyncio.sleep(0)
+            close_ms = int(time.time() * 1000) + 200
+            await db.redis_conn.zadd('vote_close_times',
+                                     { f'{channel_id}:{vote_id}': close_ms })
+            await realtime.notify_vote_close_time(close_ms)
+            closed = await seen
+            await stop(task)
+        assert closed == [vote_id]